@@ -0,0 +1,62 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Conversions between Cozo results/parameters and Apache Arrow data. Requires the `pyarrow` package.
+
+Conversions are done column by column: a result becomes one Arrow array per column, and an Arrow table becomes
+one Python list per column before being zipped into the rows Cozo expects.
+"""
+
+import pyarrow as pa
+
+_COZO_ARROW_TYPES = {
+    'Int': pa.int64(),
+    'Float': pa.float64(),
+    'String': pa.string(),
+    'Bool': pa.bool_(),
+    'Bytes': pa.binary(),
+}
+
+
+def arrow_type(cozo_type):
+    """The Arrow type for a Cozo column type like 'Int' or 'Float?', or None if there is no direct equivalent"""
+    if cozo_type is None:
+        return None
+    if isinstance(cozo_type, pa.DataType):
+        return cozo_type
+    return _COZO_ARROW_TYPES.get(cozo_type.rstrip('?'))
+
+
+def to_table(headers, rows, dtypes=None):
+    """Build a `pyarrow.Table` from a Cozo result.
+
+    :param dtypes: optional dict from column names to Cozo types or Arrow types.
+                   Other columns have their type inferred by Arrow.
+    """
+    dtypes = dtypes or {}
+    columns = list(zip(*rows)) if rows else [()] * len(headers)
+    arrays = [pa.array(values, type=arrow_type(dtypes.get(name))) for name, values in zip(headers, columns)]
+    return pa.Table.from_arrays(arrays, names=list(headers))
+
+
+def to_rows(data):
+    """Turn an Arrow table or record batch into `(headers, rows)`, the form Cozo uses for results and imports"""
+    columns = [column.to_pylist() for column in data.columns]
+    return list(data.column_names), [list(row) for row in zip(*columns)]
+
+
+def iter_parquet_batches(path, batch_size=10000):
+    """Yield the contents of a Parquet file as record batches of at most `batch_size` rows"""
+    import pyarrow.parquet as pq
+
+    yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+
+
+def write_parquet(table, path, compression='snappy'):
+    """Write a `pyarrow.Table` to a Parquet file"""
+    import pyarrow.parquet as pq
+
+    pq.write_table(table, path, compression=compression)
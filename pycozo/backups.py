@@ -0,0 +1,423 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Scheduled, incremental backups of stored relations into chunked, compressed files.
+
+A `BackupManager` writes snapshots into a directory, one subdirectory per snapshot:
+
+    <path>/<snapshot id>/manifest.json
+    <path>/<snapshot id>/<relation>/<chunk>.ndjson.gz
+
+Each relation is split into chunks of consecutive keys, and each chunk is stored as its own file with one JSON
+row per line. The manifest of a snapshot lists, for every relation, its columns and all of its chunks with the
+lower bound of their keys, a digest of their rows and the file holding them, which may belong to an earlier
+snapshot. A snapshot is only listed once its manifest is written, so an interrupted snapshot is never restored.
+
+A full snapshot writes every chunk. An incremental snapshot reads the relations again, chunk by chunk along
+the key ranges of the previous snapshot, and only writes the chunks whose digest changed: unchanged chunks point
+to the files already written. Change callbacks are not used for this, as the change feed of Cozo has no durable
+position to resume from and the embedded engine only serves the callbacks of one relation at a time.
+
+For embedded databases, a snapshot is read from a native backup taken first (see `Client.backup`), so that all
+relations are captured at the same instant while the database keeps serving writes. Remote databases are read
+directly, which captures each chunk as of the time it is read.
+
+Relations are exported, and restored, in parallel. Restoring goes through `import_relations`, so triggers are
+_not_ run, and can be limited to some of the relations.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from pycozo.transfer import _NDJSON_SUFFIXES, _open_text, _run_parallel
+
+logger = logging.getLogger(__name__)
+
+_MANIFEST = 'manifest.json'
+
+
+class BackupManager:
+    """Takes full and incremental snapshots of a database, on demand or on a schedule, and restores them.
+
+    >>> import tempfile
+    >>> from pycozo.client import Client
+    >>> db = Client(dataframe=False)
+    >>> _ = db.run('?[k, v] <- [[1, "a"], [2, "b"]] :create kv {k => v}')
+    >>> backups = BackupManager(db, tempfile.mkdtemp())
+    >>> backups.snapshot()['kind']
+    'full'
+    >>> _ = db.run('?[k, v] <- [[3, "c"]] :put kv {k => v}')
+    >>> backups.snapshot()['chunks_written']
+    1
+    >>> restored = Client(dataframe=False)
+    >>> backups.restore(restored)
+    {'kv': 3}
+    """
+
+    def __init__(self, client, path, relations=None, keep=7, full_every=7, compression='gzip', chunk_size=10000,
+                 workers=4, staging_dir=None):
+        """
+        :param client: the client of the database to back up.
+        :param path: the local directory holding the snapshots. It is created if it does not exist.
+        :param relations: names of the stored relations to back up, all of them if None.
+        :param keep: the number of most recent snapshots kept by `rotate`, which runs after each snapshot.
+                     Files of older snapshots that kept ones still refer to are not removed.
+        :param full_every: scheduled snapshots are full every `full_every` snapshots, and incremental otherwise.
+        :param compression: the compression of the chunk files: None, 'gzip', 'bz2', 'xz' or 'zstd'
+                            (requires the `zstandard` package).
+        :param chunk_size: the number of rows per chunk of a full snapshot.
+        :param workers: the number of relations exported or chunks restored concurrently.
+        :param staging_dir: where the native backup of an embedded database is written before being read,
+                            by default in `path`.
+        """
+        if compression not in _NDJSON_SUFFIXES:
+            raise ValueError(f'Unknown compression {compression!r}, expected one of {list(_NDJSON_SUFFIXES)}')
+        self.client = client
+        self.path = path
+        self.relations = list(relations) if relations is not None else None
+        self.keep = keep
+        self.full_every = full_every
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.staging_dir = staging_dir or os.path.join(path, '.staging')
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        os.makedirs(path, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def snapshots(self):
+        """The manifests of the complete snapshots, oldest first"""
+        manifests = []
+        for name in sorted(os.listdir(self.path)):
+            file = os.path.join(self.path, name, _MANIFEST)
+            if not name.endswith('.partial') and os.path.isfile(file):
+                with open(file, encoding='utf-8') as f:
+                    manifests.append(json.load(f))
+        return manifests
+
+    def snapshot(self, full=None):
+        """Take a snapshot now.
+
+        :param full: whether to write all chunks. If None, the snapshot is full when there is no earlier
+                     snapshot, or when the last `full_every - 1` snapshots were all incremental.
+        :return: the summary of the snapshot: its `id`, `kind`, whether it is `consistent` across relations,
+                 the number of `rows`, `chunks_written`, `chunks_reused` and `bytes_written`, and the `seconds`
+                 it took.
+        """
+        with self._lock:
+            start = time.monotonic()
+            for name in os.listdir(self.path):
+                if name.endswith('.partial'):
+                    # left over by a snapshot that was interrupted
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+            previous = self.snapshots()
+            if full is None:
+                recent = [m['kind'] for m in previous[-max(1, self.full_every - 1):]]
+                full = not previous or self.full_every <= 1 or 'full' not in recent
+            last = previous[-1] if previous and not full else None
+            snapshot_id = _new_id(previous)
+            directory = os.path.join(self.path, snapshot_id)
+            partial = directory + '.partial'
+            os.makedirs(partial)
+            try:
+                with self._frozen_source() as (source, consistent):
+                    relations = self.relations if self.relations is not None else _stored_relations(source)
+
+                    def export_one(relation):
+                        previous_entry = last['relations'].get(relation) if last else None
+                        return _export_relation(source, relation, previous_entry, partial, snapshot_id,
+                                                self.compression, self.chunk_size)
+
+                    exported = _run_parallel(export_one, relations, self.workers)
+                manifest = {'id': snapshot_id, 'kind': 'full' if full else 'incremental', 'consistent': consistent,
+                            'created_at': time.time(), 'compression': self.compression,
+                            'relations': {relation: entry for relation, (entry, _) in exported.items()}}
+                written = [stats for _, stats in exported.values()]
+                manifest['rows'] = sum(entry['rows'] for entry in manifest['relations'].values())
+                manifest['chunks_written'] = sum(s['chunks_written'] for s in written)
+                manifest['chunks_reused'] = sum(s['chunks_reused'] for s in written)
+                manifest['bytes_written'] = sum(s['bytes_written'] for s in written)
+                manifest['seconds'] = time.monotonic() - start
+                with open(os.path.join(partial, _MANIFEST), 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f)
+                os.replace(partial, directory)
+            except BaseException:
+                shutil.rmtree(partial, ignore_errors=True)
+                raise
+            logger.info(f'Snapshot {snapshot_id} ({manifest["kind"]}): {manifest["rows"]} rows, '
+                        f'{manifest["chunks_written"]} chunks written, {manifest["chunks_reused"]} reused, '
+                        f'{manifest["seconds"]:.2f}s')
+            self.rotate()
+            return {key: value for key, value in manifest.items() if key != 'relations'}
+
+    def _frozen_source(self):
+        if self.client.embedded is None:
+            return _Unchanged(self.client)
+        return _NativeCopy(self.client, self.staging_dir)
+
+    def rotate(self):
+        """Remove the snapshots older than the `keep` most recent ones, and the files no kept snapshot uses.
+
+        :return: the ids of the removed snapshots.
+        """
+        snapshots = self.snapshots()
+        kept = snapshots[-self.keep:] if self.keep > 0 else []
+        kept_ids = {m['id'] for m in kept}
+        used = {chunk['file'] for m in kept for entry in m['relations'].values() for chunk in entry['chunks']
+                if chunk['file']}
+        removed = []
+        for manifest in snapshots:
+            if manifest['id'] in kept_ids:
+                continue
+            directory = os.path.join(self.path, manifest['id'])
+            for entry in manifest['relations'].values():
+                for chunk in entry['chunks']:
+                    if chunk['file'] and chunk['file'] not in used and chunk['file'].startswith(manifest['id'] + '/'):
+                        _remove(os.path.join(self.path, chunk['file']))
+            # the snapshot is no longer listed, the files still used by kept snapshots stay in place
+            os.remove(os.path.join(directory, _MANIFEST))
+            if not any(f.startswith(manifest['id'] + '/') for f in used):
+                shutil.rmtree(directory, ignore_errors=True)
+            removed.append(manifest['id'])
+        return removed
+
+    def restore(self, target=None, snapshot=None, relations=None, workers=None, create_missing=True,
+                progress=None):
+        """Load a snapshot into a database.
+
+        :param target: the client to restore into, by default the backed up one.
+        :param snapshot: the id of the snapshot, the most recent one if None.
+        :param relations: the relations to restore, all of those in the snapshot if None.
+        :param workers: the number of chunks imported concurrently, by default that of the manager.
+        :param create_missing: if true, relations missing from the target are created with the columns they had.
+                               Otherwise they must exist. Existing rows with other keys are kept.
+        :param progress: if given, called as `progress(relation, rows_restored)` after each chunk.
+        :return: a dict from relation names to the number of rows restored.
+        """
+        target = target or self.client
+        snapshots = self.snapshots()
+        if not snapshots:
+            raise ValueError(f'There are no snapshots in {self.path}')
+        if snapshot is None:
+            manifest = snapshots[-1]
+        else:
+            manifest = next((m for m in snapshots if m['id'] == snapshot), None)
+            if manifest is None:
+                raise ValueError(f'No snapshot {snapshot} in {self.path}')
+        names = list(manifest['relations']) if relations is None else list(relations)
+        missing = [name for name in names if name not in manifest['relations']]
+        if missing:
+            raise ValueError(f'Relations {missing} are not in snapshot {manifest["id"]}')
+        if create_missing:
+            existing = {row[0] for row in target._run_raw('::relations', immutable=True)['rows']}
+            for name in names:
+                if name not in existing:
+                    _create_relation(target, name, manifest['relations'][name]['columns'])
+
+        counts = {name: 0 for name in names}
+        counts_lock = threading.Lock()
+        jobs = [(name, chunk) for name in names for chunk in manifest['relations'][name]['chunks'] if chunk['file']]
+
+        def restore_one(job):
+            name, chunk = job
+            headers = [col[0] for col in manifest['relations'][name]['columns']]
+            with _open_text(os.path.join(self.path, chunk['file']), 'r', manifest['compression']) as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            target.import_relations({name: {'headers': headers, 'rows': rows}})
+            with counts_lock:
+                counts[name] += len(rows)
+                total = counts[name]
+            if progress is not None:
+                progress(name, total)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers or self.workers)) as pool:
+            for _ in pool.map(restore_one, jobs):
+                pass
+        return counts
+
+    def start(self, interval):
+        """Take a snapshot every `interval` seconds in the background, until `stop`.
+
+        Failed snapshots are logged and kept in `last_error`, and the schedule goes on.
+        """
+        if self._thread is not None:
+            raise RuntimeError('Backups are already scheduled')
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval):
+                try:
+                    self.snapshot()
+                    self.last_error = None
+                except Exception as e:
+                    logger.exception('Scheduled snapshot failed')
+                    self.last_error = e
+
+        self._thread = threading.Thread(target=loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop taking scheduled snapshots, waiting for one in progress to finish."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+class _Unchanged:
+    def __init__(self, client):
+        self._client = client
+
+    def __enter__(self):
+        return self._client, False
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        pass
+
+
+class _NativeCopy:
+    """A read-only view of an embedded database at one instant, from a native backup opened as a database"""
+
+    def __init__(self, client, staging_dir):
+        self._client = client
+        self._staging_dir = staging_dir
+        self._file = None
+        self._copy = None
+
+    def __enter__(self):
+        from pycozo.client import Client
+
+        os.makedirs(self._staging_dir, exist_ok=True)
+        self._file = os.path.join(self._staging_dir, f'native-{os.getpid()}-{threading.get_ident()}.db')
+        _remove(self._file)
+        self._client.backup(self._file)
+        self._copy = Client('sqlite', self._file, dataframe=False)
+        return self._copy, True
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._copy is not None:
+            self._copy.close()
+        _remove(self._file)
+
+
+def _stored_relations(client):
+    # index relations are named `<relation>:<index>` and are rebuilt from their relation
+    return [row[0] for row in client._run_raw('::relations', immutable=True)['rows'] if ':' not in row[0]]
+
+
+def _export_relation(source, relation, previous, directory, snapshot_id, compression, chunk_size):
+    """Write the chunks of a relation that differ from the previous snapshot.
+
+    :return: the manifest entry of the relation, and the counts of chunks written and reused.
+    """
+    columns = [list(col[:4]) for col in source._run_raw(f'::columns {relation}', immutable=True)['rows']]
+    headers = [col[0] for col in columns]
+    keys = [col[0] for col in columns if col[1]]
+    stats = {'chunks_written': 0, 'chunks_reused': 0, 'bytes_written': 0}
+    os.makedirs(os.path.join(directory, relation), exist_ok=True)
+    chunks = []
+
+    def add(first, rows, old=None):
+        text = ''.join(json.dumps(row) + '\n' for row in rows)
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if old is not None and old['digest'] == digest:
+            chunks.append(old)
+            stats['chunks_reused'] += 1
+            return
+        file = None
+        if rows:
+            file = f'{snapshot_id}/{relation}/{len(chunks)}{_NDJSON_SUFFIXES[compression]}'
+            with _open_text(os.path.join(directory, relation, os.path.basename(file)), 'w', compression) as f:
+                f.write(text)
+            stats['bytes_written'] += os.path.getsize(os.path.join(directory, relation, os.path.basename(file)))
+        chunks.append({'first': first, 'rows': len(rows), 'digest': digest, 'file': file})
+        stats['chunks_written'] += 1
+
+    if previous is None or previous['columns'] != columns:
+        from pycozo.transfer import iter_relation_chunks
+
+        for i, (_, rows) in enumerate(iter_relation_chunks(source, relation, chunk_size)):
+            add(None if i == 0 else rows[0][:len(keys)], rows)
+        if not chunks:
+            add(None, [])
+    else:
+        old_chunks = previous['chunks']
+        for i, old in enumerate(old_chunks):
+            upper = old_chunks[i + 1]['first'] if i + 1 < len(old_chunks) else None
+            rows = _range_rows(source, relation, headers, keys, old['first'], upper, chunk_size)
+            if len(rows) <= 2 * chunk_size:
+                add(old['first'], rows, old)
+            else:
+                # a range that grew is split, so that chunks stay about the same size
+                for offset in range(0, len(rows), chunk_size):
+                    part = rows[offset:offset + chunk_size]
+                    add(old['first'] if offset == 0 else part[0][:len(keys)], part)
+    return {'columns': columns, 'rows': sum(chunk['rows'] for chunk in chunks), 'chunks': chunks}, stats
+
+
+def _range_rows(source, relation, headers, keys, lower, upper, chunk_size):
+    """The rows of a relation with keys from `lower` (included) to `upper` (excluded), None for no bound"""
+    head = ', '.join(headers)
+    key_list = f'[{", ".join(keys)}]'
+    conditions = []
+    params = {}
+    # a condition on the first key alone lets the engine turn the scan into a range scan, but the engine
+    # drops the rows equal to an inclusive lower bound of such a scan, so that bound is on the key list only
+    if lower is not None:
+        conditions.append(f'{key_list} >= $lower')
+        params.update(lower=lower)
+    if upper is not None:
+        conditions.append(f'{keys[0]} <= $upper_first, {key_list} < $upper')
+        params.update(upper_first=upper[0], upper=upper)
+    base = f'?[{head}] := *{relation}{{{head}}}' + ''.join(', ' + c for c in conditions)
+    rows = []
+    script = f'{base} :limit {chunk_size}'
+    while True:
+        with source._admission(None, 'batch'):
+            page = source._run_raw(script, params, immutable=True)['rows']
+        rows.extend(page)
+        if len(page) < chunk_size:
+            return rows
+        params['last'] = page[-1][:len(keys)]
+        script = f'{base}, {key_list} > $last :limit {chunk_size}'
+
+
+def _create_relation(client, relation, columns):
+    keys = ', '.join(f'{col[0]}: {col[3]}' for col in columns if col[1])
+    values = ', '.join(f'{col[0]}: {col[3]}' for col in columns if not col[1])
+    client._run_raw(f':create {relation} {{{keys} => {values}}}')
+
+
+def _new_id(previous):
+    snapshot_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    if previous and snapshot_id <= previous[-1]['id']:
+        # clocks can go backwards, ids must not
+        snapshot_id = previous[-1]['id'] + '-1'
+    return snapshot_id
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -147,7 +147,8 @@ class StoredRuleApply:
     validity: Expr | None = None
 
     def __str__(self):
-        return f'*{self.name}[{", ".join(map(str, self.args))} {"| @" + str(self.validity) if self.validity else ""}]'
+        validity = f' @ {self.validity}' if self.validity is not None else ''
+        return f'*{self.name}[{", ".join(map(str, self.args))}{validity}]'
 
 
 @dataclass
@@ -160,10 +161,10 @@ class StoredRuleNamedApply:
         ret = '*' + self.name + '{'
         for k, v in self.args.items():
             ret += f'{k}: {v}, '
-        if self.validity:
-            ret += f'| @{self.validity}'
         if ret.endswith(', '):
             ret = ret[:-2]
+        if self.validity is not None:
+            ret += f' @ {self.validity}'
         ret += '}'
         return ret
 
@@ -196,6 +197,7 @@ class Conjunction:
                 ret += ', (' + str(part) + ')'
             else:
                 ret += '(' + str(part) + ')'
+        return ret
 
 
 @dataclass
@@ -209,6 +211,7 @@ class Disjunction:
                 ret += ' or (' + str(part) + ')'
             else:
                 ret += '(' + str(part) + ')'
+        return ret
 
 
 @dataclass
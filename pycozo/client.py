@@ -4,8 +4,13 @@
 #  If a copy of the MPL was not distributed with this file,
 #  You can obtain one at https://mozilla.org/MPL/2.0/.
 
+import base64
+import contextlib
 import json
 import logging
+import re
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +19,20 @@ class Client:
     """Python client for CozoDB
 
     This client can either operate on an embedded database, or a remote database via HTTP.
+
+    A client can be shared between threads. Calls into the embedded database release the GIL while the query
+    runs, so queries from different threads execute concurrently, subject to the locking done by the storage
+    engine: 'mem' and 'rocksdb' run concurrent readers in parallel, 'sqlite' serializes writers.
+    For remote databases, requests from all threads share the connection pool of one `requests.Session`.
+    Transactions from `multi_transact` are tracked until they are committed or aborted, and those still open
+    are aborted by `close`. To bound the number of concurrent readers or to serialize writers,
+    see `pycozo.pool.ClientPool`. To admit queries by priority class, see `pycozo.scheduler.Scheduler`.
+    To bound the size of results and account for the memory they take, see `pycozo.limits`. To keep track of
+    query plans, see `explain` and `pycozo.plans.PlanRecorder`.
     """
 
-    def __init__(self, engine='mem', path='', options=None, *, dataframe=True):
+    def __init__(self, engine='mem', path='', options=None, *, dataframe=True, single_flight=False, scheduler=None,
+                 max_rows=None, max_bytes=None, on_result=None, plan_recorder=None):
         """Constructor for the client. The behaviour depends on the argument.
 
         If the database `db` is an embedded one, and you do not intend it to live as long as your program, you **must**
@@ -32,22 +48,71 @@ class Client:
         :param options: options for the database, the expected values depend on the engine of the database.
                         Currently only the 'http' engine expect options of the form:
                         `{'host': <HOST:PORT>, 'auth': <AUTH_STR>}`.
+                        The 'http' engine also accepts the optional keys `'encoding'` and `'compression'`.
+                        `'encoding'` can be 'msgpack' or 'cbor' (the `msgpack` or `cbor2` package must be installed):
+                        responses are requested in that encoding, and once the server has answered in it,
+                        requests are sent in it too. Servers that only speak JSON keep working with JSON.
+                        `'compression'` can be 'gzip' or 'zstd' (requires `zstandard`): request bodies
+                        larger than a few kilobytes are compressed once the server has listed the compression
+                        in the `Accept-Encoding` header of a response (RFC 7694). Until then, and for servers
+                        that never do, requests are sent uncompressed.
         :param dataframe: if true, output will be transformed into pandas dataframes. The `pandas` package
                           must be installed.
+        :param single_flight: if true, concurrent `run` calls with `immutable=True` and the same script and
+                              parameters share a single execution, and all get its result. Nothing is kept once
+                              the execution finishes. Calls with parameters other than None, bools, numbers,
+                              strings, bytes, and lists and dicts of those run on their own.
+                              See `single_flight_stats`.
+        :param scheduler: a `pycozo.scheduler.Scheduler`, possibly shared with other clients, which admits
+                          queries, imports and exports by priority class. See `priority` and `scheduler_stats`.
+        :param max_rows: the default of the `max_rows` argument of `run`.
+        :param max_bytes: the default of the `max_bytes` argument of `run`.
+        :param on_result: if given, called after each `run` with a dict accounting for the size of its result,
+                          see `pycozo.limits`. Exceptions raised by the hook are logged.
+        :param plan_recorder: a `pycozo.plans.PlanRecorder`, possibly shared with other clients, which records the
+                              plans of the slow or sampled queries run with `run`, in the background, and reports
+                              those that changed.
         """
         self.pandas = None
         self.session = None
         self.embedded = None
+        self._lock = threading.Lock()
+        self._transactions = set()
+        self._executor = None
+        # queries running on the embedded database: a token for each, to the thread running it
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._query_token = threading.local()
+        self._single_flight = _SingleFlight() if single_flight else None
+        self._scheduler = scheduler
+        self._priority = threading.local()
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.on_result = on_result
+        self.plan_recorder = plan_recorder
         if engine == 'http':
             import requests
             self.host = options['host']
             self.auth = options.get('auth')
             self.session = requests.Session()
+            self.encoding = options.get('encoding', 'json')
+            self.compression = options.get('compression')
+            if self.encoding not in _WIRE_ENCODINGS:
+                raise ValueError(f'Unknown encoding {self.encoding!r}')
+            self._binary_accepted = False
+            self._compression_accepted = False
             self._remote_sse = {}
             self._remote_cb_id = 0
         else:
             from cozo_embedded import CozoDbPy
             self.embedded = CozoDbPy(engine, path, json.dumps(options or {}))
+            # the embedded engine serves one callback at a time: changes for later callbacks are held back until
+            # the earlier ones are unregistered. A single native callback per relation fans out to all registered
+            # callbacks of that relation, which takes care of several subscribers to the same relation.
+            # Open transactions also wait for all callbacks to be unregistered, see `multi_transact`.
+            self._relation_callbacks = {}
+            self._callback_relations = {}
+            self._next_callback_id = 0
 
         if dataframe:
             try:
@@ -63,7 +128,21 @@ class Client:
         For embedded databases, this method must be called, otherwise the native resources associated with it
         may live as long as your program.
         """
+        for tx in self.outstanding_transactions():
+            logger.warning('Aborting a transaction that was still open when the client was closed')
+            try:
+                tx.abort()
+            except Exception:
+                logger.exception("Exception while aborting transaction:")
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
         if self.embedded:
+            # closing the database ends its change callbacks
+            with self._lock:
+                for relation in self._relation_callbacks:
+                    _count_native_callbacks(relation, -1)
+                self._relation_callbacks.clear()
+                self._callback_relations.clear()
             try:
                 self.embedded.close()
             except Exception:
@@ -79,68 +158,455 @@ class Client:
             'x-cozo-auth': self.auth
         }
 
-    def _client_request(self, script, params=None, immutable=False):
-        r = self.session.post(f'{self.host}/text-query', headers=self._headers(), json={
+    def _http(self, method, path, body=None, timeout=None):
+        return self._decode_response(self._http_request(method, path, body, timeout))
+
+    def _http_request(self, method, path, body=None, timeout=None, stream=False):
+        """Send a request and return the `requests` response. Streamed responses are always asked for in JSON."""
+        headers = self._headers()
+        if stream:
+            headers['Accept'] = 'application/json'
+        else:
+            headers['Accept'] = _WIRE_ENCODINGS[self.encoding][0] + ', application/json;q=0.5'
+        data = None
+        if body is not None:
+            encoding = self.encoding if self._binary_accepted else 'json'
+            content_type, encode, _ = _WIRE_ENCODINGS[encoding]
+            data = encode(body)
+            headers['Content-Type'] = content_type
+            if self._compression_accepted and len(data) >= _COMPRESS_MIN_BYTES:
+                data = _compress(data, self.compression)
+                headers['Content-Encoding'] = self.compression
+        if timeout is not None:
+            # leave the server the time to report its own timeout before giving up on the connection
+            timeout += _HTTP_TIMEOUT_GRACE
+        r = self.session.request(method, f'{self.host}{path}', headers=headers, data=data, timeout=timeout,
+                                 stream=stream)
+        if self.compression and not self._compression_accepted:
+            self._compression_accepted = self.compression in _accepted_codings(r.headers.get('Accept-Encoding'))
+        return r
+
+    def _decode_response(self, r):
+        content_type = r.headers.get('Content-Type', '').split(';')[0].strip()
+        for encoding, (binary_type, _, decode) in _WIRE_ENCODINGS.items():
+            if encoding != 'json' and content_type == binary_type:
+                self._binary_accepted = True
+                return decode(r.content)
+        return r.json()
+
+    def _client_request(self, script, params=None, immutable=False, timeout=None):
+        return self._check_return(self._http('POST', '/text-query', {
             'script': script,
             'params': params or {},
             'immutable': immutable
-        })
-        res = r.json()
-        return self._format_return(res)
+        }, timeout))
 
     def _client_tx_begin(self, write: bool) -> int:
-        r = self.session.post(f'{self.host}/transact?write={str(write).lower()}', headers=self._headers())
-        res = r.json()
+        res = self._http('POST', f'/transact?write={str(write).lower()}')
         if not res['ok']:
             raise RuntimeError(res['message'])
         tx_id = res['id']
         return tx_id
 
     def _client_tx_request(self, tx_id: int, script, params=None):
-        r = self.session.post(f'{self.host}/transact/{tx_id}', headers=self._headers(), json={
+        return self._to_output(self._client_tx_request_raw(tx_id, script, params))
+
+    def _client_tx_request_raw(self, tx_id: int, script, params=None):
+        return self._check_return(self._http('POST', f'/transact/{tx_id}', {
             'script': script,
             'params': params or {},
-        })
-        res = r.json()
-        return self._format_return(res)
+        }))
 
     def _client_tx_finish(self, tx_id: int, abort: bool):
-        r = self.session.put(f'{self.host}/transact/{tx_id}', headers=self._headers(), json={
+        res = self._http('PUT', f'/transact/{tx_id}', {
             'abort': abort,
         })
-        res = r.json()
         return self._format_return(res)
 
-    def _format_return(self, res):
+    def _check_return(self, res):
         if res.get('ok') is False or ('ok' not in res and 'rows' not in res):
             raise QueryException(res)
+        return res
 
+    def _format_return(self, res):
+        return self._to_output(self._check_return(res))
+
+    def _to_output(self, res, dtypes=None, format=None):
+        if format == 'arrow':
+            from pycozo.arrow import to_table
+
+            return to_table(res['headers'], res['rows'], dtypes)
+        elif format is not None:
+            raise ValueError(f'Unknown output format {format!r}')
         if self.pandas:
+            if dtypes:
+                return _typed_frame(self.pandas, res['headers'], res['rows'], dtypes)
             return self.pandas.DataFrame(columns=res['headers'], data=res['rows'])
         else:
             return res
 
     def _embedded_request(self, script, params=None, immutable=False):
+        token = getattr(self._query_token, 'value', None) or object()
+        self._query_token.value = None
+        with self._in_flight_lock:
+            self._in_flight[token] = threading.get_ident()
         try:
-            res = self.embedded.run_script(script, params or {}, immutable)
+            return self.embedded.run_script(script, params or {}, immutable)
         except Exception as e:
             raise QueryException(e.args[0]) from None
-        if self.pandas:
-            return self.pandas.DataFrame(columns=res['headers'], data=res['rows'])
+        finally:
+            with self._in_flight_lock:
+                del self._in_flight[token]
+
+    def _run_raw(self, script, params=None, immutable=False, timeout=None):
+        if self.embedded is None:
+            return self._client_request(script, params, immutable, timeout)
         else:
-            return res
+            return self._embedded_request(script, params, immutable)
+
+    def _invalidate_for(self, script):
+        """Called after a script that may have written ran without `_run_raw`, for subclasses caching results"""
 
-    def run(self, script, params=None, immutable=False):
+    def _execute(self, script, params=None, immutable=False, timeout=None):
+        if timeout is None:
+            return self._run_raw(script, params, immutable)
+        limited = _with_timeout(script, timeout)
+        if limited is None:
+            return self._run_killed_after(timeout, script, params, immutable)
+        return self._run_raw(limited, params, immutable, timeout)
+
+    def run(self, script, params=None, immutable=False, dtypes=None, format=None, timeout=None,
+            spill_threshold_bytes=None, spill_dir=None, priority=None, queue_timeout=None, max_rows=None,
+            max_bytes=None):
         """Run a given CozoScript query.
 
         :param script: the query in CozoScript
         :param params: the named parameters for the query. If specified, must be a dict with string keys.
+        :param dtypes: only used for dataframe output. A dict from column names to either Cozo column types
+                       (e.g. 'Int', 'Float?', 'String') or pandas dtypes. Columns with Cozo types are built directly
+                       into int64/float64/bool columns, nullable extension types for types ending with `?`,
+                       and categoricals for low-cardinality strings. Other columns are inferred by pandas.
+                       For Arrow output, Cozo types or `pyarrow` types fix the type of the Arrow columns.
+        :param format: if 'arrow', the result is returned as a `pyarrow.Table` built column by column, regardless
+                       of the `dataframe` option. The `pyarrow` package must be installed.
+        :param timeout: seconds after which the query is killed by the database, raising a `QueryException`.
+                        This is done with the `:timeout` query option when the script allows it. Otherwise
+                        (chained, imperative or system scripts), queries of embedded databases are killed
+                        through `::kill` if no other query of the client is running, and those of remote
+                        databases are abandoned with a `TimeoutError`, but keep running on the server.
+        :param spill_threshold_bytes: if given, the result is returned as a `pycozo.spill.SpilledResult`,
+                       regardless of the `dataframe` option. Once the rows received take more than this many bytes
+                       of memory, they are written to a temporary Arrow IPC file, which the result memory-maps.
+                       From remote databases, rows are then streamed from the response into the file.
+                       The `pyarrow` package must be installed.
+        :param spill_dir: the directory of the temporary file, by default that of the `tempfile` module.
+        :param priority: with a scheduler, the priority class of the query, by default the one set by `priority`
+                         or 'normal'.
+        :param queue_timeout: with a scheduler, seconds to wait for admission before raising `TimeoutError`,
+                              the default of the priority class if None.
+        :param max_rows: if the result has more rows, raise `pycozo.limits.ResultTooLarge` instead of returning
+                         it. The client default if None. See `pycozo.limits` for how the query is cut short.
+        :param max_bytes: if the rows of the result take more bytes of memory, raise
+                          `pycozo.limits.ResultTooLarge`. The client default if None. Not applied to spilled results.
         :return: the query result as a dict, or a pandas dataframe if the `dataframe` option was true.
         """
+        max_rows = self.max_rows if max_rows is None else max_rows
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if spill_threshold_bytes is not None:
+            if format is not None:
+                raise ValueError('`format` cannot be combined with `spill_threshold_bytes`')
+            from pycozo.limits import check_rows, with_row_limit
+            from pycozo.spill import run_spilled
+
+            # rows are consumed as they arrive, so spilled queries do not go through single-flight
+            with self._admission(priority, 'normal', queue_timeout):
+                res = run_spilled(self, with_row_limit(script, max_rows), params, immutable, timeout,
+                                  spill_threshold_bytes, dtypes, spill_dir)
+            try:
+                check_rows(len(res), max_rows)
+            except BaseException:
+                res.close()
+                raise
+            return res
+        if max_rows is None and max_bytes is None and self.on_result is None and self.plan_recorder is None:
+            res = self._run_shared(script, params, immutable, timeout, priority, queue_timeout, None, None)
+            return self._to_output(res, dtypes, format)
+        return self._run_accounted(script, params, immutable, dtypes, format, timeout, priority, queue_timeout,
+                                   max_rows, max_bytes)
+
+    def _run_shared(self, script, params, immutable, timeout, priority, queue_timeout, max_rows, max_bytes):
+        def execute():
+            with self._admission(priority, 'normal', queue_timeout):
+                if max_rows is None and max_bytes is None:
+                    return self._execute(script, params, immutable, timeout)
+                from pycozo.limits import run_limited
+
+                return run_limited(self, script, params, immutable, timeout, max_rows, max_bytes)
+
+        key = _flight_key(script, params, timeout) if self._single_flight is not None and immutable else None
+        if key is not None:
+            return self._single_flight.do(key + (max_rows, max_bytes), execute)
+        return execute()
+
+    def _run_accounted(self, script, params, immutable, dtypes, format, timeout, priority, queue_timeout, max_rows,
+                       max_bytes):
+        from pycozo.limits import ResultTooLarge, accounting, caller
+
+        on_result = self.on_result
+        where = caller() if on_result is not None else None
+        start = time.perf_counter()
+        try:
+            res = self._run_shared(script, params, immutable, timeout, priority, queue_timeout, max_rows, max_bytes)
+            output = self._to_output(res, dtypes, format)
+        except ResultTooLarge as e:
+            if on_result is not None:
+                self._account(on_result, accounting(script, None, None, time.perf_counter() - start, where, e))
+            raise
+        seconds = time.perf_counter() - start
+        if on_result is not None:
+            self._account(on_result, accounting(script, res, output, seconds, where))
+        if self.plan_recorder is not None:
+            self.plan_recorder.observe(self, script, params, seconds)
+        return output
+
+    def _run_checked(self, script, params=None, immutable=True, timeout=None, priority=None, max_rows=None,
+                     max_bytes=None):
+        """Run a query made on behalf of the caller by `get_many`, `search_many` or `AsOf.run` like `run` does:
+        admitted as 'normal', limited by `max_rows` and `max_bytes` or the client defaults, and accounted for.
+        Returns the result as a dict."""
+        from pycozo.limits import ResultTooLarge, accounting, caller, run_limited
+
+        max_rows = self.max_rows if max_rows is None else max_rows
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        on_result = self.on_result
+        where = caller() if on_result is not None else None
+        start = time.perf_counter()
+        try:
+            with self._admission(priority, 'normal'):
+                if max_rows is None and max_bytes is None:
+                    res = self._execute(script, params, immutable, timeout)
+                else:
+                    res = run_limited(self, script, params, immutable, timeout, max_rows, max_bytes)
+        except ResultTooLarge as e:
+            if on_result is not None:
+                self._account(on_result, accounting(script, None, None, time.perf_counter() - start, where, e))
+            raise
+        seconds = time.perf_counter() - start
+        if on_result is not None:
+            self._account(on_result, accounting(script, res, None, seconds, where))
+        if self.plan_recorder is not None:
+            self.plan_recorder.observe(self, script, params, seconds)
+        return res
+
+    @staticmethod
+    def _account(on_result, stats):
+        try:
+            on_result(stats)
+        except Exception:
+            logger.exception('Result accounting hook failed')
+
+    def run_batch(self, queries, dtypes=None, format=None, consistent=True, priority=None, queue_timeout=None,
+                  max_rows=None, max_bytes=None):
+        """Run several read-only queries together, and return their results in order.
+
+        Each query keeps its own parameters, so parameters of the same name in different queries do not clash.
+        Each query is accounted for by the `on_result` hook and observed by the plan recorder, as for `run`.
+
+        :param queries: a list of scripts, or of (script, params) pairs.
+        :param dtypes: as for `run`, applied to all the results.
+        :param format: as for `run`.
+        :param consistent: if true, the queries run in one read transaction from `multi_transact`, and so see the
+                           same state of the database on engines where transactions are snapshots. For embedded
+                           databases, transactions cannot start while change callbacks are registered in the
+                           process (see `multi_transact`): the queries then run one after the other without a
+                           transaction, and a warning is logged. For remote databases, the queries are sent one
+                           after the other within the transaction. If false, the queries run on their own, and
+                           those for remote databases are sent concurrently, so that the batch takes about one
+                           round trip.
+        :param priority, queue_timeout: as for `run`, the batch is admitted once as a whole.
+        :param max_rows, max_bytes: as for `run`, applied to each result once received.
+        :return: the list of the results, as for `run`.
+        """
+        queries = [(query, None) if isinstance(query, str) else tuple(query) for query in queries]
+        max_rows = self.max_rows if max_rows is None else max_rows
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        sent = queries
+        if max_rows is not None or max_bytes is not None:
+            from pycozo.limits import with_row_limit
+
+            sent = [(with_row_limit(script, max_rows), params) for script, params in queries]
+        with self._admission(priority, 'normal', queue_timeout):
+            if consistent and self.embedded and _callbacks_registered():
+                logger.warning('Running a batch of queries without a transaction, so they may see different '
+                               'states of the database: change callbacks are registered in the process')
+                consistent = False
+            if consistent:
+                timed = self._run_in_transaction(sent)
+            elif self.embedded is None and len(sent) > 1:
+                pool = self._pool()
+                futures = [pool.submit(_timed, self._run_raw, script, params, True) for script, params in sent]
+                timed = [future.result() for future in futures]
+            else:
+                timed = [_timed(self._run_raw, script, params, True) for script, params in sent]
+        return self._batch_outputs(queries, timed, dtypes, format, max_rows, max_bytes)
+
+    def _run_in_transaction(self, queries):
+        timed = []
+        with self.multi_transact(write=False) as tx:
+            for script, params in queries:
+                timed.append(_timed(tx._run_raw, script, params))
+            tx.commit()
+        return timed
+
+    def _batch_outputs(self, queries, timed, dtypes, format, max_rows, max_bytes):
+        from pycozo.limits import ResultTooLarge, accounting, caller, check_result
+
+        on_result = self.on_result
+        where = caller() if on_result is not None else None
+        outputs = []
+        for (script, params), (res, seconds) in zip(queries, timed):
+            try:
+                check_result(res, max_rows, max_bytes)
+            except ResultTooLarge as e:
+                if on_result is not None:
+                    self._account(on_result, accounting(script, None, None, seconds, where, e))
+                raise
+            output = self._to_output(res, dtypes, format)
+            if on_result is not None:
+                self._account(on_result, accounting(script, res, output, seconds, where))
+            if self.plan_recorder is not None:
+                self.plan_recorder.observe(self, script, params, seconds)
+            outputs.append(output)
+        return outputs
+
+    def explain(self, script, params=None):
+        """The plan of a query, from `::explain`, without running it.
+
+        :param script: a query, which cannot be a chained, imperative or system script.
+        :param params: the parameters of the query, which must be given for the query to be planned.
+        :return: one row per operation of the plan, as a dict or a pandas dataframe. See `pycozo.plans`.
+        """
+        from pycozo.plans import explain_script
+
+        return self._to_output(self._run_raw(explain_script(script), params, immutable=True))
+
+    @contextlib.contextmanager
+    def priority(self, priority):
+        """Context manager setting the priority class of the calls made by this thread, see `scheduler`.
+
+        It applies to `run`, `submit`, `import_relations` and `export_relations` (and the methods built on them)
+        called without an explicit priority. Otherwise, queries are 'normal' and imports and exports 'batch'.
+        """
+        previous = getattr(self._priority, 'value', None)
+        self._priority.value = priority
+        try:
+            yield
+        finally:
+            self._priority.value = previous
+
+    def _admission(self, priority, default, queue_timeout=None):
+        if self._scheduler is None:
+            return contextlib.nullcontext()
+        priority = priority or getattr(self._priority, 'value', None) or default
+        return self._scheduler.slot(priority, queue_timeout)
+
+    def scheduler_stats(self):
+        """Queue depths, running calls and admission wait times per priority class, see
+        `pycozo.scheduler.Scheduler.stats`. None without a scheduler."""
+        if self._scheduler is None:
+            return None
+        return self._scheduler.stats()
+
+    def single_flight_stats(self):
+        """Counters of the single-flight layer: `executed` queries, and `coalesced` calls that shared
+        the execution of another one. None if the layer is not enabled."""
+        if self._single_flight is None:
+            return None
+        return self._single_flight.stats()
+
+    def submit(self, script, params=None, immutable=False, **kwargs):
+        """Start a query in the background.
+
+        :param kwargs: other arguments for `run`.
+        :return: a `QueryHandle`, whose `result()` waits for the query and whose `cancel()` stops it,
+                 see `QueryHandle.cancel`.
+        """
+        # the query runs on another thread, which does not see the priority set for this one
+        kwargs.setdefault('priority', getattr(self._priority, 'value', None))
+        return self._submit_call(lambda: self.run(script, params, immutable, **kwargs))
+
+    def _submit_call(self, fn):
+        handle = QueryHandle(self)
+        handle._future = self._pool().submit(self._run_handle, handle, fn)
+        return handle
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self._executor = ThreadPoolExecutor(thread_name_prefix='cozo-query')
+            return self._executor
+
+    def _run_handle(self, handle, fn):
+        handle._thread = threading.get_ident()
+        handle._started_at = time.monotonic()
+        try:
+            return fn()
+        finally:
+            with self._in_flight_lock:
+                handle._thread = None
+            handle._finished_at = time.monotonic()
+
+    def _run_killed_after(self, timeout, script, params, immutable):
+        """Run a query that cannot take a `:timeout` on the calling thread, killing it after `timeout` seconds.
+
+        Remote databases cannot tell the queries of this client from those of others, so their queries are
+        only abandoned, and keep running on the server.
+        """
         if self.embedded is None:
-            return self._client_request(script, params, immutable)
-        else:
-            return self._embedded_request(script, params, immutable)
+            import requests
+
+            try:
+                return self._run_raw(script, params, immutable, timeout)
+            except requests.exceptions.Timeout:
+                raise TimeoutError(f'Query did not finish within {timeout} seconds') from None
+        token = object()
+        timer = threading.Timer(timeout, self._kill, (lambda t, _: t is token,))
+        timer.daemon = True
+        timer.start()
+        self._query_token.value = token
+        try:
+            # a killed query fails with a `QueryException`, which is raised here
+            return self._run_raw(script, params, immutable)
+        finally:
+            self._query_token.value = None
+            timer.cancel()
+
+    def _kill(self, match):
+        """Kill the running query of this client for which `match(token, thread)` is true.
+
+        The database identifies running queries only by ids, which cannot be traced back to the calls that
+        started them. Queries are therefore only killed when they are the only query of this client running
+        on its embedded database, which no other client uses. Remote databases are shared with other
+        clients, so their queries are never killed.
+
+        :return: whether a kill was requested.
+        """
+        if self.embedded is None:
+            return False
+        with self._in_flight_lock:
+            if not any(match(token, thread) for token, thread in self._in_flight.items()):
+                return False
+            if len(self._in_flight) > 1:
+                logger.warning('Cannot kill the query: other queries of the client are running, and the database '
+                               'does not tell them apart')
+                return False
+            # while holding the lock, so that no other query starts in the meantime
+            ids = [row[0] for row in self.embedded.run_script('::running', {}, True)['rows']]
+            for query_id in ids:
+                self.embedded.run_script(f'::kill {query_id}', {}, True)
+        return bool(ids)
 
     def export_relations(self, relations):
         """Export the specified relations.
@@ -148,20 +614,19 @@ class Client:
         :param relations: names of the relations in a list.
         :return: a dict with string keys for the names of relations, and values containing all the rows.
         """
-        if self.embedded:
-            return self.embedded.export_relations(relations)
-        else:
-            import urllib.parse
+        with self._admission(None, 'batch'):
+            if self.embedded:
+                return self.embedded.export_relations(relations)
+            else:
+                import urllib.parse
 
-            rels = ','.join(map(lambda s: urllib.parse.quote_plus(s), relations))
-            url = f'{self.host}/export/{rels}'
+                rels = ','.join(map(lambda s: urllib.parse.quote_plus(s), relations))
 
-            r = self.session.get(url, headers=self._headers())
-            res = r.json()
-            if res['ok']:
-                return res['data']
-            else:
-                raise RuntimeError(res['message'])
+                res = self._http('GET', f'/export/{rels}')
+                if res['ok']:
+                    return res['data']
+                else:
+                    raise RuntimeError(res['message'])
 
     def import_relations(self, data):
         """Import data into a database
@@ -172,13 +637,78 @@ class Client:
         :param data: should be given as a dict with string keys, in the same format as returned by `export_relations`.
                      The relations to import into must exist.
         """
-        if self.embedded:
-            self.embedded.import_relations(data)
-        else:
-            r = self.session.put(f'{self.host}/import', headers=self._headers(), json=data)
-            res = r.json()
-            if not res['ok']:
-                raise RuntimeError(res['message'])
+        with self._admission(None, 'batch'):
+            if self.embedded:
+                self.embedded.import_relations(data)
+            else:
+                res = self._http('PUT', '/import', data)
+                if not res['ok']:
+                    raise RuntimeError(res['message'])
+
+    def export_to_file(self, relations, path, format='ndjson', compression=None, chunk_size=10000, workers=4,
+                       progress=None):
+        """Export the specified relations into files, without holding whole relations in memory.
+
+        Each relation is paged through in key order and written chunk by chunk into its own file
+        in the directory `path`. Relations are exported in parallel. See `pycozo.transfer` for the formats.
+
+        :param relations: names of the relations in a list.
+        :param path: the local directory to write into. It is created if it does not exist.
+        :param format: 'ndjson', 'parquet' or 'arrow'. The latter two require the `pyarrow` package.
+        :param compression: the compression of the files, the accepted values depend on the format.
+        :param chunk_size: the number of rows fetched and written at once.
+        :param workers: the number of relations exported concurrently.
+        :param progress: if given, called as `progress(relation, rows_written)` after each chunk.
+        :return: a dict with the names of relations as keys, and the number of rows written as values.
+        """
+        from pycozo.transfer import export_to_file
+
+        return export_to_file(self, relations, path, format, compression, chunk_size, workers, progress)
+
+    def import_from_file(self, path, chunk_size=10000, relations=None, workers=4, progress=None):
+        """Import data from files written by `export_to_file`, one chunk at a time.
+
+        As with `import_relations`, triggers are _not_ run and the relations to import into must exist.
+
+        :param path: a single exported file, or a directory of them.
+        :param chunk_size: the number of rows read and imported at once.
+        :param relations: if given, only the files of these relations are imported.
+        :param workers: the number of relations imported concurrently.
+        :param progress: if given, called as `progress(relation, rows_imported)` after each chunk.
+        :return: a dict with the names of relations as keys, and the number of rows imported as values.
+        """
+        from pycozo.transfer import import_from_file
+
+        return import_from_file(self, path, chunk_size, relations, workers, progress)
+
+    def run_to_parquet(self, script, path, params=None, immutable=True, dtypes=None, compression='snappy'):
+        """Run a query and write its result into a Parquet file. The `pyarrow` package must be installed.
+
+        :param dtypes: as for `run`, fixes the types of the Parquet columns.
+        :return: the number of rows written.
+        """
+        from pycozo.arrow import write_parquet
+
+        table = self.run(script, params, immutable, dtypes, format='arrow')
+        write_parquet(table, path, compression)
+        return table.num_rows
+
+    def put_parquet(self, relation, path, batch_size=10000, op='put'):
+        """Load a Parquet file into a stored relation, one batch at a time. The `pyarrow` package must be installed.
+
+        The columns of the file must be named after the columns of the relation. Unlike `import_from_file`,
+        this goes through a normal query, so triggers are run.
+
+        :param op: the mutation to use, one of 'put', 'insert', 'update' or 'rm'.
+        :return: the number of rows loaded.
+        """
+        from pycozo.arrow import iter_parquet_batches
+
+        total = 0
+        for batch in iter_parquet_batches(path, batch_size):
+            self._mutate(relation, batch, op)
+            total += batch.num_rows
+        return total
 
     def backup(self, path):
         """Backup a database to the specified path.
@@ -188,23 +718,35 @@ class Client:
         if self.embedded:
             self.embedded.backup(path)
         else:
-            r = self.session.post(f'{self.host}/backup', headers=self._headers(), json={'path': path})
-            res = r.json()
+            res = self._http('POST', '/backup', {'path': path})
             if not res['ok']:
                 raise RuntimeError(res['message'])
 
     def register_callback(self, relation, callback):
         if self.embedded:
-            return self.embedded.register_callback(relation, callback)
+            with self._lock:
+                cb_id = self._next_callback_id
+                self._next_callback_id += 1
+                if relation not in self._relation_callbacks:
+                    if self._relation_callbacks:
+                        logger.warning(f'Changes to {relation} will only be delivered once the callbacks on '
+                                       f'{", ".join(self._relation_callbacks)} are unregistered: the embedded '
+                                       f'engine serves the callbacks of one relation at a time')
+                    listeners = {}
+                    native_id = self.embedded.register_callback(relation, lambda *args: _fan_out(listeners, args))
+                    _count_native_callbacks(relation, 1)
+                    self._relation_callbacks[relation] = (native_id, listeners)
+                self._relation_callbacks[relation][1][cb_id] = callback
+                self._callback_relations[cb_id] = relation
+            return cb_id
         else:
-            import threading
-
-            tid = self._remote_cb_id
-            self._remote_cb_id += 1
+            with self._lock:
+                tid = self._remote_cb_id
+                self._remote_cb_id += 1
             url = f'{self.host}/changes/{relation}'
             thread = threading.Thread(target=self._start_sse, args=(tid, url, callback), daemon=True)
-            thread.start()
             self._remote_sse[tid] = {'thread': thread}
+            thread.start()
 
             return tid
 
@@ -247,9 +789,18 @@ class Client:
 
     def unregister_callback(self, cb_id):
         if self.embedded:
-            self.embedded.unregister_callback(cb_id)
+            with self._lock:
+                relation = self._callback_relations.pop(cb_id, None)
+                if relation is None:
+                    return
+                native_id, listeners = self._relation_callbacks[relation]
+                listeners.pop(cb_id, None)
+                if not listeners:
+                    del self._relation_callbacks[relation]
+                    self.embedded.unregister_callback(native_id)
+                    _count_native_callbacks(relation, -1)
         else:
-            del self._remote_sse[cb_id]
+            self._remote_sse.pop(cb_id, None)
 
     def register_fixed_rule(self, name, arity, impl):
         if self.embedded:
@@ -287,17 +838,43 @@ class Client:
         if self.embedded:
             self.embedded.import_from_backup(path, relations)
         else:
-            r = self.session.post(f'{self.host}/import-from-backup', headers=self._headers(),
-                                  json={'path': path, 'relations': relations})
-            res = r.json()
+            res = self._http('POST', '/import-from-backup', {'path': path, 'relations': relations})
             if not res['ok']:
                 raise RuntimeError(res['message'])
 
     def multi_transact(self, write=False):
+        """Start a transaction spanning multiple queries. It must be finished with `commit` or `abort`,
+        or used as a context manager, which aborts it if it was not committed.
+
+        For embedded databases, transactions cannot be started while change callbacks are registered
+        by any client of the process, even on another database: the engine runs all of them on one worker.
+
+        :param write: whether the transaction may write.
+        """
         if self.embedded:
-            return MultiTransact(self.embedded.multi_transact(write))
+            with _native_callbacks_lock:
+                if _native_callbacks:
+                    # the transaction would wait behind the callbacks forever
+                    relations = ', '.join(sorted(_native_callbacks))
+                    raise RuntimeError(f'Transactions of embedded databases cannot start while change callbacks '
+                                       f'are registered in the process (on {relations}): the engine runs both '
+                                       f'on one worker')
+            tx = MultiTransact(self.embedded.multi_transact(write), on_finish=self._transaction_finished)
         else:
-            return RemoteMultiTransact(self._client_tx_begin(write), self._client_tx_request, self._client_tx_finish)
+            tx = RemoteMultiTransact(self._client_tx_begin(write), self._client_tx_request, self._client_tx_finish,
+                                     on_finish=self._transaction_finished, tx_request_raw=self._client_tx_request_raw)
+        with self._lock:
+            self._transactions.add(tx)
+        return tx
+
+    def _transaction_finished(self, tx):
+        with self._lock:
+            self._transactions.discard(tx)
+
+    def outstanding_transactions(self):
+        """The transactions started by `multi_transact` that are neither committed nor aborted yet."""
+        with self._lock:
+            return list(self._transactions)
 
     def _process_mutate_data_dict(self, data):
         cols = []
@@ -320,6 +897,11 @@ class Client:
                     nxt_row.append(el[col])
                 rows.append(nxt_row)
             return ','.join(cols), rows
+        elif _is_arrow(data):
+            from pycozo.arrow import to_rows
+
+            cols, rows = to_rows(data)
+            return ','.join(cols), rows
         else:
             import pandas as pd
             if isinstance(data, pd.DataFrame):
@@ -346,36 +928,448 @@ class Client:
     def rm(self, relation, data):
         return self._mutate(relation, data, 'rm')
 
+    def put_vectors(self, relation, ids, matrix, id_column='id', vector_column='vec', vector_type='F32',
+                    batch_size=10000, op='put'):
+        """Store the rows of a 2-D NumPy array as vectors. The `numpy` package must be installed.
+
+        Each vector is sent as the base64 encoding of its raw bytes and decoded by the database with `vec`,
+        which is much more compact than nested lists of Python floats.
+
+        :param relation: the stored relation, with key `id_column` and a vector column `vector_column`.
+                         Any other column must have a default.
+        :param ids: the keys of the vectors, one per row of `matrix`.
+        :param matrix: the vectors, one per row.
+        :param vector_type: 'F32' or 'F64', must match the type of the vector column.
+        :param batch_size: the number of vectors sent per query.
+        :param op: the mutation to use, 'put' or 'insert'.
+        :return: the number of vectors stored.
+        """
+        import numpy as np
+
+        matrix = np.ascontiguousarray(matrix, dtype=_VECTOR_DTYPES[vector_type])
+        if matrix.ndim != 2:
+            raise ValueError('`matrix` must be 2-dimensional')
+        ids = ids.tolist() if hasattr(ids, 'tolist') else list(ids)
+        if len(ids) != len(matrix):
+            raise ValueError('`ids` and `matrix` must have the same number of rows')
+        script = f'data[id, encoded] <- $data\n' \
+                 f'?[{id_column}, {vector_column}] := data[{id_column}, encoded], ' \
+                 f'{vector_column} = vec(encoded, "{vector_type}")\n' \
+                 f':{op} {relation} {{ {id_column} => {vector_column} }}'
+        for start in range(0, len(ids), batch_size):
+            data = [[ids[i], _encode_vector(matrix[i])] for i in range(start, min(start + batch_size, len(ids)))]
+            # through `run`, like the other mutations, for admission, accounting and cache invalidation
+            self.run(script, {'data': data})
+        return len(ids)
+
+    def search_many(self, relation_index, query_matrix, k=10, ef=50, vector_type='F32', id_column='id',
+                    extra_params=None):
+        """Run a batch of HNSW nearest-neighbour searches in a single query. The `numpy` package must be installed.
+
+        :param relation_index: the index to search, in the form `<relation>:<index>`.
+        :param query_matrix: the query vectors, one per row.
+        :param k: the number of neighbours to return per query.
+        :param ef: the size of the candidate list used during the search.
+        :param vector_type: 'F32' or 'F64', must match the type of the index.
+        :param id_column: the key column of the relation to return.
+        :param extra_params: other search parameters such as `radius` or `filter`, as CozoScript strings.
+        :return: a pair `(ids, distances)` of arrays of shape `(len(query_matrix), k)`, each row sorted by distance.
+                 If some query found fewer than `k` neighbours, `ids` has dtype object and is padded with None,
+                 and `distances` is padded with `inf`.
+
+        The query returns up to `k` rows per query vector, to which the client's `max_rows` and `max_bytes`
+        apply, and it is reported to `on_result`, as for `run`.
+        """
+        import numpy as np
+
+        query_matrix = np.ascontiguousarray(query_matrix, dtype=_VECTOR_DTYPES[vector_type])
+        if query_matrix.ndim != 2:
+            raise ValueError('`query_matrix` must be 2-dimensional')
+        search_params = ''.join(f', {name}: {value}' for name, value in (extra_params or {}).items())
+        script = f'queries[qi, encoded] <- $queries\n' \
+                 f'?[qi, {id_column}, dist] := queries[qi, encoded], q = vec(encoded, "{vector_type}"), ' \
+                 f'~{relation_index}{{{id_column} | query: q, k: $k, ef: $ef, bind_distance: dist{search_params}}}'
+        queries = [[i, _encode_vector(row)] for i, row in enumerate(query_matrix)]
+        res = self._run_checked(script, {'queries': queries, 'k': k, 'ef': ef})
+
+        found = [[] for _ in range(len(query_matrix))]
+        for qi, key, dist in res['rows']:
+            found[qi].append((dist, key))
+        distances = np.full((len(query_matrix), k), np.inf, dtype=np.float32)
+        complete = all(len(hits) == k for hits in found)
+        ids = [] if complete else np.full((len(query_matrix), k), None, dtype=object)
+        for qi, hits in enumerate(found):
+            hits.sort(key=lambda hit: hit[0])
+            distances[qi, :len(hits)] = [dist for dist, _ in hits]
+            if complete:
+                ids.append([key for _, key in hits])
+            else:
+                ids[qi, :len(hits)] = [key for _, key in hits]
+        if complete:
+            ids = np.array(ids).reshape(len(query_matrix), k)
+        return ids, distances
+
+
+_COZO_DTYPES = {
+    'Int': ('int64', 'Int64'),
+    'Float': ('float64', 'Float64'),
+    'Bool': ('bool', 'boolean'),
+}
+
+
+def _typed_frame(pandas, headers, rows, dtypes):
+    columns = list(zip(*rows)) if rows else [()] * len(headers)
+    return _typed_frame_from_columns(pandas, headers, columns, dtypes)
+
+
+def _typed_frame_from_columns(pandas, headers, columns, dtypes):
+    data = {}
+    for i, (name, values) in enumerate(zip(headers, columns)):
+        data[i] = _typed_column(pandas, values, dtypes.get(name))
+    df = pandas.DataFrame(data)
+    df.columns = headers
+    return df
+
+
+def _typed_column(pandas, values, dtype):
+    if dtype is None:
+        return pandas.Series(values, dtype=object if not values else None)
+    nullable = False
+    if isinstance(dtype, str):
+        base = dtype.rstrip('?')
+        nullable = base != dtype
+        if base == 'String':
+            return _string_column(pandas, values)
+        if base in _COZO_DTYPES:
+            strict, loose = _COZO_DTYPES[base]
+            dtype = loose if nullable else strict
+        elif base in ('Any', 'Bytes', 'Json', 'Uuid', 'Validity') or base.startswith(('[', '<', '(')):
+            return pandas.Series(values, dtype=object)
+    try:
+        return pandas.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        # e.g. a null in a column declared as non-nullable: keep the data rather than failing the query
+        return pandas.Series(values, dtype=object if nullable else None)
+
+
+def _string_column(pandas, values):
+    canonical = {}
+    values = [canonical.setdefault(v, v) if isinstance(v, str) else v for v in values]
+    if len(values) >= 64 and len(canonical) * 2 <= len(values):
+        return pandas.Categorical(values)
+    # the strings are deduplicated above, so repeated values share one object
+    return pandas.Series(values, dtype=object)
+
+
+def _msgpack_encode(obj):
+    import msgpack
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def _msgpack_decode(data):
+    import msgpack
+    return msgpack.unpackb(data, raw=False)
+
+
+def _cbor_encode(obj):
+    import cbor2
+    return cbor2.dumps(obj)
+
+
+def _cbor_decode(data):
+    import cbor2
+    return cbor2.loads(data)
+
+
+# encoding name -> (content type, encode, decode)
+_WIRE_ENCODINGS = {
+    'json': ('application/json', lambda obj: json.dumps(obj).encode('utf-8'), json.loads),
+    'msgpack': ('application/msgpack', _msgpack_encode, _msgpack_decode),
+    'cbor': ('application/cbor', _cbor_encode, _cbor_decode),
+}
+
+_COMPRESS_MIN_BYTES = 4096
+
+
+def _accepted_codings(header):
+    """The content codings listed in an `Accept-Encoding` header, without those of quality 0"""
+    codings = set()
+    for item in (header or '').split(','):
+        parts = [p.strip() for p in item.split(';')]
+        quality = 1.0
+        for p in parts[1:]:
+            if p.startswith('q='):
+                try:
+                    quality = float(p[2:])
+                except ValueError:
+                    pass
+        if parts[0] and quality > 0:
+            codings.add(parts[0].lower())
+    return codings
+
+
+def _compress(data, compression):
+    if compression == 'gzip':
+        import gzip
+        return gzip.compress(data, compresslevel=5)
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    raise ValueError(f'Unknown compression {compression!r}')
+
+
+_VECTOR_DTYPES = {'F32': 'float32', 'F64': 'float64'}
+
+
+def _encode_vector(vector):
+    return base64.b64encode(vector.tobytes()).decode('ascii')
+
+
+def _is_arrow(data):
+    # checked without importing pyarrow, which is optional
+    return type(data).__module__.startswith('pyarrow') and hasattr(data, 'column_names')
+
+
+class QueryHandle:
+    """Handle of a query started with `Client.submit`."""
+
+    def __init__(self, client):
+        self._client = client
+        self._future = None
+        self._thread = None
+        self._started_at = None
+        self._finished_at = None
+
+    def result(self, timeout=None):
+        """Wait for the result of the query, at most `timeout` seconds if given,
+        raising `concurrent.futures.TimeoutError` after that."""
+        return self._future.result(timeout)
+
+    def done(self):
+        return self._future.done()
+
+    def add_done_callback(self, fn):
+        """Call `fn(handle)` when the query finishes, fails or is cancelled, at once if it already has."""
+        self._future.add_done_callback(lambda _: fn(self))
+
+    def cancel(self):
+        """Cancel the query. A query that has not started yet is dropped. A running one is killed on embedded
+        databases, if it is the only query of the client running: running queries cannot be told apart otherwise.
+
+        :return: whether the query was cancelled or a kill was requested.
+        """
+        if self._future.cancel():
+            return True
+        if self._future.done():
+            return False
+        return self._client._kill(lambda _, thread: thread == self._thread)
+
+    @property
+    def status(self):
+        """One of 'pending', 'running', 'cancelled', 'failed' or 'done'."""
+        if self._future.cancelled():
+            return 'cancelled'
+        if not self._future.done():
+            return 'running' if self._started_at is not None else 'pending'
+        return 'failed' if self._future.exception() is not None else 'done'
+
+    @property
+    def elapsed(self):
+        """Seconds since the query started running, or its total running time once finished."""
+        if self._started_at is None:
+            return 0.0
+        return (self._finished_at or time.monotonic()) - self._started_at
+
+    def __repr__(self):
+        return f'<QueryHandle {self.status} {self.elapsed:.1f}s>'
+
+
+# the embedded engine runs all change callbacks of the process, and all transactions, on one worker,
+# whichever database they belong to. Number of native callbacks by relation name.
+_native_callbacks = {}
+_native_callbacks_lock = threading.Lock()
+
+
+def _count_native_callbacks(relation, delta):
+    with _native_callbacks_lock:
+        count = _native_callbacks.get(relation, 0) + delta
+        if count > 0:
+            _native_callbacks[relation] = count
+        else:
+            _native_callbacks.pop(relation, None)
+
+
+def _callbacks_registered():
+    with _native_callbacks_lock:
+        return bool(_native_callbacks)
+
+
+def _timed(fn, *args):
+    """The result of a call, and the seconds it took"""
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def _fan_out(listeners, args):
+    for callback in list(listeners.values()):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception('Change callback failed')
+
+
+def _with_timeout(script, timeout):
+    """The script with a `:timeout` option added, or None if the script cannot take one at the top level."""
+    if not _is_query(script):
+        return None
+    if re.search(r'(?m)^\s*:timeout\b', script):
+        return script
+    return f'{script}\n:timeout {timeout}'
+
+
+class _SingleFlight:
+    """Lets concurrent identical calls share one execution. Only in-flight calls are tracked."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._executed = 0
+        self._coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+                self._executed += 1
+            else:
+                self._coalesced += 1
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        if leader:
+            return call.result
+        # followers get their own lists, so that no caller sees another one's modifications
+        return {**call.result, 'headers': list(call.result['headers']),
+                'rows': [list(row) for row in call.result['rows']]}
+
+    def stats(self):
+        with self._lock:
+            return {'executed': self._executed, 'coalesced': self._coalesced, 'in_flight': len(self._calls)}
+
+
+class _FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _flight_key(script, params, timeout):
+    """A key shared by the calls giving the same result, None if the parameters cannot be compared by value"""
+    try:
+        return script, _tagged(params or {}), timeout
+    except TypeError:
+        return None
+
+
+def _tagged(value):
+    """A hashable form of a parameter, tagged with its type so that e.g. 1, 1.0 and True stay apart"""
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return type(value).__name__, value
+    elif isinstance(value, (list, tuple)):
+        return 'list', tuple(_tagged(v) for v in value)
+    elif isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return 'dict', tuple(sorted((k, _tagged(v)) for k, v in value.items()))
+    raise TypeError(f'Cannot compare parameters of type {type(value).__name__}')
+
+
+_HTTP_TIMEOUT_GRACE = 5
+
+_LEADING_COMMENTS_RE = re.compile(r'(?:\s+|#[^\n]*|/\*.*?\*/)*', re.S)
+
+
+def _is_query(script):
+    """Whether a script is a single query, rather than a chained, imperative or system script.
+
+    Leading whitespace and comments are skipped."""
+    body = script[_LEADING_COMMENTS_RE.match(script).end():]
+    return not body.startswith(('::', '{', '%'))
+
 
 class MultiTransact:
-    def __init__(self, multi_tx):
+    def __init__(self, multi_tx, on_finish=None):
         self.multi_tx = multi_tx
+        self._on_finish = on_finish
+        self._finished = False
+        self.committed = False
+        # the scripts run, so that the client can drop what they changed from its caches once committed
+        self._scripts = []
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        try:
-            self.abort()
-        except:
-            pass
+        if not self._finished:
+            try:
+                self.abort()
+            except:
+                pass
+
+    def _finish(self):
+        self._finished = True
+        if self._on_finish:
+            self._on_finish(self)
 
     def commit(self):
-        return self.multi_tx.commit()
+        try:
+            result = self.multi_tx.commit()
+            self.committed = True
+            return result
+        finally:
+            self._finish()
 
     def abort(self):
-        return self.multi_tx.abort()
+        try:
+            return self.multi_tx.abort()
+        finally:
+            self._finish()
 
     def run(self, script, params=None):
+        self._scripts.append(script)
         return self.multi_tx.run_script(script, params or {})
 
+    def _run_raw(self, script, params=None):
+        """Like `run`, but failing with `QueryException`"""
+        self._scripts.append(script)
+        try:
+            return self.multi_tx.run_script(script, params or {})
+        except Exception as e:
+            raise QueryException(e.args[0]) from None
+
 
 class RemoteMultiTransact:
-    def __init__(self, tx_id: int, tx_request, tx_finish):
+    def __init__(self, tx_id: int, tx_request, tx_finish, on_finish=None, tx_request_raw=None):
         self._tx_id = tx_id
         self._tx_request = tx_request
+        self._tx_request_raw = tx_request_raw
         self._tx_finish = tx_finish
+        self._on_finish = on_finish
         self._finished = False
+        self.committed = False
+        self._scripts = []
 
     def __enter__(self):
         return self
@@ -392,6 +1386,9 @@ class RemoteMultiTransact:
             raise ValueError("Transaction has already been completed.")
         result = self._tx_finish(self._tx_id, abort=False)
         self._finished = True
+        self.committed = True
+        if self._on_finish:
+            self._on_finish(self)
         return result
 
     def abort(self):
@@ -399,13 +1396,23 @@ class RemoteMultiTransact:
             raise ValueError("Transaction has already been completed.")
         result = self._tx_finish(self._tx_id, abort=True)
         self._finished = True
+        if self._on_finish:
+            self._on_finish(self)
         return result
 
     def run(self, script, params=None):
         if self._finished:
             raise ValueError("Transaction has already been completed.")
+        self._scripts.append(script)
         return self._tx_request(self._tx_id, script, params or {})
 
+    def _run_raw(self, script, params=None):
+        """Like `run`, but the result is always a dict"""
+        if self._finished:
+            raise ValueError("Transaction has already been completed.")
+        self._scripts.append(script)
+        return self._tx_request_raw(self._tx_id, script, params or {})
+
 
 class QueryException(Exception):
     """The exception class for queries. `repr(e)` will pretty format the exceptions into ANSI-coloured messages.
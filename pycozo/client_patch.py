@@ -1,4 +1,9 @@
 # pycozo.py
+import re
+import threading
+import time
+from collections import OrderedDict
+
 from pycozo import *  # noqa
 from pycozo import client
 
@@ -53,14 +58,52 @@ class Client(client.Client):
     """ PyCozo Client wrapper with .create(), .relations(), .columns() methods
 
     create(name, *column_names): create a stored (persistent) relation (table)
+    create_from_dataframe(name, df, keys): create a typed relation from a DataFrame and bulk-load it
     relations(name): DataFrame describing relation (table) schemas 
     columns(name): DataFrame describing the columns of the named relation (tables) with their names, arity, etc 
 
+    get_many(name, keys): fetch the rows for many primary keys in one round trip, optionally cached
+    as_of(timestamp): run builder programs against relations with time travel as of a timestamp, cached
+
+    Relation and column metadata is cached in memory. Entries are dropped when this client runs a
+    schema-changing script (:create, :replace, ::remove, ...) and expire after `schema_cache_ttl` seconds
+    so that changes made by other clients are eventually picked up.
+
     TODO:
       remove(name): delete a stored (persistent) relation (relational DB table)
       query(name): run arbitrary cozo "select * where " query strings
     """
 
+    def __init__(self, *args, key_cache_size=65536, key_cache_ttl=10, schema_cache_ttl=60, as_of_cache_size=256,
+                 **kwargs):
+        """ Same arguments as pycozo.client.Client, plus:
+
+        key_cache_size: maximum number of rows kept by the `get_many(..., cache=True)` LRU cache
+        key_cache_ttl: seconds after which rows cached by `get_many` are fetched again
+        schema_cache_ttl: seconds after which cached relation/column metadata is re-fetched, 0 disables the cache
+        as_of_cache_size: maximum number of results kept by the cache of `as_of` views, 0 disables the cache
+        """
+        super().__init__(*args, **kwargs)
+        self.schema_cache_ttl = schema_cache_ttl
+        self._schema_lock = threading.Lock()
+        self._schema_relations = None
+        self._schema_columns = {}
+        self.key_cache_ttl = key_cache_ttl
+        self._key_cache = _LRUCache(key_cache_size)
+        self._key_cache_lock = threading.Lock()
+        self._key_cache_cbs = {}
+        self._key_cache_gens = {}
+        self._key_cache_epochs = {}
+        self._key_cache_epoch = 0
+        self._key_cache_layouts = {}
+        self._views = {}
+        self._as_of_cache = _LRUCache(as_of_cache_size)
+        self._as_of_lock = threading.Lock()
+        self._as_of_gens = {}
+        self._as_of_epoch = 0
+        self._as_of_hits = 0
+        self._as_of_misses = 0
+
     def create(self, name, *args, **kwargs):
         """ Create a new empty table with the table name and column labels indicated (positional args) 
 
@@ -77,6 +120,108 @@ class Client(client.Client):
         #     self.run(f':create {name} {{{pk_name} => {", ".join([c for c in args])}}}')
         return self.run(f':create {name} {{{", ".join([c for c in args])}}}')
 
+    def create_from_dataframe(self, name, df, keys=None, indexes=None, replace=False, chunk_size=10000, workers=4,
+                              progress=None):
+        """ Create a typed stored relation from a pandas DataFrame and load the DataFrame into it
+
+        name: name of the relation to create
+        df: the data, its column names become the column names of the relation
+        keys: the key columns, defaults to the first column. The other columns are values.
+        indexes: secondary indexes to create, a list of column names or lists of column names, or a dict from
+            index names to those. Indexes are named `<relation>:by_<columns>` unless given in a dict
+        replace: if True, an existing relation of that name is replaced, otherwise creating it fails
+        chunk_size, workers: rows are loaded in chunks of `chunk_size`, `workers` chunks at a time,
+            with `import_relations`
+        progress: if given, called as `progress(name, rows_loaded)` after each chunk
+
+        Column types are inferred from the dtypes: integers become Int, floats Float, booleans Bool,
+        datetimes and timedeltas Float (seconds, as Cozo stores times), and object columns String, Bytes or
+        a list type if all their values are of one kind, and Any otherwise. Columns with nulls are nullable.
+
+        Returns a dict with the number of `rows` loaded, the `seconds` taken and the `rows_per_second`.
+
+        >>> import pandas
+        >>> db = Client()
+        >>> df = pandas.DataFrame({'id': [1, 2], 'name': ['a', 'b'], 'score': [0.5, None]})
+        >>> db.create_from_dataframe('scores', df, keys=['id'], indexes=['name'])['rows']
+        2
+        >>> db.columns('scores')
+          column  is_key  index    type  has_default
+        0     id    True      0     Int        False
+        1   name   False      1  String        False
+        2  score   False      2  Float?        False
+        """
+        columns = [str(c) for c in df.columns]
+        bad = [c for c in columns if not c.isidentifier()]
+        if bad:
+            raise ValueError(f'Columns {bad} are not valid column names for relation {name}')
+        keys = list(keys) if keys is not None else columns[:1]
+        unknown = [c for c in keys if c not in columns]
+        if unknown or not keys:
+            raise ValueError(f'Key columns {unknown or keys} are not columns of the DataFrame')
+        df = df.set_axis(columns, axis=1)
+        if df.duplicated(subset=keys).any():
+            raise ValueError(f'The DataFrame has duplicate keys {keys}, rows would overwrite each other')
+        if isinstance(indexes, dict):
+            indexes = {idx: [cols] if isinstance(cols, str) else list(cols) for idx, cols in indexes.items()}
+        else:
+            indexes = {'by_' + '_'.join(cols): cols
+                       for cols in ([c] if isinstance(c, str) else list(c) for c in indexes or [])}
+        for cols in indexes.values():
+            if any(c not in columns for c in cols):
+                raise ValueError(f'Index columns {cols} are not columns of the DataFrame')
+
+        types = {c: _cozo_type(df[c]) for c in columns}
+        key_spec = ', '.join(f'{c}: {types[c]}' for c in keys)
+        value_spec = ', '.join(f'{c}: {types[c]}' for c in columns if c not in keys)
+        spec = f'{key_spec} => {value_spec}' if value_spec else key_spec
+        if replace and name in {row[0] for row in self._run_raw('::relations', immutable=True)['rows']}:
+            # relations with indexes can be neither replaced nor removed
+            for row in self._run_raw(f'::indices {name}', immutable=True)['rows']:
+                self.run(f'::{_INDEX_KINDS.get(row[1], row[1])} drop {name}:{row[0]}')
+            self.run(f'::remove {name}')
+        self.run(f':create {name} {{{spec}}}')
+        for idx, cols in indexes.items():
+            self.run(f'::index create {name}:{idx} {{{", ".join(cols)}}}')
+
+        start = time.perf_counter()
+        loaded = self._load_frame(name, df, columns, chunk_size, workers, progress)
+        seconds = time.perf_counter() - start
+        self._invalidate_key_cache(name)
+        stats = {'rows': loaded, 'seconds': seconds, 'rows_per_second': loaded / seconds if seconds else 0.0}
+        client.logger.info(f'Loaded {loaded} rows into {name} in {seconds:.2f}s '
+                           f'({stats["rows_per_second"]:.0f} rows/s)')
+        return stats
+
+    def _load_frame(self, name, df, columns, chunk_size, workers, progress):
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        loaded = 0
+
+        def load(offset):
+            chunk = df.iloc[offset:offset + chunk_size]
+            values = [_column_values(chunk[c]) for c in columns]
+            rows = [list(row) for row in zip(*values)]
+            self.import_relations({name: {'headers': columns, 'rows': rows}})
+            return len(rows)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            pending = set()
+            # at most `workers` chunks are converted or in flight at any time
+            for offset in range(0, len(df), chunk_size):
+                if len(pending) >= max(1, workers):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        loaded += future.result()
+                        if progress is not None:
+                            progress(name, loaded)
+                pending.add(pool.submit(load, offset))
+            for future in pending:
+                loaded += future.result()
+                if progress is not None:
+                    progress(name, loaded)
+        return loaded
+
     def relations(self, name=None):
         """ Return DataFrame listing all the relations (tables) with their names, arity, etc
 
@@ -96,21 +241,366 @@ class Client(client.Client):
         0      ABCs      7       normal       7           0               0              0                   0            
         1  table123      3       normal       3           0               0              0                   0            
         """
+        res = self._cached_relations()
         if name is None:
-            return self.run('::relations')
-        df = self.relations(name=None)
-        if isinstance(name, str):
-            return df.loc[df['name'] == name].copy()
-        return df.loc[df['name'].isin(name)].copy()
+            return self._to_output(_copy_result(res))
+        names = {name} if isinstance(name, str) else set(name)
+        return self._to_output({'headers': list(res['headers']),
+                                'rows': [list(row) for row in res['rows'] if row[0] in names]})
 
     def columns(self, name=None):
         """ DataFrame of columns for the named relation (tables) with their names, arity, etc 
 
-        If name is None (default) return a dict of DataFrames, one DataFrame per relation (table)
+        If name is None (default) return a dict of DataFrames, one DataFrame per relation (table).
+        The database lists the columns of one relation per `::columns` query, so the relations missing from
+        the cache take one query each, sent concurrently to remote databases
         """
         if name is None:
-            return {n: self.columns(name=str(n)) for n in self.relations()['name']}
-        return self.run(f'::columns {name}')
+            names = [row[0] for row in self._cached_relations()['rows']]
+            if self.embedded is None and len(names) > 1:
+                results = self._pool().map(self._cached_columns, names)
+            else:
+                results = map(self._cached_columns, names)
+            return {n: self._to_output(_copy_result(res)) for n, res in zip(names, results)}
+        return self._to_output(_copy_result(self._cached_columns(name)))
+
+    def run(self, script, params=None, immutable=False, dtypes=None, **kwargs):
+        """ Same as pycozo.client.Client.run, but `dtypes` can also be the name of a stored relation,
+        in which case the column types stored for that relation are used.
+        """
+        if isinstance(dtypes, str):
+            dtypes = self.relation_dtypes(dtypes)
+        return super().run(script, params, immutable, dtypes, **kwargs)
+
+    def relation_dtypes(self, name):
+        """ Dict from column names to the Cozo types of the named relation, usable as `run(..., dtypes=...)` """
+        return {row[0]: row[3] for row in self._cached_columns(name)['rows']}
+
+    def _cached_relations(self):
+        now = time.monotonic()
+        with self._schema_lock:
+            entry = self._schema_relations
+        if entry is not None and now - entry[0] < self.schema_cache_ttl:
+            return entry[1]
+        res = self._run_raw('::relations', immutable=True)
+        with self._schema_lock:
+            self._schema_relations = (now, res)
+        return res
+
+    def _cached_columns(self, name):
+        now = time.monotonic()
+        with self._schema_lock:
+            entry = self._schema_columns.get(name)
+        if entry is not None and now - entry[0] < self.schema_cache_ttl:
+            return entry[1]
+        res = self._run_raw(f'::columns {name}', immutable=True)
+        with self._schema_lock:
+            self._schema_columns[name] = (now, res)
+        return res
+
+    def invalidate_schema_cache(self, name=None):
+        """ Drop cached metadata of the named relation, or of all relations if name is None """
+        with self._schema_lock:
+            self._schema_relations = None
+            if name is None:
+                self._schema_columns.clear()
+            else:
+                self._schema_columns.pop(name, None)
+        with self._key_cache_lock:
+            if name is None:
+                self._key_cache_layouts.clear()
+            else:
+                self._key_cache_layouts.pop(name, None)
+
+    def _run_raw(self, script, params=None, immutable=False, timeout=None):
+        try:
+            return super()._run_raw(script, params, immutable, timeout)
+        finally:
+            if not immutable:
+                self._invalidate_for(script)
+
+    def _transaction_finished(self, tx):
+        super()._transaction_finished(tx)
+        if tx.committed:
+            for script in tx._scripts:
+                self._invalidate_for(script)
+
+    def _invalidate_for(self, script):
+        """ Drop the cached metadata, rows and `as_of` results that a script may have changed """
+        self._invalidate_schema_for(script)
+        if any(not op[0] for op in _SCHEMA_OP_RE.findall(script)):
+            # relations removed or renamed
+            self._invalidate_key_cache()
+            self.invalidate_as_of_cache()
+            return
+        for target in set(_WRITE_OP_RE.findall(script)):
+            self._invalidate_key_cache(target)
+            self.invalidate_as_of_cache(target)
+
+    def _invalidate_schema_for(self, script):
+        ops = _SCHEMA_OP_RE.findall(script)
+        if not ops:
+            return
+        if all(op[0] for op in ops):
+            # only :create/:replace, whose targets are known
+            for _, target, _ in ops:
+                self.invalidate_schema_cache(target)
+        else:
+            self.invalidate_schema_cache()
+
+    def _relation_columns(self, name):
+        """ List of (column, is_key) pairs of a stored relation, in storage order """
+        return [(row[0], row[1]) for row in self._cached_columns(name)['rows']]
+
+    def get_many(self, name, keys, columns=None, cache=False):
+        """ Fetch the rows of a stored relation for many primary keys with a single query
+
+        name: name of the stored relation
+        keys: list of keys. For relations with a single key column, each key is the value of that column, even
+            when it is a list. For composite keys, each key is a tuple/list with one value per key column
+        columns: names of the columns to return, all columns of the relation if None
+        cache: if True, rows are served from an LRU cache keyed by (relation, key). Entries are dropped when
+            this client writes to the relation (scripts, put/insert/update/rm, imports), and expire after
+            `key_cache_ttl` seconds so that writes made by other clients or by triggers are picked up.
+            For remote databases, the changes streamed by the server also drop them
+
+        Rows are returned in the order of `keys`, keys that do not exist are skipped. The client's `max_rows` and
+        `max_bytes` apply to the rows fetched from the database, and the query is reported to `on_result`, as
+        for `run`.
+
+        >>> db = Client()
+        >>> db.run(':create kv {k => v}')
+          status
+        0     OK
+        >>> db.put('kv', [{'k': 1, 'v': 'a'}, {'k': 2, 'v': 'b'}])
+          status
+        0     OK
+        >>> db.get_many('kv', [2, 3, 1])
+           k  v
+        0  2  b
+        1  1  a
+        """
+        key_cols, all_cols, dtypes = self._key_layout(name, cache)
+        out_cols = list(columns) if columns else all_cols
+        n_keys = len(key_cols)
+        if n_keys == 1:
+            keys = [(_hashable(k),) for k in keys]
+        else:
+            bad = [k for k in keys if not isinstance(k, (list, tuple)) or len(k) != n_keys]
+            if bad:
+                raise ValueError(f'Keys of relation {name} are tuples of its key columns {key_cols}, got {bad[0]!r}')
+            keys = [_hashable(k) for k in keys]
+
+        found = {}
+        missing = keys
+        if cache:
+            if self.embedded is None:
+                self._ensure_key_cache_callback(name, n_keys)
+            now = time.monotonic()
+            epoch = self._key_cache_epoch_of(name)
+            missing = []
+            for k in keys:
+                entry = self._key_cache.get((name, k))
+                if entry is None or entry[0] != epoch or now - entry[1] >= self.key_cache_ttl:
+                    missing.append(k)
+                else:
+                    found[k] = entry[2]
+            # a cached row is always a full row, so that any projection can be served from it
+            fetch_cols = all_cols
+        else:
+            fetch_cols = key_cols + [c for c in out_cols if c not in key_cols]
+
+        if missing:
+            gen = self._key_cache_gens.get(name, 0)
+            epoch = self._key_cache_epoch_of(name)
+            fetched_at = time.monotonic()
+            key_vars = ', '.join(key_cols)
+            script = f'keys_in[{key_vars}] <- $keys\n' \
+                     f'?[{", ".join(fetch_cols)}] := keys_in[{key_vars}], *{name}{{{", ".join(fetch_cols)}}}'
+            res = self._run_checked(script, {'keys': [list(k) for k in dict.fromkeys(missing)]})
+            positions = [res['headers'].index(c) for c in fetch_cols]
+            for row in res['rows']:
+                row = [row[i] for i in positions]
+                k = _hashable(tuple(row[:n_keys]))
+                found[k] = row
+                if cache:
+                    with self._key_cache_lock:
+                        if self._key_cache_gens.get(name, 0) == gen and self._key_cache_epoch_of(name) == epoch:
+                            self._key_cache.put((name, k), (epoch, fetched_at, row))
+
+        positions = [fetch_cols.index(c) for c in out_cols]
+        rows = [[found[k][i] for i in positions] for k in keys if k in found]
+        return self._to_output({'headers': out_cols, 'rows': rows}, dtypes)
+
+    def _key_layout(self, name, cache):
+        """ The key columns, all columns and dtypes of a relation, kept with the key cache so that lookups
+        served from the cache need no metadata query """
+        now = time.monotonic()
+        with self._key_cache_lock:
+            entry = self._key_cache_layouts.get(name) if cache else None
+            epoch = self._key_cache_epoch_of(name)
+        if entry is not None and now - entry[0] < self.key_cache_ttl:
+            return entry[1]
+        schema = self._relation_columns(name)
+        layout = [c for c, is_key in schema if is_key], [c for c, _ in schema], self.relation_dtypes(name)
+        if cache:
+            with self._key_cache_lock:
+                if self._key_cache_epoch_of(name) == epoch:
+                    self._key_cache_layouts[name] = (now, layout)
+        return layout
+
+    def _key_cache_epoch_of(self, name):
+        return self._key_cache_epoch, self._key_cache_epochs.get(name, 0)
+
+    def _ensure_key_cache_callback(self, name, n_keys):
+        # only for remote databases: the embedded engine serves one relation's callbacks at a time,
+        # and does not start transactions while any is registered
+        with self._key_cache_lock:
+            if name in self._key_cache_cbs:
+                return
+
+            def on_change(_op, new_rows, old_rows):
+                with self._key_cache_lock:
+                    self._key_cache_gens[name] = self._key_cache_gens.get(name, 0) + 1
+                    for row in new_rows + old_rows:
+                        self._key_cache.discard((name, _hashable(tuple(row[:n_keys]))))
+
+            self._key_cache_cbs[name] = self.register_callback(name, on_change)
+
+    def _invalidate_key_cache(self, name=None):
+        """ Drop the cached rows of the named relation, or of all relations if name is None """
+        # entries of older epochs are treated as misses and age out of the LRU
+        with self._key_cache_lock:
+            if name is None:
+                self._key_cache_epoch += 1
+                self._key_cache_layouts.clear()
+            else:
+                self._key_cache_epochs[name] = self._key_cache_epochs.get(name, 0) + 1
+                self._key_cache_layouts.pop(name, None)
+
+    def _mutate(self, relation, data, op):
+        # without a cache, the columns would be fetched for every write: the database checks them anyway
+        if self.schema_cache_ttl > 0:
+            error = self._mutation_error(relation, data)
+            if error is not None:
+                # the cached columns may predate a schema change made by another client
+                self.invalidate_schema_cache(relation)
+                error = self._mutation_error(relation, data)
+            if error is not None:
+                raise RuntimeError(error)
+        try:
+            return super()._mutate(relation, data, op)
+        finally:
+            self._invalidate_key_cache(relation)
+            self.invalidate_as_of_cache(relation)
+
+    def _mutation_error(self, relation, data):
+        """ Why the data cannot be written to the relation according to its columns, None if it can """
+        try:
+            known = self._relation_columns(relation)
+        except client.QueryException:
+            # let the database report the missing relation
+            return None
+        cols = _mutation_columns(data)
+        known_names = {c for c, _ in known}
+        unknown = [c for c in cols if c not in known_names]
+        if unknown:
+            return f'Columns {unknown} do not exist in relation {relation}'
+        missing = [c for c, is_key in known if is_key and c not in cols]
+        if missing:
+            return f'Key columns {missing} of relation {relation} are missing from the data'
+        return None
+
+    def import_relations(self, data):
+        try:
+            return super().import_relations(data)
+        finally:
+            for name in data:
+                self._invalidate_key_cache(name)
+                self.invalidate_as_of_cache(name)
+
+    def as_of(self, timestamp):
+        """ A `pycozo.time_travel.AsOf` view running builder programs as of the timestamp
+
+        Stored-relation atoms of the programs on relations whose last key is a Validity get `@ <timestamp>`.
+        Results at timestamps in the past of programs reading only such atoms are cached, see
+        `invalidate_as_of_cache` and `as_of_cache_stats`.
+
+        timestamp: a datetime, microseconds since the epoch, an ISO 8601 string, or 'NOW' or 'END'
+        """
+        from pycozo.time_travel import AsOf
+
+        return AsOf(self, timestamp)
+
+    def invalidate_as_of_cache(self, name=None):
+        """ Drop the cached `as_of` results reading the named relation, or all of them if name is None
+
+        Needed after writes with past validities made by other clients or by triggers.
+        """
+        with self._as_of_lock:
+            if name is None:
+                self._as_of_epoch += 1
+                self._as_of_cache.clear()
+            else:
+                # entries of older generations are treated as misses and age out of the LRU
+                self._as_of_gens[name] = self._as_of_gens.get(name, 0) + 1
+
+    def as_of_cache_stats(self):
+        """ Counters of the `as_of` cache: cached `entries`, and `hits` and `misses` so far """
+        with self._as_of_lock:
+            return {'entries': len(self._as_of_cache), 'hits': self._as_of_hits, 'misses': self._as_of_misses}
+
+    def _as_of_generations(self, relations):
+        with self._as_of_lock:
+            return self._as_of_epoch, tuple(self._as_of_gens.get(r, 0) for r in sorted(relations))
+
+    def _as_of_cache_get(self, key, relations):
+        entry = self._as_of_cache.get(key)
+        current = self._as_of_generations(relations)
+        with self._as_of_lock:
+            if entry is None or entry[0] != current:
+                self._as_of_misses += 1
+                return None
+            self._as_of_hits += 1
+        return _copy_result(entry[1])
+
+    def _as_of_cache_put(self, key, generations, res):
+        self._as_of_cache.put(key, (generations, _copy_result(res)))
+
+    def materialize(self, name, script, source_relations, params=None, group_by=None, aggregates=None,
+                    key_columns=None, debounce=0.05):
+        """ Run a query once and keep its result in memory, maintained from change callbacks
+
+        name: name of the view, it can be retrieved later with `view(name)`
+        script, params: the query of the view
+        source_relations: the stored relations the query reads, changes to them update the view.
+            Views of embedded databases have a single source relation
+        group_by, aggregates: declare that the query is `?[<group_by>, <aggregates>] := *rel{...}` over a single
+            source relation, with aggregates given as {output_column: ('count', None) or ('sum', source_column)}.
+            Such views with a count among their aggregates are updated incrementally from each change, other
+            views re-run their query
+        key_columns: number of leading columns the view is indexed by, defaults to the group_by columns or 1
+        debounce: seconds to wait for further changes before re-running the query
+
+        >>> db = Client(dataframe=False)
+        >>> _ = db.run('?[k, g, v] <- [[1, "a", 5], [2, "b", 1]] :create t {k => g, v}')
+        >>> view = db.materialize('by_g', '?[g, count(k), sum(v)] := *t{k, g, v}', ['t'],
+        ...                       group_by=['g'], aggregates={'n': ('count', None), 'total': ('sum', 'v')})
+        >>> view.get('a')
+        ['a', 1, 5.0]
+        """
+        from pycozo.views import MaterializedView
+
+        if name in self._views:
+            self._views[name].close()
+        view = MaterializedView(self, name, script, source_relations, params, group_by, aggregates, key_columns,
+                                debounce)
+        self._views[name] = view
+        return view
+
+    def view(self, name):
+        """ The materialized view with the given name """
+        return self._views[name]
 
     def query(self, query_str):
         """ Execute a raw cozodb query string """
@@ -121,6 +611,131 @@ class Client(client.Client):
         return self.run(f'::remove {name}')
 
 
+class _LRUCache:
+    """ Minimal thread-safe LRU mapping used by the key cache """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# the system op dropping each kind of index listed by `::indices`
+_INDEX_KINDS = {'normal': 'index'}
+
+_SCHEMA_OP_RE = re.compile(
+    r'(?<![\w:]):(create|replace)\s+([\w:.]+)'
+    r'|::(remove|rename|index|hnsw|fts|lsh|set_triggers|access_level|describe)\b'
+)
+
+
+_WRITE_OP_RE = re.compile(r'(?<![\w:]):(?:create|replace|put|insert|update|rm|delete)\s+([\w.]+)')
+
+
+def _copy_result(res):
+    return {'headers': list(res['headers']), 'rows': [list(row) for row in res['rows']]}
+
+
+def _mutation_columns(data):
+    if isinstance(data, dict):
+        return list(data)
+    elif isinstance(data, list):
+        return list(data[0]) if data else []
+    elif hasattr(data, 'column_names'):
+        return list(data.column_names)
+    else:
+        return list(getattr(data, 'columns', []))
+
+
+def _cozo_type(series):
+    """ The Cozo column type for a pandas Series, nullable if the Series has nulls """
+    import pandas as pd
+
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        base = _cozo_type(pd.Series(dtype.categories)).rstrip('?')
+    elif pd.api.types.is_bool_dtype(dtype):
+        base = 'Bool'
+    elif pd.api.types.is_integer_dtype(dtype):
+        base = 'Int'
+    elif pd.api.types.is_float_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype) \
+            or pd.api.types.is_timedelta64_dtype(dtype):
+        base = 'Float'
+    elif pd.api.types.is_string_dtype(dtype) and not pd.api.types.is_object_dtype(dtype):
+        base = 'String'
+    else:
+        base = _object_type(series.dropna())
+    return base + '?' if series.isna().any() and base != 'Any' else base
+
+
+def _object_type(values):
+    kinds = {type(v) for v in values}
+    if kinds and all(issubclass(k, str) for k in kinds):
+        return 'String'
+    elif kinds and all(issubclass(k, bytes) for k in kinds):
+        return 'Bytes'
+    elif kinds and all(issubclass(k, (list, tuple)) for k in kinds):
+        return '[Any]'
+    return 'Any'
+
+
+def _column_values(series):
+    """ The values of a pandas Series as Python objects that Cozo accepts, with None for nulls """
+    import pandas as pd
+
+    dtype = series.dtype
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, 'tz', None) is not None:
+            series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+        values = (series - pd.Timestamp(0)).dt.total_seconds()
+    elif pd.api.types.is_timedelta64_dtype(dtype):
+        values = series.dt.total_seconds()
+    else:
+        values = series
+    nulls = values.isna().to_numpy()
+    if not nulls.any():
+        out = values.tolist()
+    else:
+        out = [None if null else v for v, null in zip(values.astype(object).tolist(), nulls)]
+    # tuples from object columns would not be accepted as lists
+    return [list(v) if isinstance(v, tuple) else v for v in out] if dtype == object else out
+
+
+def _hashable(val):
+    """ Turn the (possibly nested) list values Cozo uses for keys into tuples """
+    if isinstance(val, (list, tuple)):
+        return tuple(_hashable(v) for v in val)
+    return val
+
+
 client.Client = Client
 
 
@@ -4,7 +4,7 @@
 #  If a copy of the MPL was not distributed with this file,
 #  You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import json
+import weakref
 
 from IPython.core.magic import (Magics, magics_class, line_magic,
                                 cell_magic, needs_local_scope)
@@ -20,6 +20,11 @@ class CozoMagics(Magics):
         super().__init__(shell, **kwargs)
         self.client = None
         self.params = {}
+        self.display_config = dict(DEFAULT_CONFIG)
+        self.background = {}
+        # results returned by the line magics, shown as a preview: id -> weak reference
+        self._previewed = {}
+        self._html_printer = None
 
     def _ensure_client(self):
         if self.client is None:
@@ -46,8 +51,20 @@ class CozoMagics(Magics):
 
     @cell_magic
     def cozo(self, line, cell):
-        """Run CozoScript"""
+        """Run CozoScript
+        ```
+        %%cozo [<VARIABLE>]
+        %%cozo --bg <VARIABLE>
+        ```
+        With `--bg`, the query runs in the background and a handle showing its status is returned at once.
+        The result is stored in the variable when the query finishes, see also `%cozo_cancel`.
+        """
         self._ensure_client()
+        background, rest = _parse_bg(line)
+        if background:
+            if rest:
+                raise Exception('%%cozo --bg takes only the name of a variable')
+            return self._run_in_background(background, cell)
         try:
             res = self.client.run(cell, self.params)
         except QueryException as e:
@@ -57,33 +74,130 @@ class CozoMagics(Magics):
         var = line.strip()
         if var:
             self.shell.user_ns[var] = res
-        try:
-            return res.style.applymap(_colour_code_type)
-        except:
+        return self._display(res)
+
+    def _run_in_background(self, var, script):
+        handle = self.client.submit(script, dict(self.params))
+        self.background[var] = handle
+
+        def assign(h):
+            if h.status == 'done':
+                self.shell.user_ns[var] = h.result()
+            elif h.status == 'failed':
+                self.shell.user_ns[var] = h._future.exception()
+
+        handle.add_done_callback(assign)
+        return handle
+
+    @line_magic
+    def cozo_cancel(self, line):
+        """Cancel queries running in the background
+        ```
+        %cozo_cancel [<VARIABLE>]
+        ```
+        Without a variable, all background queries that are still running are cancelled.
+        Returns the status of the cancelled queries.
+        """
+        names = line.split() or [var for var, h in self.background.items() if not h.done()]
+        for var in names:
+            if var not in self.background:
+                raise Exception(f'no background query for {var}')
+            self.background[var].cancel()
+        return {var: self.background[var] for var in names}
+
+    def _display(self, res):
+        if not hasattr(res, 'iloc'):
+            return res
+        return ResultPreview(res, self.display_config['preview_rows'], self.display_config['style'])
+
+    def _preview_when_shown(self, res):
+        """The result itself, which line magics return as there is no variable to keep it in. Only a preview of it
+        is rendered as HTML, through a printer of the display formatter of the shell."""
+        if not hasattr(res, 'iloc'):
             return res
+        key = id(res)
+        self._previewed[key] = weakref.ref(res, lambda _: self._previewed.pop(key, None))
+        if self._html_printer is None:
+            formatter = self.shell.display_formatter.formatters['text/html']
+            previous = formatter.for_type(type(res), self._format_html)
+            self._html_printer = previous or (lambda df: df._repr_html_())
+        return res
+
+    def _format_html(self, df):
+        ref = self._previewed.get(id(df))
+        if ref is not None and ref() is df:
+            return self._display(df)._repr_html_()
+        return self._html_printer(df)
+
+    @line_magic
+    def cozo_config(self, line):
+        """Show or change how results are displayed
+        ```
+        %cozo_config preview_rows=40 style=False page_size=100
+        ```
+        `preview_rows` is the number of rows shown for a result, half from its start and half from its end.
+        The full result is always stored in the variable given to `%%cozo`, and returned by `%cozo_run_string`
+        and `%cozo_run_file`.
+        `style` colour-codes the values of the preview by type.
+        `page_size` is the number of rows shown by `%cozo_page`.
+        `import_chunk_rows` is the number of rows imported at once by `%cozo_import_local_file`
+        and `%cozo_import_remote_file`.
+        Without arguments, returns the current configuration.
+        """
+        for item in line.split():
+            key, _, value = item.partition('=')
+            if key not in DEFAULT_CONFIG:
+                raise Exception(f'unknown option {key}, expected one of {", ".join(DEFAULT_CONFIG)}')
+            self.display_config[key] = eval(value)
+        return dict(self.display_config)
+
+    @line_magic
+    @needs_local_scope
+    def cozo_page(self, line, local_ns):
+        """Show one page of a stored result, pages are numbered from 0
+        ```
+        %cozo_page <VARIABLE> <PAGE>
+        ```
+        """
+        args = line.split()
+        res = eval(args[0], self.shell.user_ns, local_ns)
+        page = int(args[1]) if len(args) > 1 else 0
+        size = self.display_config['page_size']
+        n_pages = max(1, -(-len(res) // size))
+        if not 0 <= page < n_pages:
+            raise Exception(f'page {page} is out of range, there are {n_pages} pages')
+        return ResultPreview(res.iloc[page * size:(page + 1) * size], size, self.display_config['style'],
+                             caption=f'page {page} of {n_pages}, rows {page * size} to '
+                                     f'{min(len(res), (page + 1) * size) - 1} of {len(res)}')
 
     @line_magic
     @needs_local_scope
     def cozo_run_string(self, line, local_ns):
-        """Run CozoScript contained in a string expression"""
+        """Run CozoScript contained in a string expression, in the background with `--bg <VARIABLE> <EXPR>`"""
         self._ensure_client()
+        background, line = _parse_bg(line)
         script = eval(line, self.shell.user_ns, local_ns)
         if not isinstance(script, str):
             raise Exception('a string is required')
+        if background:
+            return self._run_in_background(background, script)
         try:
-            return self.client.run(script, self.params)
+            return self._preview_when_shown(self.client.run(script, self.params))
         except QueryException as e:
             return e
 
     @line_magic
     def cozo_run_file(self, line):
-        """Run CozoScript contained in a file"""
+        """Run CozoScript contained in a file, in the background with `--bg <VARIABLE> <PATH>`"""
         self._ensure_client()
+        background, line = _parse_bg(line)
         filename = eval(line)
         with open(filename, encoding='utf-8') as f:
             script = f.read()
+        if background:
+            return self._run_in_background(background, script)
         try:
-            return self.client.run(script, self.params)
+            return self._preview_when_shown(self.client.run(script, self.params))
         except QueryException as e:
             return e
 
@@ -128,25 +242,104 @@ class CozoMagics(Magics):
 
     @line_magic
     def cozo_import_local_file(self, line):
-        """Import data saved in a local file"""
+        """Import data saved in a local file, in the format of `export_relations`
+
+        The file is read and imported in chunks of rows, returns the number of rows imported per relation.
+        """
         self._ensure_client()
         file = eval(line)
         with open(file, encoding='utf-8') as f:
-            data = json.load(f)
-
-        self.client.import_relations(data)
-
+            return self._import_stream(f)
 
     @line_magic
     def cozo_import_remote_file(self, line):
-        """Import data saved in a local file"""
+        """Import data saved in a remote file, in the format of `export_relations`
+
+        The file is downloaded and imported in chunks of rows, returns the number of rows imported per relation.
+        """
+        import io
         import requests
         self._ensure_client()
         url = eval(line)
-        resp = requests.get(url)
-        resp.raise_for_status()
-        data = resp.json()
-        self.client.import_relations(data)
+        with requests.get(url, stream=True) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            # keep the body readable to its end, `io.TextIOWrapper` fails on a body that closed itself
+            resp.raw.auto_close = False
+            return self._import_stream(io.TextIOWrapper(resp.raw, encoding='utf-8'))
+
+    def _import_stream(self, f):
+        from pycozo.transfer import iter_json_export
+
+        counts = {}
+        for relation, headers, rows in iter_json_export(f, self.display_config['import_chunk_rows']):
+            self.client.import_relations({relation: {'headers': headers, 'rows': rows}})
+            counts[relation] = counts.get(relation, 0) + len(rows)
+        return counts
+
+
+DEFAULT_CONFIG = {
+    'preview_rows': 20,
+    'style': True,
+    'page_size': 50,
+    'import_chunk_rows': 10000,
+}
+
+
+def _parse_bg(line):
+    """Split the `--bg <VARIABLE>` option off the arguments of a magic: returns the variable, or None if the option
+    is absent, and the remaining arguments."""
+    args = line.strip()
+    if not args.startswith('--bg'):
+        return None, args
+    parts = args[len('--bg'):].split(maxsplit=1)
+    if not parts:
+        raise Exception('--bg needs the name of the variable to store the result in')
+    return parts[0], parts[1] if len(parts) > 1 else ''
+
+
+class ResultPreview:
+    """Displays the first and last rows of a result dataframe, with its size.
+
+    Styling and HTML rendering cost time per cell, so only the rows shown are styled and rendered.
+    """
+
+    def __init__(self, df, rows, style=True, caption=None):
+        self.df = df
+        self.rows = rows
+        self.style = style
+        self.caption = caption
+
+    def _preview(self):
+        n = len(self.df)
+        if n <= self.rows:
+            return self.df, f'{n} rows × {len(self.df.columns)} columns'
+        import pandas
+
+        head = (self.rows + 1) // 2
+        tail = self.rows - head
+        parts = [self.df.iloc[:head]] + ([self.df.iloc[n - tail:]] if tail else [])
+        return pandas.concat(parts), (f'{n} rows × {len(self.df.columns)} columns, '
+                                      f'showing the first {head} and last {tail}')
+
+    def _repr_html_(self):
+        preview, summary = self._preview()
+        summary = self.caption or summary
+        if self.style:
+            try:
+                styler = preview.style
+                # `Styler.applymap` was renamed to `Styler.map` in pandas 2.1
+                colour = styler.map if hasattr(styler, 'map') else styler.applymap
+                return colour(_colour_code_type).to_html() + f'<p>{summary}</p>'
+            except Exception:
+                # e.g. jinja2, which styling needs, is not installed
+                pass
+        return preview.to_html() + f'<p>{summary}</p>'
+
+    def __repr__(self):
+        preview, summary = self._preview()
+        return f'{preview.to_string()}\n\n[{self.caption or summary}]'
+
 
 def _colour_code_type(val):
     if isinstance(val, int) or isinstance(val, float):
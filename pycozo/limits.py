@@ -0,0 +1,154 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Limits on the size of query results, and accounting of the memory they take.
+
+With `max_rows` or `max_bytes`, given to `Client.run` or as defaults to the client, a query whose result is
+larger fails with `ResultTooLarge` instead. When the script is a single query that writes to no stored relation
+and has no `:limit` of its own, `:limit <max_rows + 1>` is added to it, so that the database stops one row past
+the limit. Results from remote databases are parsed while they are received when `max_bytes` is given or the
+limit could not be added, and the connection is dropped as soon as a limit is exceeded. The embedded engine
+hands over its results whole, so they are only checked once received.
+
+Sizes in bytes are estimates of the memory taken by the rows as Python lists and values. A client given an
+`on_result` hook calls it after each `run` with a dict of:
+
+* `script`: the script of the query,
+* `rows`: the number of rows of the result, or of those received before a limit was exceeded,
+* `bytes`: the estimated size of these rows,
+* `output_bytes`: the size of the returned DataFrame or Arrow table, None for dicts,
+* `seconds`: the time taken by the query, including the conversion of its result,
+* `caller`: the `file:line` the query was run from, outside pycozo,
+* `exceeded`: whether the query failed with `ResultTooLarge`.
+
+The queries sent by `get_many`, `search_many` and `AsOf.run` are limited by the defaults of the client and
+reported to the hook like those of `run`, with an `output_bytes` of None. `get_many` limits the rows it fetches,
+not those it takes from its cache, and `AsOf.run` checks cached results against the limits without reporting them.
+"""
+
+import re
+import sys
+
+from pycozo.client import _is_query, _with_timeout
+from pycozo.transfer import _stream_query
+
+# store options, with which an added `:limit` would change what is written
+_WRITES_RE = re.compile(r'(?<![\w:]):(?:create|replace|put|insert|update|rm|delete|ensure|ensure_not|returning)\b')
+
+_LIMIT_RE = re.compile(r'(?<![\w:]):limit\b')
+
+
+class ResultTooLarge(RuntimeError):
+    """Raised when the result of a query has more rows or takes more bytes than allowed.
+
+    `rows` and `bytes` are the number of rows received, and their estimated size if it was measured,
+    when the limit was exceeded."""
+
+    def __init__(self, message, rows, bytes=None):
+        super().__init__(message)
+        self.rows = rows
+        self.bytes = bytes
+
+
+def run_limited(client, script, params, immutable, timeout, max_rows=None, max_bytes=None):
+    """Run a query for `client`, failing with `ResultTooLarge` if its result exceeds the limits"""
+    limited = with_row_limit(script, max_rows)
+    stream = max_bytes is not None or (max_rows is not None and limited is script)
+    if client.embedded is None and stream and (timeout is None or _with_timeout(limited, timeout) is not None):
+        guard = _Guard(max_rows, max_bytes, keep=True)
+        timed = limited if timeout is None else _with_timeout(limited, timeout)
+        res = _stream_query(client, timed, params, immutable, timeout, guard)
+        res['rows'] = guard.rows
+        return res
+    res = client._execute(limited, params, immutable, timeout)
+    check_result(res, max_rows, max_bytes)
+    return res
+
+
+def with_row_limit(script, max_rows):
+    """The script with `:limit <max_rows + 1>` added if that cannot change its result, and otherwise itself"""
+    if max_rows is None or not _is_query(script):
+        return script
+    if _LIMIT_RE.search(script) or _WRITES_RE.search(script):
+        return script
+    return f'{script}\n:limit {max_rows + 1}'
+
+
+def check_result(res, max_rows, max_bytes):
+    """Raise `ResultTooLarge` if a result received whole exceeds the limits"""
+    if max_rows is not None or max_bytes is not None:
+        guard = _Guard(max_rows, max_bytes, keep=False)
+        for row in res['rows']:
+            guard.add(row)
+
+
+def check_rows(n_rows, max_rows):
+    if max_rows is not None and n_rows > max_rows:
+        raise ResultTooLarge(f'The result has more than {max_rows} rows', n_rows)
+
+
+def accounting(script, res, output, seconds, caller, exceeded=None):
+    """The dict given to the `on_result` hook of a client"""
+    if exceeded is not None:
+        rows, size = exceeded.rows, exceeded.bytes
+    else:
+        rows, size = len(res['rows']), None
+    if size is None and res is not None:
+        size = _size_of(res['rows'])
+    return {'script': script, 'rows': rows, 'bytes': size, 'output_bytes': _output_bytes(output),
+            'seconds': seconds, 'caller': caller, 'exceeded': exceeded is not None}
+
+
+def caller():
+    """`file:line` of the innermost frame outside pycozo"""
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        # the tests live in the package, but are callers like any other
+        if not module.startswith('pycozo.') or module.rsplit('.', 1)[-1].startswith('test_'):
+            return f'{frame.f_code.co_filename}:{frame.f_lineno}'
+        frame = frame.f_back
+    return None
+
+
+class _Guard:
+    """Counts the rows of a result as they are received, raising once a limit is exceeded"""
+
+    def __init__(self, max_rows, max_bytes, keep):
+        self.headers = None
+        self.rows = []
+        self.count = 0
+        self.bytes = 0
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._keep = keep
+
+    def add(self, row):
+        self.count += 1
+        if self._max_rows is not None and self.count > self._max_rows:
+            raise ResultTooLarge(f'The result has more than {self._max_rows} rows', self.count)
+        if self._max_bytes is not None:
+            self.bytes += _size_of(row)
+            if self.bytes > self._max_bytes:
+                raise ResultTooLarge(f'The result takes more than {self._max_bytes} bytes', self.count,
+                                     self.bytes)
+        if self._keep:
+            self.rows.append(row)
+
+
+def _output_bytes(output):
+    if output is None or isinstance(output, dict):
+        return None
+    if hasattr(output, 'memory_usage'):
+        return int(output.memory_usage(deep=True).sum())
+    return getattr(output, 'nbytes', None)
+
+
+def _size_of(value):
+    """The approximate memory taken by a row or value"""
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+    return sys.getsizeof(value)
@@ -0,0 +1,360 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Load testing of a database through `Client` with a mix of operations.
+
+    python -m pycozo.loadtest spec.json [--duration S] [--rate R] [--threads N] [--json]
+
+The workload spec is a JSON object:
+
+    {
+      "engine": "mem", "path": "", "options": {},
+      "setup": [":create kv {k: Int => v: String}"],
+      "duration": 10, "rate": 500, "threads": 8,
+      "operations": [
+        {"name": "get", "kind": "run", "weight": 8, "immutable": true,
+         "script": "?[v] := *kv{k: $k, v}", "params": {"k": "$randint:0:9999"}},
+        {"name": "put", "kind": "put", "weight": 2, "relation": "kv", "rows": 10,
+         "row": {"k": "$randint:0:9999", "v": "$randstr:16"}},
+        {"name": "tx", "kind": "transact", "weight": 1, "write": true,
+         "scripts": [{"script": "?[k, v] <- [[$k, 'x']] :put kv {k => v}", "params": {"k": "$seq"}}]}
+      ],
+      "subscribers": [{"relation": "kv", "count": 1}],
+      "scheduler": {"max_concurrency": 4, "classes": {"interactive": {}, "batch": {"rate": 50}}}
+    }
+
+Operations are picked at random in proportion to their weights. Kinds are `run` (a query, `immutable` defaults
+to false), `put`, `rm` and `update` (`rows` rows built from the `row` template), and `transact` (the `scripts`
+in one `multi_transact`, committed at the end). String values starting with `$` in params and row templates are
+generated per operation: `$seq` (a counter), `$randint:lo:hi`, `$randfloat`, and `$randstr:n`. Write `$$` for a
+literal leading `$`.
+
+With a `scheduler`, the client admits calls through a `pycozo.scheduler.Scheduler` built from these arguments,
+and operations run in the priority class given by their `priority` key. The report then includes the queue
+depths and admission waits per class.
+
+With a `rate`, operations are scheduled at that total rate regardless of how fast they complete, and latencies
+are measured from the scheduled time, so that a saturated database shows up as growing latencies rather than
+as silently fewer requests. Without a rate, every thread runs operations back to back.
+
+For the 'http' engine, give the options of the engine, e.g. `"options": {"host": "http://127.0.0.1:9070"}`.
+"""
+
+import json
+import math
+import queue
+import random
+import string
+import threading
+import time
+
+_KINDS = ('run', 'put', 'rm', 'update', 'transact')
+
+
+def run_workload(spec, client=None):
+    """Run a workload spec (a dict as described in the module documentation) and return its report.
+
+    :param client: the client to run against. If not given, one is created from the `engine`, `path` and
+                   `options` of the spec, and closed at the end.
+    :return: a dict with the overall throughput, per-operation counts, errors and latency percentiles in
+             milliseconds, events received by subscribers, and the CPU and memory used by this process.
+    """
+    from pycozo.client import Client
+
+    operations = [_Operation(op) for op in spec['operations']]
+    if not operations:
+        raise ValueError('The workload has no operations')
+    own_client = client is None
+    if own_client:
+        scheduler = None
+        if spec.get('scheduler') is not None:
+            from pycozo.scheduler import Scheduler
+
+            scheduler = Scheduler(**spec['scheduler'])
+        client = Client(spec.get('engine', 'mem'), spec.get('path', ''), spec.get('options'), dataframe=False,
+                        scheduler=scheduler)
+    if client.embedded and spec.get('subscribers') and any(op.kind == 'transact' for op in operations):
+        if own_client:
+            client.close()
+        raise ValueError('Embedded databases cannot run transactions while change callbacks are registered, '
+                         'drop either the subscribers or the transact operations')
+    duration = spec.get('duration', 10)
+    rate = spec.get('rate')
+    threads = spec.get('threads', 4)
+    try:
+        for script in spec.get('setup', []):
+            client.run(script)
+        events = {}
+        callbacks = []
+        for sub in spec.get('subscribers', []):
+            for _ in range(sub.get('count', 1)):
+                relation = sub['relation']
+                events.setdefault(relation, 0)
+                callbacks.append(client.register_callback(relation, _counter(events, relation)))
+        usage = _Usage()
+        if rate:
+            samples = _open_loop(client, operations, duration, rate, threads)
+        else:
+            samples = _closed_loop(client, operations, duration, threads)
+        report = _report(operations, samples, usage.stop())
+        for cb_id in callbacks:
+            client.unregister_callback(cb_id)
+        report['subscriber_events'] = dict(events)
+        report['scheduler'] = client.scheduler_stats()
+        return report
+    finally:
+        if own_client:
+            client.close()
+
+
+class _Operation:
+    def __init__(self, spec):
+        self.kind = spec.get('kind', 'run')
+        if self.kind not in _KINDS:
+            raise ValueError(f'Unknown operation kind {self.kind!r}, expected one of {_KINDS}')
+        self.name = spec.get('name', self.kind)
+        self.weight = spec.get('weight', 1)
+        self.priority = spec.get('priority')
+        self.spec = spec
+
+    def __call__(self, client, gen):
+        if self.priority is None:
+            return self._call(client, gen)
+        with client.priority(self.priority):
+            return self._call(client, gen)
+
+    def _call(self, client, gen):
+        spec = self.spec
+        if self.kind == 'run':
+            client.run(spec['script'], gen.fill(spec.get('params', {})), immutable=spec.get('immutable', False))
+        elif self.kind == 'transact':
+            with client.multi_transact(spec.get('write', False)) as tx:
+                for step in spec['scripts']:
+                    if isinstance(step, str):
+                        step = {'script': step}
+                    tx.run(step['script'], gen.fill(step.get('params', {})))
+                tx.commit()
+        else:
+            rows = [gen.fill(spec['row']) for _ in range(spec.get('rows', 1))]
+            getattr(client, self.kind)(spec['relation'], rows)
+
+
+class _Generator:
+    """Fills in the `$` placeholders of params and row templates"""
+
+    def __init__(self, seed=None):
+        self._random = random.Random(seed)
+
+    _seq = 0
+    _seq_lock = threading.Lock()
+
+    def fill(self, template):
+        if isinstance(template, dict):
+            return {k: self.fill(v) for k, v in template.items()}
+        elif isinstance(template, list):
+            return [self.fill(v) for v in template]
+        elif isinstance(template, str) and template.startswith('$'):
+            return self._value(template[1:])
+        return template
+
+    def _value(self, placeholder):
+        name, *args = placeholder.split(':')
+        if placeholder.startswith('$'):
+            return placeholder
+        elif name == 'seq':
+            with _Generator._seq_lock:
+                _Generator._seq += 1
+                return _Generator._seq
+        elif name == 'randint':
+            return self._random.randint(int(args[0]), int(args[1]))
+        elif name == 'randfloat':
+            return self._random.random()
+        elif name == 'randstr':
+            return ''.join(self._random.choices(string.ascii_letters, k=int(args[0])))
+        raise ValueError(f'Unknown placeholder ${placeholder}')
+
+
+def _counter(events, relation):
+    lock = threading.Lock()
+
+    def callback(op, new_rows, old_rows):
+        with lock:
+            events[relation] += 1
+
+    return callback
+
+
+def _pick(operations, rnd):
+    return rnd.choices(operations, weights=[op.weight for op in operations])[0]
+
+
+def _execute(client, op, gen, scheduled, samples):
+    start = time.perf_counter()
+    error = None
+    try:
+        op(client, gen)
+    except Exception as e:
+        error = str(e)
+    end = time.perf_counter()
+    # (name, error or None, latency from the scheduled start, time spent running)
+    samples.append((op.name, error, end - (scheduled if scheduled is not None else start), end - start))
+
+
+def _closed_loop(client, operations, duration, threads):
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    def work(seed):
+        gen = _Generator(seed)
+        rnd = random.Random(seed)
+        while time.perf_counter() < deadline:
+            _execute(client, _pick(operations, rnd), gen, None, samples)
+
+    _run_threads(work, threads)
+    return samples, duration
+
+
+def _open_loop(client, operations, duration, rate, threads):
+    samples = []
+    jobs = queue.Queue()
+    rnd = random.Random(0)
+
+    def work(seed):
+        gen = _Generator(seed)
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            _execute(client, job[0], gen, job[1], samples)
+
+    workers = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(threads)]
+    for t in workers:
+        t.start()
+    start = time.perf_counter()
+    n = 0
+    while True:
+        scheduled = start + n / rate
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        jobs.put((_pick(operations, rnd), scheduled))
+        n += 1
+    for _ in workers:
+        jobs.put(None)
+    for t in workers:
+        t.join()
+    return samples, time.perf_counter() - start
+
+
+def _run_threads(fn, n):
+    workers = [threading.Thread(target=fn, args=(i,), daemon=True) for i in range(n)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+
+class _Usage:
+    """CPU time and peak memory of this process over a run"""
+
+    def __init__(self):
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def stop(self):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        usage = {'cpu_seconds': cpu, 'cpu_utilization': cpu / wall if wall else 0.0}
+        try:
+            import resource
+            import sys
+
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # kilobytes on Linux, bytes on macOS
+            usage['peak_rss_mb'] = peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        except ImportError:
+            usage['peak_rss_mb'] = None
+        return usage
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # nearest rank
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def _summary(samples, elapsed):
+    latencies = sorted(s[2] for s in samples if s[1] is None)
+    errors = [s[1] for s in samples if s[1] is not None]
+    summary = {'count': len(samples), 'errors': len(errors),
+               'throughput': len(latencies) / elapsed if elapsed else 0.0,
+               'first_error': errors[0] if errors else None}
+    for p in (50, 90, 99):
+        value = _percentile(latencies, p)
+        summary[f'p{p}_ms'] = value * 1000 if value is not None else None
+    summary['max_ms'] = latencies[-1] * 1000 if latencies else None
+    return summary
+
+
+def _report(operations, samples, usage):
+    samples, elapsed = samples
+    per_op = {}
+    for op in operations:
+        if op.name not in per_op:
+            per_op[op.name] = _summary([s for s in samples if s[0] == op.name], elapsed)
+    total = _summary(samples, elapsed)
+    return {'elapsed_seconds': elapsed, 'total': total, 'operations': per_op, 'client': usage}
+
+
+def _format_report(report):
+    def ms(value):
+        return f'{value:9.2f}' if value is not None else f'{"-":>9}'
+
+    lines = [f'{"operation":16} {"count":>8} {"errors":>7} {"ops/s":>9} {"p50 ms":>9} {"p90 ms":>9} '
+             f'{"p99 ms":>9} {"max ms":>9}']
+    for name, s in list(report['operations'].items()) + [('total', report['total'])]:
+        lines.append(f'{name:16} {s["count"]:8} {s["errors"]:7} {s["throughput"]:9.1f} {ms(s["p50_ms"])} '
+                     f'{ms(s["p90_ms"])} {ms(s["p99_ms"])} {ms(s["max_ms"])}')
+    for name, s in report['operations'].items():
+        if s['first_error']:
+            lines.append(f'first error of {name}: {s["first_error"]}')
+    for relation, n in report['subscriber_events'].items():
+        lines.append(f'subscriber events on {relation}: {n}')
+    for priority, s in (report.get('scheduler') or {}).items():
+        if isinstance(s, dict):
+            lines.append(f'{priority} admissions: {s["admitted"]}, timed out {s["timed_out"]}, '
+                         f'wait p99 {ms(s["wait_p99_ms"]).strip()} ms')
+    client = report['client']
+    rss = f'{client["peak_rss_mb"]:.1f} MB' if client['peak_rss_mb'] is not None else 'unknown'
+    lines.append(f'client CPU {client["cpu_seconds"]:.2f}s ({client["cpu_utilization"] * 100:.0f}% of one core), '
+                 f'peak RSS {rss}')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m pycozo.loadtest', description='Load test a Cozo database.')
+    parser.add_argument('spec', help='the JSON workload spec')
+    parser.add_argument('--duration', type=float, help='seconds to run, overrides the spec')
+    parser.add_argument('--rate', type=float, help='operations per second, overrides the spec, 0 for no limit')
+    parser.add_argument('--threads', type=int, help='number of threads, overrides the spec')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+    with open(args.spec) as f:
+        spec = json.load(f)
+    for key in ('duration', 'rate', 'threads'):
+        if getattr(args, key) is not None:
+            spec[key] = getattr(args, key)
+    report = run_workload(spec)
+    print(json.dumps(report, indent=2) if args.json else _format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Recording query plans, and detecting when they change.
+
+`Client.explain` returns the plan of a query from `::explain`: one row per operation, with the `stratum`, the
+`rule` and the index of its `atom`, the `op` (e.g. `load_stored`, `stored_prefix_join`), the relation it reads
+(`ref`), the columns it joins on, its filters and its output columns.
+
+A `PlanRecorder` given to a client as `plan_recorder` explains some of the queries run with `Client.run`: those
+slower than `slow_ms`, and a random `sample_rate` of the others. The `::explain` runs in the background on the
+query threads of the client, so `run` returns without waiting for it, and `wait` waits for the plans being
+recorded. Plans are keyed by the fingerprint of their
+script, in which literal strings and numbers are replaced, so that queries differing only by their constants
+share a key. The first plan of a fingerprint becomes its baseline, and is kept in a JSON file if a path is given.
+Later plans are compared to the baseline, ignoring their filters, and differences are reported as changes:
+
+* `lost_index` / `new_index`: an index relation (`rel:index`) that the baseline read is not read anymore, or
+  the reverse,
+* `join_order`: a rule reads the same relations in a different order,
+* `plan_changed`: other differences of the operations of a rule, or rules added or removed.
+
+Changes are logged as warnings, passed to the `on_change` hook and listed by `changes`, until the new plan is
+accepted as the baseline with `accept`.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+from pycozo.client import _is_query
+
+logger = logging.getLogger(__name__)
+
+# changes kept by `PlanRecorder.changes`
+_MAX_CHANGES = 1000
+
+_LITERAL_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|(?<![\w$])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+
+
+def explain_script(script):
+    """The `::explain` script of a query"""
+    return f'::explain {{\n{script}\n}}'
+
+
+def fingerprint(script):
+    """A key shared by the scripts differing only by whitespace and literal strings and numbers"""
+    normalized = ' '.join(_LITERAL_RE.sub('?', script).split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+def compare_plans(before, after):
+    """The changes from one plan to another, as a list of dicts with a `kind`, the `rule` if the change is
+    limited to one, and what it was `before` and is `after`.
+
+    :param before: a plan, as returned by `Client.explain` for `dataframe=False` clients.
+    :param after: another plan.
+    """
+    changes = []
+    before_indexes = _index_refs(before)
+    after_indexes = _index_refs(after)
+    for ref in sorted(before_indexes - after_indexes):
+        changes.append({'kind': 'lost_index', 'rule': None, 'before': ref, 'after': None})
+    for ref in sorted(after_indexes - before_indexes):
+        changes.append({'kind': 'new_index', 'rule': None, 'before': None, 'after': ref})
+    before_rules = _rules(before)
+    after_rules = _rules(after)
+    for rule in sorted(before_rules.keys() | after_rules.keys(), key=repr):
+        old = before_rules.get(rule)
+        new = after_rules.get(rule)
+        if old == new:
+            continue
+        if old is not None and new is not None:
+            old_refs = [ref for _, ref, _ in old if ref is not None]
+            new_refs = [ref for _, ref, _ in new if ref is not None]
+            if old_refs != new_refs and sorted(old_refs) == sorted(new_refs):
+                changes.append({'kind': 'join_order', 'rule': rule[1], 'before': old_refs, 'after': new_refs})
+                continue
+        changes.append({'kind': 'plan_changed', 'rule': rule[1], 'before': _ops(old), 'after': _ops(new)})
+    return changes
+
+
+class PlanRecorder:
+    """Records the plans of sampled or slow queries, and reports those that changed from their baseline.
+
+    >>> from pycozo.client import Client
+    >>> recorder = PlanRecorder(slow_ms=0)
+    >>> db = Client(dataframe=False, plan_recorder=recorder)
+    >>> _ = db.run('?[k, v] <- [[1, "a"]] :create kv {k => v}')
+    >>> _ = db.run('?[v] := *kv{k: 1, v}')
+    >>> recorder.wait()
+    True
+    >>> recorder.baselines()[fingerprint('?[v] := *kv{k: 1, v}')]['script']
+    '?[v] := *kv{k: 1, v}'
+    >>> recorder.record(db, '?[v] := *kv{k: 2, v}')
+    []
+    """
+
+    def __init__(self, path=None, sample_rate=0.0, slow_ms=None, min_interval=60.0, on_change=None, seed=None):
+        """
+        :param path: a JSON file keeping the baselines, loaded if it exists. Only in memory if None.
+        :param sample_rate: the fraction of the queries, faster than `slow_ms`, whose plan is recorded.
+        :param slow_ms: the plans of queries taking at least this many milliseconds are always recorded.
+        :param min_interval: seconds during which a fingerprint is not explained again after being recorded.
+        :param on_change: if given, called with each change, a dict as returned by `compare_plans` with the
+                          `fingerprint` and `script` of the query added. Exceptions raised by it are logged.
+        :param seed: the seed of the random sampling.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.min_interval = min_interval
+        self.on_change = on_change
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._baselines = {}
+        self._latest = {}
+        self._last_recorded = {}
+        self._changes = deque(maxlen=_MAX_CHANGES)
+        self._pending = set()
+        if path is not None and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._baselines = json.load(f)['plans']
+
+    def observe(self, client, script, params, seconds):
+        """Record the plan of a query just run by `client` in the background if it is slow or sampled.
+        Called by `Client.run`."""
+        if not _is_query(script):
+            return
+        slow = self.slow_ms is not None and seconds * 1000 >= self.slow_ms
+        with self._lock:
+            if not slow and not (self.sample_rate and self._random.random() < self.sample_rate):
+                return
+            key = fingerprint(script)
+            last = self._last_recorded.get(key)
+            if last is not None and time.monotonic() - last < self.min_interval:
+                return
+            self._last_recorded[key] = time.monotonic()
+        try:
+            future = client._pool().submit(self._record_logged, client, script, params)
+        except RuntimeError:
+            # the client was closed
+            return
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._discard_pending)
+
+    def wait(self, timeout=None):
+        """Wait until the plans being recorded in the background are recorded.
+
+        :return: whether all of them were, False if `timeout` seconds passed first.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        return not futures.wait(pending, timeout).not_done
+
+    def _record_logged(self, client, script, params):
+        try:
+            self.record(client, script, params)
+        except Exception:
+            logger.debug('Could not record the plan of a query', exc_info=True)
+
+    def _discard_pending(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def record(self, client, script, params=None):
+        """Explain a query now and compare its plan to the baseline of its fingerprint.
+
+        :return: the changes from the baseline, empty if there is none yet, in which case the plan becomes it,
+                 or if the changes were already reported.
+        """
+        plan = client._run_raw(explain_script(script), params, immutable=True)
+        plan = {'headers': plan['headers'], 'rows': plan['rows']}
+        key = fingerprint(script)
+        with self._lock:
+            baseline = self._baselines.get(key)
+            if baseline is None:
+                self._baselines[key] = {'script': script, 'recorded_at': time.time(), **plan}
+                self._save()
+                return []
+            # plans are compared without their filters, which carry the constants of the query
+            if _structure(plan) == _structure(self._latest.get(key, baseline)):
+                return []
+            self._latest[key] = plan
+            changes = [{'fingerprint': key, 'script': script, **change} for change in compare_plans(baseline, plan)]
+            self._changes.extend(changes)
+        for change in changes:
+            logger.warning(f'Plan of query {key} changed ({change["kind"]}): {change["before"]} -> '
+                           f'{change["after"]}')
+            if self.on_change is not None:
+                try:
+                    self.on_change(change)
+                except Exception:
+                    logger.exception('Plan change hook failed')
+        return changes
+
+    def baselines(self):
+        """Dict from fingerprints to their baseline: the `script`, the time it was `recorded_at`, and the
+        `headers` and `rows` of its plan"""
+        with self._lock:
+            return {key: dict(entry) for key, entry in self._baselines.items()}
+
+    def changes(self):
+        """The changes reported so far and not accepted, oldest first"""
+        with self._lock:
+            return list(self._changes)
+
+    def accept(self, fingerprint=None):
+        """Make the latest plan of the fingerprint, or of all fingerprints if None, its baseline"""
+        with self._lock:
+            keys = list(self._latest) if fingerprint is None else [fingerprint]
+            for key in keys:
+                plan = self._latest.pop(key, None)
+                if plan is not None:
+                    self._baselines[key] = {**self._baselines[key], 'recorded_at': time.time(), **plan}
+            self._changes = deque((c for c in self._changes if c['fingerprint'] not in keys), maxlen=_MAX_CHANGES)
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'plans': self._baselines}, f)
+        os.replace(tmp, self.path)
+
+
+def _columns(plan):
+    headers = plan['headers']
+    return [dict(zip(headers, row)) for row in plan['rows']]
+
+
+def _index_refs(plan):
+    return {row['ref'] for row in _columns(plan) if row['ref'] and row['ref'].count(':') > 1}
+
+
+def _rules(plan):
+    """Dict from (stratum, rule) to the (op, ref, join columns) of the operations of the rule, in order"""
+    rules = {}
+    for row in _columns(plan):
+        joins = sorted((row.get('joins_on') or {}).items())
+        rules.setdefault((row['stratum'], row['rule']), []).append((row['op'], row['ref'], joins))
+    return rules
+
+
+def _structure(plan):
+    return sorted(_rules(plan).items(), key=repr)
+
+
+def _ops(operations):
+    if operations is None:
+        return None
+    return [op if ref is None else f'{op} {ref}' for op, ref, _ in operations]
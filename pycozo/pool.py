@@ -0,0 +1,292 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Sharing a client between many concurrent callers.
+
+`ClientPool` wraps one `Client` (which is itself thread-safe, see its documentation) and adds admission rules:
+at most `max_readers` immutable queries run at once, and writes, including write transactions,
+are serialized and queued in arrival order.
+
+`ProcessPoolClient` goes further and runs queries in worker processes, each with its own handle on the same
+database file, so that the Python-side work of many queries is not limited by the GIL of a single process.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from pycozo.client import QueryException
+
+
+class ClientPool:
+    """Hands out read and write sessions over a shared client.
+
+    >>> from pycozo.client import Client
+    >>> pool = ClientPool(Client(dataframe=False), max_readers=8)
+    >>> _ = pool.run(':create kv {k => v}')
+    >>> _ = pool.run('?[k, v] <- [[1, 2]] :put kv {k => v}')
+    >>> with pool.reader() as session:
+    ...     session.run('?[v] := *kv{k: 1, v}')['rows']
+    [[2]]
+    >>> pool.close()
+    """
+
+    def __init__(self, client, max_readers=None, max_writers=1):
+        """
+        :param client: the client to share.
+        :param max_readers: the maximum number of concurrent immutable queries, unbounded if None.
+        :param max_writers: the maximum number of concurrent writes. The default of 1 serializes writers,
+                            which avoids write-write conflicts and lock contention inside the storage engine.
+        """
+        self.client = client
+        self._readers = threading.BoundedSemaphore(max_readers) if max_readers else None
+        self._writers = _FifoSemaphore(max_writers)
+        self._stats_lock = threading.Lock()
+        self._stats = {'reads': 0, 'writes': 0, 'active_readers': 0, 'peak_readers': 0, 'write_wait_seconds': 0.0}
+
+    @contextmanager
+    def reader(self):
+        """Context manager holding a read slot, yielding a session whose queries all run as immutable."""
+        if self._readers:
+            self._readers.acquire()
+        with self._stats_lock:
+            self._stats['active_readers'] += 1
+            self._stats['peak_readers'] = max(self._stats['peak_readers'], self._stats['active_readers'])
+        try:
+            yield _Session(self, immutable=True)
+        finally:
+            with self._stats_lock:
+                self._stats['active_readers'] -= 1
+            if self._readers:
+                self._readers.release()
+
+    @contextmanager
+    def writer(self, timeout=None):
+        """Context manager holding a write slot, yielding a session for mutating queries.
+
+        :param timeout: seconds to wait for the slot before raising `TimeoutError`, forever if None.
+        """
+        start = time.monotonic()
+        if not self._writers.acquire(timeout):
+            raise TimeoutError('Timed out waiting for a write slot')
+        with self._stats_lock:
+            self._stats['write_wait_seconds'] += time.monotonic() - start
+        try:
+            yield _Session(self, immutable=False)
+        finally:
+            self._writers.release()
+
+    def run(self, script, params=None, immutable=False, **kwargs):
+        """Same as `Client.run`, in a read slot if `immutable` is true, in a write slot otherwise."""
+        with (self.reader() if immutable else self.writer()) as session:
+            return session.run(script, params, **kwargs)
+
+    @contextmanager
+    def transact(self, write=False):
+        """Context manager for a transaction of the shared client.
+
+        Write transactions hold a write slot until they finish, read transactions a read slot.
+        The transaction is aborted on exit unless it was committed.
+        """
+        with (self.writer() if write else self.reader()):
+            with self.client.multi_transact(write) as tx:
+                yield tx
+
+    def outstanding_transactions(self):
+        """The transactions of the shared client that are neither committed nor aborted yet."""
+        return self.client.outstanding_transactions()
+
+    def stats(self):
+        """Counters of the pool: queries run, current and peak concurrent readers, total time writers waited."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def close(self):
+        """Close the shared client, aborting its outstanding transactions."""
+        self.client.close()
+
+    def _count(self, kind):
+        with self._stats_lock:
+            self._stats[kind] += 1
+
+
+class _Session:
+    def __init__(self, pool, immutable):
+        self._pool = pool
+        self._immutable = immutable
+
+    def run(self, script, params=None, **kwargs):
+        self._pool._count('reads' if self._immutable else 'writes')
+        return self._pool.client.run(script, params, immutable=self._immutable, **kwargs)
+
+
+class _FifoSemaphore:
+    """A semaphore whose waiters are served in arrival order, so that writers are queued fairly."""
+
+    def __init__(self, value):
+        self._value = value
+        self._cond = threading.Condition()
+        self._waiters = []
+
+    def acquire(self, timeout=None):
+        ticket = object()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._waiters.append(ticket)
+            while self._waiters[0] is not ticket or self._value <= 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiters.remove(ticket)
+                    self._cond.notify_all()
+                    return False
+                self._cond.wait(remaining)
+            self._waiters.pop(0)
+            self._value -= 1
+            self._cond.notify_all()
+            return True
+
+    def release(self):
+        with self._cond:
+            self._value += 1
+            self._cond.notify_all()
+
+
+class ProcessPoolClient:
+    """Routes immutable queries to a pool of reader processes and all other queries to one writer process.
+
+    Every process opens its own handle on the database at `path`. This needs an engine whose files can be opened
+    by several processes at once, which currently means 'sqlite': 'rocksdb' locks its directory for one process,
+    and 'mem' databases are private to their process.
+
+    Results travel back as pickled columns rather than rows, which is cheaper to pickle and is the layout pandas
+    builds its columns from.
+
+    >>> import tempfile, os
+    >>> path = os.path.join(tempfile.mkdtemp(), 'db.sqlite')
+    >>> with ProcessPoolClient('sqlite', path, workers=2, dataframe=False) as db:
+    ...     _ = db.run('?[k, v] <- [[1, "a"], [2, "b"]] :create kv {k => v}')
+    ...     db.run('?[k, v] := *kv{k, v}', immutable=True)['rows']
+    [[1, 'a'], [2, 'b']]
+    """
+
+    def __init__(self, engine, path, workers=None, options=None, *, dataframe=True):
+        """
+        :param engine: the storage engine, must be 'sqlite'.
+        :param path: the path of the database.
+        :param workers: the number of reader processes, defaults to the number of CPUs.
+        :param options: options for the database, as for `Client`.
+        :param dataframe: if true, output will be transformed into pandas dataframes.
+        """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        if engine != 'sqlite':
+            raise ValueError(f'ProcessPoolClient needs a database that several processes can open, '
+                             f'which the {engine!r} engine does not support')
+        self.pandas = None
+        if dataframe:
+            try:
+                import pandas
+                self.pandas = pandas
+            except ImportError:
+                pass
+        context = multiprocessing.get_context('spawn')
+        init_args = (engine, path, options)
+        # the writer is started first so that it creates the database before any reader opens it
+        self._writer = ProcessPoolExecutor(1, mp_context=context, initializer=_init_worker, initargs=init_args)
+        self._writer.submit(_worker_ping).result()
+        self._readers = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                            initargs=init_args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def run(self, script, params=None, immutable=False, dtypes=None):
+        """Same as `Client.run`. Immutable queries run in a reader process, others in the writer process."""
+        executor = self._readers if immutable else self._writer
+        error, headers, columns = executor.submit(_worker_run, script, params, immutable).result()
+        if error is not None:
+            raise QueryException(error)
+        if self.pandas:
+            from pycozo.client import _typed_frame_from_columns
+
+            return _typed_frame_from_columns(self.pandas, headers, columns, dtypes or {})
+        return {'headers': headers, 'rows': [list(row) for row in zip(*columns)]}
+
+    def close(self):
+        """Shut down the worker processes, which closes their database handles."""
+        for executor in (self._readers, self._writer):
+            executor.shutdown(wait=True)
+
+
+_worker_client = None
+
+
+def _init_worker(engine, path, options):
+    import atexit
+    from pycozo.client import Client
+
+    global _worker_client
+    _worker_client = Client(engine, path, options, dataframe=False)
+    atexit.register(_worker_client.close)
+
+
+def _worker_ping():
+    return True
+
+
+def _worker_run(script, params, immutable):
+    try:
+        res = _worker_client._run_raw(script, params, immutable)
+    except QueryException as e:
+        # the exception itself does not survive pickling, its payload does
+        return e.resp, None, None
+    headers = res['headers']
+    columns = [list(col) for col in zip(*res['rows'])] if res['rows'] else [[] for _ in headers]
+    return None, headers, columns
+
+
+def _benchmark(engine='mem', path='', rows=200000, seconds=2.0, thread_counts=(1, 2, 4, 8)):
+    """Read throughput of a `ClientPool` for increasing numbers of threads"""
+    import os
+    import tempfile
+    from pycozo.client import Client
+
+    if engine != 'mem' and not path:
+        path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    pool = ClientPool(Client(engine, path, dataframe=False))
+    pool.run(':create bench {k: Int => v: Int}')
+    pool.run('?[k, v] <- $rows :put bench {k => v}', {'rows': [[i, i] for i in range(rows)]})
+    script = '?[sum(v)] := *bench{k, v}, k >= $lo, k < $lo + 5000'
+    results = {}
+    for n in thread_counts:
+        done = [0] * n
+        deadline = time.monotonic() + seconds
+
+        def work(i):
+            while time.monotonic() < deadline:
+                pool.run(script, {'lo': (done[i] * 7919) % rows}, immutable=True)
+                done[i] += 1
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        results[n] = sum(done) / seconds
+    pool.close()
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+
+    for eng in sys.argv[1:] or ['mem', 'sqlite', 'rocksdb']:
+        for n_threads, qps in _benchmark(eng).items():
+            print(f'{eng:8} threads={n_threads:<3} {qps:10.1f} queries/s')
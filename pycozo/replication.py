@@ -0,0 +1,401 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Continuous replication of stored relations from one database to another.
+
+A `Replicator` subscribes to the changes of the source relations, copies them over in key-ordered chunks,
+and then applies the queued and all further changes to the target in batches, in the order they happened.
+Source and target can be embedded or remote clients in any combination: changes arrive through
+`register_callback`, which uses the `/changes` stream for remote databases, and are written with
+`import_relations`, so triggers are _not_ run on the target. The embedded engine only serves the callbacks of
+one relation at a time, so an embedded source is limited to a single relation.
+
+The change feed of Cozo has no durable position to resume from, so each start synchronizes the target by
+comparing it with the source chunk by chunk: only rows that differ are written and rows missing from the source
+are removed. A target that is already up to date is therefore only read, not rewritten.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from pycozo.transfer import iter_relation_chunks
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Replicator:
+    """Keeps relations of a target database in sync with a source database.
+
+    >>> from pycozo.client import Client
+    >>> source, target = Client(dataframe=False), Client(dataframe=False)
+    >>> _ = source.run('?[k, v] <- [[1, "a"]] :create kv {k => v}')
+    >>> with Replicator(source, target, ['kv']) as replicator:
+    ...     _ = source.run('?[k, v] <- [[2, "b"]] :put kv {k => v}')
+    ...     replicator.wait_until_caught_up(timeout=5)
+    ...     target.run('?[k, v] := *kv{k, v}')['rows']
+    True
+    [[1, 'a'], [2, 'b']]
+    """
+
+    def __init__(self, source, target, relations, batch_size=1000, chunk_size=10000, max_rows_per_second=None,
+                 checkpoint_path=None, create_missing=True):
+        """
+        :param source: the client to replicate from.
+        :param target: the client to replicate into.
+        :param relations: names of the stored relations to replicate, in a list.
+        :param batch_size: the maximum number of changed rows written to the target in one import.
+        :param chunk_size: the number of rows compared per chunk during the initial synchronization.
+        :param max_rows_per_second: if given, the rate at which rows are written to the target is limited
+                                    to this, so that catching up on a large backlog does not starve other
+                                    users of the target.
+        :param checkpoint_path: if given, a JSON file where the progress of the replication is saved,
+                                see `checkpoint`.
+        :param create_missing: if true, relations missing from the target are created with the schema
+                               of the source relation. Otherwise they must exist.
+        """
+        self.source = source
+        self.target = target
+        self.relations = list(relations)
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.max_rows_per_second = max_rows_per_second
+        self.checkpoint_path = checkpoint_path
+        self.create_missing = create_missing
+        self._queue = queue.Queue()
+        self._columns = {}
+        self._callbacks = []
+        self._thread = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = 0
+        self._oldest_pending = {}
+        self._throttle_start = None
+        self._throttle_rows = 0
+        self._last_checkpoint = 0.0
+        self._progress = {relation: {'synchronized': False, 'rows_compared': 0, 'rows_written': 0,
+                                     'rows_removed': 0, 'events_applied': 0, 'last_applied_at': None}
+                          for relation in self.relations}
+        self._stats = {'events_received': 0, 'events_applied': 0, 'rows_applied': 0, 'batches': 0,
+                       'last_lag_seconds': 0.0, 'max_lag_seconds': 0.0, 'errors': 0}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stop()
+
+    def start(self):
+        """Subscribe to the source, synchronize the target and start applying changes in the background.
+
+        Returns once the initial synchronization is done. Changes made in the meantime are queued
+        and applied afterwards.
+        """
+        if self._thread is not None:
+            raise RuntimeError('The replicator is already running')
+        if self.source.embedded and len(self.relations) > 1:
+            raise RuntimeError('An embedded source delivers the changes of only one relation at a time, '
+                               'replicate one relation per source process, or replicate from a remote source')
+        for relation in self.relations:
+            columns = self.source._run_raw(f'::columns {relation}', immutable=True)['rows']
+            self._columns[relation] = columns
+            if self.create_missing:
+                self._ensure_target_relation(relation, columns)
+        # subscribe before copying, so that no change is missed: changes that are already part of the copy
+        # are applied a second time, which leaves the same result
+        for relation in self.relations:
+            self._callbacks.append(self.source.register_callback(relation, self._callback_for(relation)))
+        try:
+            for relation in self.relations:
+                self._synchronize(relation)
+        except Exception:
+            self._unsubscribe()
+            raise
+        self._thread = threading.Thread(target=self._apply_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, drain=True):
+        """Stop replicating.
+
+        :param drain: if true, changes received so far are applied before returning, otherwise they are dropped.
+        """
+        self._unsubscribe()
+        if self._thread is None:
+            return
+        if not drain:
+            self._discard_pending()
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._save_checkpoint(force=True)
+
+    def wait_until_caught_up(self, timeout=None):
+        """Wait until all changes received from the source are applied to the target.
+
+        Changes are delivered to callbacks asynchronously, so changes made on the source just before
+        this call may not have been received yet.
+
+        :return: true if the target caught up, false if the timeout elapsed first.
+        """
+        # give in-flight change notifications a moment to arrive
+        time.sleep(0.05)
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def lag(self):
+        """Seconds since the oldest change not yet applied to the target was received, 0.0 if there is none."""
+        with self._lock:
+            if not self._oldest_pending:
+                return 0.0
+            return time.monotonic() - min(self._oldest_pending.values())
+
+    def stats(self):
+        """Counters of the replication: changes received and applied, batches, lag and queue depth."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending_events'] = self._pending
+        stats['lag_seconds'] = self.lag()
+        return stats
+
+    def checkpoint(self):
+        """The progress of the replication per relation.
+
+        For each relation: whether the initial synchronization finished, how many rows it compared, wrote and
+        removed, how many change events were applied since, and the wall-clock time the last one was applied.
+        This is also what is saved to `checkpoint_path`.
+        """
+        with self._lock:
+            return {'relations': {relation: dict(progress) for relation, progress in self._progress.items()},
+                    'saved_at': time.time()}
+
+    def _callback_for(self, relation):
+        def callback(op, new_rows, old_rows):
+            with self._lock:
+                self._pending += 1
+                seq = self._stats['events_received']
+                self._stats['events_received'] += 1
+                received = time.monotonic()
+                self._oldest_pending[seq] = received
+            # for 'Rm', the new rows are the keys that were removed
+            self._queue.put((seq, received, relation, op, new_rows))
+
+        return callback
+
+    def _unsubscribe(self):
+        for cb_id in self._callbacks:
+            self.source.unregister_callback(cb_id)
+        self._callbacks = []
+
+    def _discard_pending(self):
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                self._done([item[0]])
+
+    def _ensure_target_relation(self, relation, columns):
+        existing = self.target._run_raw('::relations', immutable=True)['rows']
+        if any(row[0] == relation for row in existing):
+            return
+        keys = ', '.join(f'{col[0]}: {col[3]}' for col in columns if col[1])
+        values = ', '.join(f'{col[0]}: {col[3]}' for col in columns if not col[1])
+        self.target._run_raw(f':create {relation} {{{keys} => {values}}}')
+
+    def _synchronize(self, relation):
+        """Make the target relation equal to the source relation, writing only what differs."""
+        columns = self._columns[relation]
+        headers = [col[0] for col in columns]
+        keys = [col[0] for col in columns if col[1]]
+        n_keys = len(keys)
+        progress = self._progress[relation]
+        lower = None
+        for _, rows in iter_relation_chunks(self.source, relation, self.chunk_size):
+            upper = rows[-1][:n_keys] if len(rows) == self.chunk_size else None
+            target_rows = self._target_rows(relation, headers, keys, lower, upper)
+            source_rows = {_row_key(row[:n_keys]): row for row in rows}
+            to_put = [row for key, row in source_rows.items() if target_rows.get(key) != row]
+            to_rm = [row[:n_keys] for key, row in target_rows.items() if key not in source_rows]
+            self._write(relation, headers, keys, to_put, to_rm)
+            with self._lock:
+                progress['rows_compared'] += len(rows)
+                progress['rows_written'] += len(to_put)
+                progress['rows_removed'] += len(to_rm)
+            self._save_checkpoint()
+            if upper is None:
+                break
+            lower = upper
+        else:
+            # the source is empty, or its last chunk was exactly full
+            stale = self._target_rows(relation, headers, keys, lower, None)
+            to_rm = [row[:n_keys] for row in stale.values()]
+            self._write(relation, headers, keys, [], to_rm)
+            with self._lock:
+                progress['rows_removed'] += len(to_rm)
+        with self._lock:
+            progress['synchronized'] = True
+        self._save_checkpoint(force=True)
+
+    def _target_rows(self, relation, headers, keys, lower, upper):
+        """Rows of the target relation with keys in `(lower, upper]`, an unset bound being unbounded."""
+        head = ', '.join(headers)
+        key_list = f'[{", ".join(keys)}]'
+        conditions = []
+        params = {}
+        if lower is not None:
+            # the condition on the first key alone lets the engine turn the scan into a range scan
+            conditions += [f'{keys[0]} >= $lower_first', f'{key_list} > $lower']
+            params.update(lower_first=lower[0], lower=lower)
+        if upper is not None:
+            conditions += [f'{keys[0]} <= $upper_first', f'{key_list} <= $upper']
+            params.update(upper_first=upper[0], upper=upper)
+        script = f'?[{head}] := *{relation}{{{head}}}' + ''.join(', ' + c for c in conditions)
+        with self.target._admission(None, 'batch'):
+            rows = self.target._run_raw(script, params, immutable=True)['rows']
+        return {_row_key(row[:len(keys)]): row for row in rows}
+
+    def _write(self, relation, headers, keys, puts, rms):
+        data = {}
+        if puts:
+            data[relation] = {'headers': headers, 'rows': puts}
+        if rms:
+            data['-' + relation] = {'headers': keys, 'rows': rms}
+        if data:
+            self._throttle(len(puts) + len(rms))
+            self.target.import_relations(data)
+
+    def _throttle(self, n_rows):
+        if not self.max_rows_per_second:
+            return
+        now = time.monotonic()
+        if self._throttle_start is None or now - self._throttle_start > 1.0:
+            self._throttle_start, self._throttle_rows = now, 0
+        self._throttle_rows += n_rows
+        ahead = self._throttle_rows / self.max_rows_per_second - (now - self._throttle_start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def _apply_loop(self):
+        stopping = False
+        while not stopping:
+            events = [self._queue.get()]
+            n_rows = len(events[0][4]) if events[0] is not _STOP else 0
+            # take whatever else is already queued, up to the batch size
+            while n_rows < self.batch_size:
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                events.append(event)
+                if event is not _STOP:
+                    n_rows += len(event[4])
+            if events[-1] is _STOP:
+                stopping = True
+            events = [event for event in events if event is not _STOP]
+            for batch in _split_batches(events):
+                self._apply_batch(batch)
+
+    def _apply_batch(self, events):
+        data = {}
+        for _, _, relation, op, rows in events:
+            columns = self._columns[relation]
+            n_keys = sum(1 for col in columns if col[1])
+            if op == 'Put':
+                entry = data.setdefault(relation, {'headers': [col[0] for col in columns], 'rows': {}})
+            else:
+                entry = data.setdefault('-' + relation, {'headers': [col[0] for col in columns[:n_keys]],
+                                                         'rows': {}})
+            for row in rows:
+                # a later change to the same key within a batch wins
+                entry['rows'][_row_key(row[:n_keys])] = row
+        data = {name: {'headers': entry['headers'], 'rows': list(entry['rows'].values())}
+                for name, entry in data.items()}
+        n_rows = sum(len(entry['rows']) for entry in data.values())
+        delay = 0.1
+        while True:
+            try:
+                self._throttle(n_rows)
+                self.target.import_relations(data)
+                break
+            except Exception:
+                with self._lock:
+                    self._stats['errors'] += 1
+                logger.exception(f'Cannot apply {len(events)} changes to the target, retrying in {delay}s')
+                time.sleep(delay)
+                delay = min(delay * 2, 30.0)
+        now = time.monotonic()
+        applied_at = time.time()
+        with self._lock:
+            lag = now - min(event[1] for event in events)
+            self._stats['batches'] += 1
+            self._stats['events_applied'] += len(events)
+            self._stats['rows_applied'] += n_rows
+            self._stats['last_lag_seconds'] = lag
+            self._stats['max_lag_seconds'] = max(self._stats['max_lag_seconds'], lag)
+            for event in events:
+                progress = self._progress[event[2]]
+                progress['events_applied'] += 1
+                progress['last_applied_at'] = applied_at
+        self._done([event[0] for event in events])
+        self._save_checkpoint()
+
+    def _done(self, seqs):
+        with self._idle:
+            for seq in seqs:
+                self._oldest_pending.pop(seq, None)
+            self._pending -= len(seqs)
+            if self._pending == 0:
+                self._idle.notify_all()
+
+    def _save_checkpoint(self, force=False):
+        if not self.checkpoint_path:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint < 1.0:
+            return
+        self._last_checkpoint = now
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.checkpoint(), f)
+        os.replace(tmp, self.checkpoint_path)
+
+
+def _row_key(values):
+    """The key columns of a row as a hashable value, with lists turned into tuples and dicts into frozensets"""
+    if isinstance(values, (list, tuple)):
+        return tuple(_row_key(v) for v in values)
+    if isinstance(values, dict):
+        return frozenset((k, _row_key(v)) for k, v in values.items())
+    return values
+
+
+def _split_batches(events):
+    """Split events into consecutive runs that can each be applied as one import.
+
+    An import applies its puts and removals of a relation in no particular order,
+    so a run ends before a put follows a removal of the same relation, or the other way around.
+    """
+    batches = []
+    batch = []
+    ops = {}
+    for event in events:
+        relation, op = event[2], event[3]
+        if ops.get(relation, op) != op:
+            batches.append(batch)
+            batch = []
+            ops = {}
+        ops[relation] = op
+        batch.append(event)
+    if batch:
+        batches.append(batch)
+    return batches
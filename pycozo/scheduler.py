@@ -0,0 +1,212 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Priority-aware admission control for `Client`.
+
+A `Scheduler` hands out a fixed number of slots to the calls of one or more clients. Each call belongs to a
+priority class, by default 'interactive', 'normal' or 'batch' from highest to lowest. A freed slot goes to the
+oldest waiting call of the highest class that can take it: a class can be held back by its own concurrency limit
+or by its token-bucket rate limit, in which case lower classes may use the slot, so that batch work fills the
+capacity interactive calls leave unused. Running calls are never preempted, so the default limits keep a slot
+free of batch work for the other classes.
+
+Queries run with `run`, `run_batch`, `get_many`, `search_many`, `put_vectors` and `AsOf.run` are admitted in the
+priority class of their call or of the thread, 'normal' by default. Imports, exports, the chunked reads of
+transfers, backups and replication, and the refreshes of materialized views are admitted as 'batch' unless the
+thread sets a class. The lookups of the schema (`::columns`, `::relations`) made by these helpers take no slot.
+
+>>> from pycozo.client import Client
+>>> db = Client(dataframe=False, scheduler=Scheduler(max_concurrency=4))
+>>> db.run('?[x] <- [[1]]', priority='interactive')['rows']
+[[1]]
+>>> db.scheduler_stats()['interactive']['admitted']
+1
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PRIORITIES = ('interactive', 'normal', 'batch')
+
+# waits kept per class for the percentiles of `stats`
+_WAIT_SAMPLES = 1024
+
+
+class Scheduler:
+    """Admission control with priority classes, per-class concurrency and rate limits, and queue timeouts."""
+
+    def __init__(self, max_concurrency=4, classes=None):
+        """
+        :param max_concurrency: the number of calls running at once over all classes.
+        :param classes: a dict from class names, in decreasing priority, to dicts of options:
+                        `max_concurrency` (defaults to all slots, but one for the lowest class),
+                        `rate` (calls admitted per second, unlimited if None), `burst` (the number of calls
+                        that can be admitted at once after an idle period, defaults to the rate) and
+                        `queue_timeout` (seconds a call may wait before failing with `TimeoutError`,
+                        forever if None). Defaults to the classes in `PRIORITIES` without rate limits.
+        """
+        if max_concurrency < 1:
+            raise ValueError('A scheduler needs at least one slot')
+        classes = classes if classes is not None else {name: {} for name in PRIORITIES}
+        if not classes:
+            raise ValueError('A scheduler needs at least one priority class')
+        self.max_concurrency = max_concurrency
+        self._cond = threading.Condition()
+        self._running = 0
+        self._classes = {}
+        names = list(classes)
+        for rank, name in enumerate(names):
+            options = dict(classes[name] or {})
+            if len(names) > 1 and rank == len(names) - 1:
+                options.setdefault('max_concurrency', max(1, max_concurrency - 1))
+            self._classes[name] = _Class(name, max_concurrency, **options)
+
+    @property
+    def priorities(self):
+        """The names of the classes, highest priority first"""
+        return list(self._classes)
+
+    @contextmanager
+    def slot(self, priority='normal', queue_timeout=None):
+        """Context manager holding a slot of the given class for its duration.
+
+        :param queue_timeout: seconds to wait for the slot, the class default if None.
+        """
+        cls = self._acquire(priority, queue_timeout)
+        try:
+            yield
+        finally:
+            self._release(cls)
+
+    def _acquire(self, priority, queue_timeout):
+        cls = self._classes.get(priority)
+        if cls is None:
+            raise ValueError(f'Unknown priority {priority!r}, expected one of {self.priorities}')
+        if queue_timeout is None:
+            queue_timeout = cls.queue_timeout
+        start = time.monotonic()
+        deadline = None if queue_timeout is None else start + queue_timeout
+        ticket = object()
+        with self._cond:
+            cls.waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._admissible(cls, ticket, now):
+                        break
+                    if deadline is not None and now >= deadline:
+                        cls.timed_out += 1
+                        raise TimeoutError(f'Waited more than {queue_timeout} seconds for a {priority} slot')
+                    wait = cls.bucket.time_to_token(now)
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._cond.wait(wait)
+            except BaseException:
+                cls.waiting.remove(ticket)
+                self._cond.notify_all()
+                raise
+            cls.waiting.popleft()
+            cls.bucket.take()
+            cls.running += 1
+            self._running += 1
+            cls.admitted += 1
+            cls.record_wait(time.monotonic() - start)
+            self._cond.notify_all()
+        return cls
+
+    def _admissible(self, cls, ticket, now):
+        if cls.waiting[0] is not ticket or self._running >= self.max_concurrency:
+            return False
+        if not cls.ready(now):
+            return False
+        for other in self._classes.values():
+            if other is cls:
+                return True
+            # a higher class that could take the slot goes first
+            if other.waiting and other.ready(now):
+                return False
+        return True
+
+    def _release(self, cls):
+        with self._cond:
+            cls.running -= 1
+            self._running -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        """Per class: `queued` calls, `running` calls, calls `admitted` and `timed_out` so far, and the
+        `wait_p50_ms`, `wait_p99_ms` and `wait_max_ms` of the recent admissions. Also the total `running`."""
+        with self._cond:
+            stats = {name: cls.stats() for name, cls in self._classes.items()}
+            stats['running'] = self._running
+            return stats
+
+
+class _Class:
+    def __init__(self, name, slots, max_concurrency=None, rate=None, burst=None, queue_timeout=None):
+        self.name = name
+        self.max_concurrency = max_concurrency if max_concurrency is not None else slots
+        self.bucket = _TokenBucket(rate, burst)
+        self.queue_timeout = queue_timeout
+        self.waiting = deque()
+        self.running = 0
+        self.admitted = 0
+        self.timed_out = 0
+        self._waits = deque(maxlen=_WAIT_SAMPLES)
+
+    def ready(self, now):
+        return self.running < self.max_concurrency and self.bucket.available(now)
+
+    def record_wait(self, seconds):
+        self._waits.append(seconds)
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            if not waits:
+                return None
+            return waits[min(len(waits) - 1, int(p / 100 * len(waits)))] * 1000
+
+        return {'queued': len(self.waiting), 'running': self.running, 'admitted': self.admitted,
+                'timed_out': self.timed_out, 'wait_p50_ms': percentile(50), 'wait_p99_ms': percentile(99),
+                'wait_max_ms': waits[-1] * 1000 if waits else None}
+
+
+class _TokenBucket:
+    """Allows `rate` takes per second on average, and up to `burst` at once"""
+
+    def __init__(self, rate=None, burst=None):
+        if rate is not None and rate <= 0:
+            raise ValueError('The rate of a priority class must be positive')
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate or 0)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+    def available(self, now):
+        if self.rate is None:
+            return True
+        self._refill(now)
+        return self._tokens >= 1
+
+    def take(self):
+        if self.rate is not None:
+            self._tokens -= 1
+
+    def time_to_token(self, now):
+        """Seconds until a token is available, None if waiting for tokens is not what holds calls back"""
+        if self.rate is None:
+            return None
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self.rate) or None
@@ -0,0 +1,329 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Query results that spill to disk once they grow too large. Requires the `pyarrow` package.
+
+`Client.run(..., spill_threshold_bytes=...)` keeps rows in memory until they take more than the threshold,
+then writes them, and all further rows, to a temporary Arrow IPC file in batches of rows. The returned
+`SpilledResult` memory-maps that file: slicing and selecting columns are free, and only what is converted with
+`to_pandas`, `to_rows` or `iter_chunks` is read into memory.
+
+The type of each column is inferred from the rows held in memory before spilling, or taken from `dtypes`.
+Columns without a scalar Arrow type (lists, mixed types, all nulls) are stored as JSON text, as in the `arrow`
+format of `pycozo.transfer`, and decoded on conversion. A column whose later rows do not fit the inferred type
+is widened to JSON text, which rewrites the rows already spilled once; columns typed by `dtypes` are not.
+
+From a remote database, the response is parsed while it is received, so the rows are never all in memory.
+The embedded engine hands over its results whole: the rows are then released one batch at a time as they are
+written, so that they are not held twice.
+"""
+
+import json
+import os
+import tempfile
+import weakref
+
+import pyarrow as pa
+
+from pycozo.arrow import arrow_type
+from pycozo.client import QueryException, _with_timeout
+from pycozo.limits import _size_of
+from pycozo.transfer import _arrow_batch, _stream_query
+
+# rows written to the file at once
+_BATCH_ROWS = 10000
+
+_SCALAR_TYPES = (pa.int64(), pa.float64(), pa.string(), pa.bool_(), pa.binary())
+
+
+def run_spilled(client, script, params, immutable, timeout, threshold, dtypes=None, directory=None):
+    """Run a query for `client`, returning a `SpilledResult`, see `Client.run`"""
+    spiller = _Spiller(threshold, dtypes, directory)
+    try:
+        limited = script if timeout is None else _with_timeout(script, timeout)
+        if client.embedded is None and limited is not None:
+            headers = _stream_query(client, limited, params, immutable, timeout, spiller)['headers']
+        else:
+            res = client._execute(script, params, immutable, timeout)
+            headers = res['headers']
+            spiller.headers = headers
+            rows = res['rows']
+            for i in range(len(rows)):
+                spiller.add(rows[i])
+                rows[i] = None
+        return spiller.finish(headers)
+    except BaseException:
+        spiller.abort()
+        raise
+
+
+class SpilledResult:
+    """A query result held in an Arrow table, memory-mapped from a temporary file if it was spilled.
+
+    `len(result)` is the number of rows, `result[i]` a row as a list, `result[start:stop]` the rows in a range
+    and `result['col']` or `result[['a', 'b']]` some of the columns, the latter two as `SpilledResult` views
+    sharing the same file. The file is deleted by `close`, or once the result and all its views are
+    garbage collected.
+    """
+
+    def __init__(self, table, json_columns=(), file=None):
+        self._table = table
+        self._json_columns = [name for name in table.column_names if name in json_columns]
+        self._file = file
+
+    @property
+    def headers(self):
+        """The names of the columns"""
+        return self._table.column_names
+
+    @property
+    def json_columns(self):
+        """The columns stored as JSON text in the Arrow table, which `to_arrow` returns as they are"""
+        return list(self._json_columns)
+
+    @property
+    def spilled(self):
+        """Whether the rows are in a file on disk rather than in memory"""
+        return self._file is not None
+
+    @property
+    def path(self):
+        """The path of the file the rows are in, None if they were not spilled"""
+        return self._file.path if self._file is not None else None
+
+    def __len__(self):
+        return self._table.num_rows
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            n = len(self)
+            if not -n <= key < n:
+                raise IndexError(f'row {key} is out of range for {n} rows')
+            return self._table_rows(self._table.slice(key % n, 1))[1][0]
+        elif isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError('Slices of results cannot have a step')
+            return self._view(self._table.slice(start, max(0, stop - start)))
+        elif isinstance(key, str):
+            return self.select([key])
+        return self.select(key)
+
+    def select(self, columns):
+        """A view with only the given columns, in the given order"""
+        missing = [c for c in columns if c not in self.headers]
+        if missing:
+            raise KeyError(f'No columns {missing} in the result, the columns are {self.headers}')
+        return self._view(self._table.select(list(columns)))
+
+    def _view(self, table):
+        return SpilledResult(table, self._json_columns, self._file)
+
+    def _projected(self, columns):
+        return self._table if columns is None else self.select(columns)._table
+
+    def to_arrow(self, columns=None):
+        """The rows as a `pyarrow.Table`, without copying them. Columns in `json_columns` hold JSON text."""
+        return self._projected(columns)
+
+    def to_pandas(self, columns=None):
+        """The rows as a pandas dataframe, reading only the given columns if any"""
+        table = self._projected(columns)
+        df = table.to_pandas()
+        for name in self._json_columns:
+            if name in table.column_names:
+                # from the Arrow column, pandas may have turned nulls into NaN
+                df[name] = [None if v is None else json.loads(v) for v in table.column(name).to_pylist()]
+        return df
+
+    def to_rows(self, columns=None):
+        """The rows as `(headers, rows)`, the form of the results of `Client.run` without dataframes"""
+        return self._table_rows(self._projected(columns))
+
+    def iter_chunks(self, chunk_size=_BATCH_ROWS, columns=None):
+        """Yield the rows as `(headers, rows)` with at most `chunk_size` rows, reading one chunk at a time"""
+        table = self._projected(columns)
+        for offset in range(0, table.num_rows, chunk_size):
+            yield self._table_rows(table.slice(offset, chunk_size))
+
+    def _table_rows(self, table):
+        from pycozo.arrow import to_rows
+
+        headers, rows = to_rows(table)
+        positions = [i for i, name in enumerate(headers) if name in self._json_columns]
+        for row in rows:
+            for i in positions:
+                if row[i] is not None:
+                    row[i] = json.loads(row[i])
+        return headers, rows
+
+    def close(self):
+        """Delete the file of a spilled result. The result and its views can no longer be used."""
+        if self._file is not None:
+            self._file.remove()
+        self._table = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self):
+        where = f'spilled to {self.path}' if self.spilled else 'in memory'
+        return f'<SpilledResult of {len(self)} rows × {len(self.headers)} columns, {where}>'
+
+
+class _SpillFile:
+    """A temporary file removed when nothing refers to it any more"""
+
+    def __init__(self, path):
+        self.path = path
+        self._finalizer = weakref.finalize(self, _remove, path)
+
+    def remove(self):
+        self._finalizer()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _Spiller:
+    """Collects the rows of a result, in memory until they pass the threshold and then in a file"""
+
+    def __init__(self, threshold, dtypes=None, directory=None):
+        self.headers = None
+        self._threshold = threshold
+        self._dtypes = dtypes or {}
+        self._directory = directory
+        self._rows = []
+        self._size = 0
+        self._path = None
+        self._writer = None
+        self._schema = None
+        self._json_columns = None
+
+    def add(self, row):
+        self._rows.append(row)
+        if self._writer is None:
+            self._size += _size_of(row)
+            if self._size > self._threshold:
+                self._open()
+                self._flush()
+        elif len(self._rows) >= _BATCH_ROWS:
+            self._flush()
+
+    def _names(self, n_columns):
+        # a response may in principle send its rows before its headers
+        if self.headers is not None:
+            return list(self.headers)
+        return [f'_{i}' for i in range(n_columns)]
+
+    def _infer_schema(self, names):
+        fields = []
+        json_columns = []
+        for i, name in enumerate(names):
+            if name in self._dtypes:
+                typ = arrow_type(self._dtypes[name])
+            else:
+                try:
+                    typ = pa.array([row[i] for row in self._rows]).type
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    typ = None
+                if typ not in _SCALAR_TYPES:
+                    typ = None
+            if typ is None:
+                typ = pa.string()
+                json_columns.append(name)
+            fields.append(pa.field(name, typ))
+        return pa.schema(fields), json_columns
+
+    def _open(self):
+        names = self._names(len(self._rows[0]))
+        self._schema, self._json_columns = self._infer_schema(names)
+        fd, self._path = tempfile.mkstemp(prefix='cozo-spill-', suffix='.arrow', dir=self._directory)
+        os.close(fd)
+        self._writer = pa.ipc.new_file(self._path, self._schema)
+
+    def _batch(self, rows):
+        try:
+            return _arrow_batch(self._schema, self._json_columns, self._schema.names, rows)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            self._widen(rows, e)
+            return _arrow_batch(self._schema, self._json_columns, self._schema.names, rows)
+
+    def _widen(self, rows, error):
+        """Turn the inferred columns that cannot hold some of the rows into JSON text, rewriting the rows already
+        spilled"""
+        widened = []
+        for i, field in enumerate(self._schema):
+            if field.name in self._json_columns:
+                continue
+            try:
+                pa.array([row[i] for row in rows], type=field.type)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                if field.name in self._dtypes or field.type == pa.binary():
+                    raise ValueError(f'Column {field.name} of the result changed type: {error}. '
+                                     f"Give it the type 'Any' in `dtypes`") from error
+                widened.append(i)
+        schema = self._schema
+        for i in widened:
+            schema = schema.set(i, pa.field(schema.field(i).name, pa.string()))
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            old_path = self._path
+            try:
+                table = pa.ipc.open_file(pa.memory_map(old_path)).read_all()
+                for i in widened:
+                    values = [None if v is None else json.dumps(v) for v in table.column(i).to_pylist()]
+                    table = table.set_column(i, schema.field(i), pa.array(values, type=pa.string()))
+                fd, self._path = tempfile.mkstemp(prefix='cozo-spill-', suffix='.arrow', dir=self._directory)
+                os.close(fd)
+                self._writer = pa.ipc.new_file(self._path, schema)
+                self._writer.write_table(table)
+            finally:
+                _remove(old_path)
+        self._schema = schema
+        self._json_columns = self._json_columns + [schema.field(i).name for i in widened]
+
+    def _flush(self):
+        rows = self._rows
+        self._rows = []
+        for offset in range(0, len(rows), _BATCH_ROWS):
+            # converted first, widening a column replaces the writer
+            batch = self._batch(rows[offset:offset + _BATCH_ROWS])
+            self._writer.write_batch(batch)
+
+    def finish(self, headers):
+        if self._writer is None:
+            self.headers = headers
+            self._schema, self._json_columns = self._infer_schema(list(headers))
+            table = pa.Table.from_batches([self._batch(self._rows)], schema=self._schema)
+            return SpilledResult(table, self._json_columns)
+        self._flush()
+        self._writer.close()
+        self._writer = None
+        table = pa.ipc.open_file(pa.memory_map(self._path)).read_all()
+        json_columns = [headers[table.column_names.index(name)] for name in self._json_columns]
+        if table.column_names != list(headers):
+            table = table.rename_columns(list(headers))
+        return SpilledResult(table, json_columns, _SpillFile(self._path))
+
+    def abort(self):
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+            self._writer = None
+        if self._path is not None:
+            _remove(self._path)
+
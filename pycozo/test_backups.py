@@ -0,0 +1,66 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+import os
+import time
+
+from pycozo.backups import BackupManager
+from pycozo.client import Client
+
+
+def _rows(client, relation):
+    return client.run(f'?[k, v] := *{relation}{{k, v}}')['rows']
+
+
+def test_incremental_snapshots(tmp_path):
+    db = Client(dataframe=False)
+    db.run('?[k, v] <- $rows :create kv {k => v}', {'rows': [[i, f'v{i}'] for i in range(1000)]})
+    db.run('?[k, v] <- [[[1, "a"], 0.5]] :create pairs {k => v}')
+    db.run('::index create kv:by_v {v}')
+    backups = BackupManager(db, str(tmp_path / 'backups'), keep=2, chunk_size=100, workers=2)
+
+    full = backups.snapshot()
+    assert full['kind'] == 'full' and full['consistent'] and full['rows'] == 1001
+    assert full['chunks_written'] == 11
+
+    db.run('?[k, v] <- [[5, "changed"], [5000, "new"]] :put kv {k => v}')
+    db.run('?[k] <- [[999]] :rm kv {k}')
+    incremental = backups.snapshot()
+    assert incremental['kind'] == 'incremental'
+    # the first and the last range of kv changed
+    assert (incremental['chunks_written'], incremental['chunks_reused']) == (2, 9)
+
+    db.run('?[k, v] <- $rows :put kv {k => v}', {'rows': [[i, 'more'] for i in range(10000, 10500)]})
+    assert backups.snapshot(full=False)['chunks_written'] == 6
+    assert [m['id'] for m in backups.snapshots()] != [] and len(backups.snapshots()) == 2
+    # the files of the full snapshot are still used by the kept ones
+    assert os.path.isdir(os.path.join(backups.path, full['id']))
+
+    restored = Client(dataframe=False)
+    assert backups.restore(restored, relations=['kv'], workers=3) == {'kv': 1500}
+    assert _rows(restored, 'kv') == _rows(db, 'kv')
+    assert restored.run('::relations')['rows'][0][0] == 'kv'
+    counts = backups.restore(restored, snapshot=backups.snapshots()[0]['id'])
+    assert counts['pairs'] == 1 and _rows(restored, 'pairs') == [[[1, 'a'], 0.5]]
+    assert not os.listdir(os.path.join(backups.path, '.staging'))
+    db.close()
+
+
+def test_scheduled_and_remote(tmp_path):
+    from pycozo.testing import StubServer
+
+    with StubServer() as server:
+        db = server.client(dataframe=False)
+        db.run('?[k, v] <- [[1, "a"]] :create kv {k => v}')
+        with BackupManager(db, str(tmp_path), full_every=2, compression=None).start(0.05) as backups:
+            deadline = time.time() + 5
+            while len(backups.snapshots()) < 3 and time.time() < deadline:
+                time.sleep(0.02)
+        kinds = [m['kind'] for m in backups.snapshots()]
+        assert kinds[:3] == ['full', 'incremental', 'full']
+        assert not backups.snapshots()[0]['consistent'] and backups.last_error is None
+        db.run('?[k, v] <- [[1, "b"]] :put kv {k => v}')
+        backups.restore()
+        assert _rows(db, 'kv') == [[1, 'a']]
@@ -5,6 +5,7 @@
 #  You can obtain one at https://mozilla.org/MPL/2.0/.
 from pycozo import Client
 from pycozo.client import QueryException
+from pycozo.limits import ResultTooLarge
 
 
 def test_client():
@@ -69,5 +70,663 @@ def test_client():
     assert r['rows'] == [[1], [2], [3]]
 
 
+def _wait_for(pred, timeout=2.0):
+    import time
+
+    deadline = time.time() + timeout
+    while not pred() and time.time() < deadline:
+        time.sleep(0.01)
+    return pred()
+
+
+def test_get_many():
+    client = Client(dataframe=False)
+    client.run(':create kv {k1, k2 => v}')
+    client.put('kv', [{'k1': i, 'k2': str(i), 'v': i * 10} for i in range(100)])
+
+    r = client.get_many('kv', [(5, '5'), (1, '1'), (1000, '1000')])
+    assert r['rows'] == [[5, '5', 50], [1, '1', 10]]
+    r = client.get_many('kv', [[7, '7']], columns=['v'])
+    assert r == {'headers': ['v'], 'rows': [[70]]}
+
+    r = client.get_many('kv', [(3, '3')], cache=True)
+    assert r['rows'] == [[3, '3', 30]]
+    assert len(client._key_cache) == 1
+    client.run('?[k1, k2, v] <- [[3, "3", 31]] :put kv {k1, k2 => v}')
+    assert client.get_many('kv', [(3, '3')], columns=['v'], cache=True)['rows'] == [[31]]
+    client.put('kv', {'k1': 3, 'k2': '3', 'v': 32})
+    assert client.get_many('kv', [(3, '3')], columns=['v'], cache=True)['rows'] == [[32]]
+    try:
+        client.get_many('kv', [3])
+        assert False
+    except ValueError:
+        pass
+
+    # hits need no query at all, not even for the columns of the relation
+    client.schema_cache_ttl = 0
+    queries = []
+    run_raw = client._run_raw
+    client._run_raw = lambda script, *args, **kwargs: queries.append(script) or run_raw(script, *args, **kwargs)
+    assert client.get_many('kv', [(3, '3')], cache=True)['rows'] == [[3, '3', 32]]
+    assert queries == []
+    del client._run_raw
+
+    # no change callback is needed, which would keep transactions from starting
+    with client.multi_transact(write=True) as tx:
+        tx.run('?[k1, k2, v] <- [[4, "4", 41]] :put kv {k1, k2 => v}')
+        tx.commit()
+    client.key_cache_ttl = 0
+    assert client.get_many('kv', [(4, '4')], columns=['v'], cache=True)['rows'] == [[41]]
+
+    # the key of a single-key relation can be a list
+    client.run(':create lists {k: [Int] => v}')
+    client.put('lists', {'k': [1, 2], 'v': 'a'})
+    assert client.get_many('lists', [[1, 2], [1]], columns=['v'], cache=True)['rows'] == [['a']]
+    client.close()
+
+
+def test_schema_cache():
+    client = Client(dataframe=False)
+    assert client.relations()['rows'] == []
+    client.create('t1', 'a', 'b')
+    client.run(':create t2 {x => y}')
+    assert [row[0] for row in client.relations()['rows']] == ['t1', 't2']
+    assert [row[0] for row in client.relations('t2')['rows']] == ['t2']
+    assert client.columns('t2')['rows'][1][:2] == ['y', False]
+    assert set(client.columns()) == {'t1', 't2'}
+    assert 't2' in client._schema_columns
+
+    client.run('?[x, y, z] <- [] :replace t2 {x => y, z}')
+    assert 't2' not in client._schema_columns
+    assert [row[0] for row in client.columns('t2')['rows']] == ['x', 'y', 'z']
+    client.run('::remove t1')
+    assert [row[0] for row in client.relations()['rows']] == ['t2']
+
+    for bad in [{'x': 1, 'w': 2}, {'y': 1}]:
+        try:
+            client.put('t2', bad)
+            assert False
+        except RuntimeError:
+            pass
+
+    # a column added behind the back of the cache is found by fetching the columns again
+    super(type(client), client)._run_raw('?[x, y, z, w] <- [] :replace t2 {x => y, z, w}')
+    client.put('t2', {'x': 1, 'y': 2, 'z': 3, 'w': 4})
+    assert client.run('?[w] := *t2{w}')['rows'] == [[4]]
+
+    # without a cache, writes take no extra query
+    client.schema_cache_ttl = 0
+    queries = []
+    run_raw = client._run_raw
+    client._run_raw = lambda script, *args, **kwargs: queries.append(script) or run_raw(script, *args, **kwargs)
+    client.put('t2', {'x': 2, 'y': 2, 'z': 3, 'w': 4})
+    assert len(queries) == 1 and ':put t2' in queries[0]
+    del client._run_raw
+    client.close()
+
+
+def test_dtypes():
+    import pytest
+    pytest.importorskip('pandas')
+
+    client = Client()
+    client.run(':create typed {a: Int => b: Float?, c: String, d: Bool, e: Int?}')
+    rows = [[i, None if i % 2 else i / 2, 'xy'[i % 2], i % 3 == 0, None if i % 5 else i] for i in range(100)]
+    client.run('?[a, b, c, d, e] <- $rows :put typed {a => b, c, d, e}', {'rows': rows})
+    df = client.run('?[a, b, c, d, e] := *typed{a, b, c, d, e}', dtypes='typed')
+    assert [str(t) for t in df.dtypes] == ['int64', 'Float64', 'category', 'bool', 'Int64']
+    assert df['e'].isna().sum() == 80
+    df = client.run('?[a, c] := *typed{a, c}', dtypes={'a': 'float64'})
+    assert str(df.dtypes['a']) == 'float64'
+    client.close()
+
+
+def test_create_from_dataframe():
+    import pytest
+    pd = pytest.importorskip('pandas')
+
+    client = Client(dataframe=False)
+    n = 25000
+    df = pd.DataFrame({'id': range(n), 'name': [f'n{i % 10}' for i in range(n)],
+                       'score': [None if i % 3 == 0 else i / 2 for i in range(n)],
+                       'at': pd.to_datetime([i for i in range(n)], unit='s'),
+                       'tags': [[i, 'x'] for i in range(n)], 'flag': [i % 2 == 0 for i in range(n)]})
+    loaded = []
+    stats = client.create_from_dataframe('people', df, keys=['id'], indexes=['name'], chunk_size=10000,
+                                         progress=lambda rel, rows: loaded.append(rows))
+    assert stats['rows'] == n and stats['rows_per_second'] > 0
+    assert len(loaded) == 3 and max(loaded) == n
+    assert client.relation_dtypes('people') == {'id': 'Int', 'name': 'String', 'score': 'Float?', 'at': 'Float',
+                                                'tags': '[Any]', 'flag': 'Bool'}
+    assert client.run('?[id, name, score, at, tags, flag] := *people{id, name, score, at, tags, flag}, id < 2')[
+               'rows'] == [[0, 'n0', None, 0.0, [0, 'x'], True], [1, 'n1', 0.5, 1.0, [1, 'x'], False]]
+    assert client.run('?[count(id)] := *people:by_name{name: "n3", id}')['rows'] == [[2500]]
+
+    try:
+        client.create_from_dataframe('dups', pd.DataFrame({'k': [1, 1], 'v': [1, 2]}))
+        assert False
+    except ValueError:
+        pass
+    stats = client.create_from_dataframe('people', df.head(3), replace=True)
+    assert stats['rows'] == 3 and len(client.run('?[id] := *people{id}')['rows']) == 3
+    client.close()
+
+
+def test_as_of():
+    from datetime import datetime, timezone
+    from pycozo.builder import Const, InlineRule, InputProgram, Negation, RuleHead, StoredRuleApply, \
+        StoredRuleNamedApply
+
+    client = Client(dataframe=False)
+    client.run(':create prices {item: String, at: Validity => price: Float}')
+    client.run(':create items {item: String}')
+    client.run('?[item, at, price] <- [["tea", [1000000, true], 2.0], ["tea", [2000000, true], 2.5], '
+               '["tea", [3000000, false], 0.0]] :put prices {item, at => price}')
+    client.run('?[item] <- [["tea"], ["milk"]] :put items {item}')
+    program = InputProgram([InlineRule(RuleHead('?', ['item', 'price']), [
+        StoredRuleNamedApply('items', {'item': 'item'}),
+        StoredRuleNamedApply('prices', {'item': 'item', 'price': 'price'}),
+        Negation(StoredRuleNamedApply('items', {'item': Const('coffee')})),
+    ])])
+    view = client.as_of(datetime(1970, 1, 1, 0, 0, 1, 500000, tzinfo=timezone.utc))
+    script = view.script(program)
+    assert '*items{item: item}' in script and '*prices{item: item, price: price @ 1500000}' in script
+    assert 'not (*items{item: "coffee"})' in script
+    explicit = InputProgram([InlineRule(RuleHead('?', ['p']), [
+        StoredRuleApply('prices', [Const('tea'), '_', 'p'], validity=Const('END'))])])
+    assert view.script(explicit).endswith('*prices["tea", _, p @ "END"]')
+    assert view.run(program)['rows'] == [['tea', 2.0]]
+    assert client.as_of('1970-01-01T00:00:02.5+00:00').run(program)['rows'] == [['tea', 2.5]]
+    assert client.as_of(3500000).run(program)['rows'] == []
+    # items has no time travel, its current state is read
+    client.run('?[item] <- [["tea"]] :rm items {item}')
+    assert view.run(program)['rows'] == []
+    client.run('?[item] <- [["tea"]] :put items {item}')
+    assert client.as_of_cache_stats() == {'entries': 0, 'hits': 0, 'misses': 0}
+
+    temporal = InputProgram([InlineRule(RuleHead('?', ['price']), [
+        StoredRuleNamedApply('prices', {'item': Const('tea'), 'price': 'price'})])])
+    assert view.run(temporal)['rows'] == [[2.0]]
+    assert view.run(temporal)['rows'] == [[2.0]]
+    assert client.as_of(3500000).run(temporal)['rows'] == []
+    assert client.as_of_cache_stats() == {'entries': 2, 'hits': 1, 'misses': 2}
+
+    # a write with a past validity through the client drops the results reading that relation
+    client.put('prices', [{'item': 'tea', 'at': [1200000, True], 'price': 3.0}])
+    assert view.run(temporal)['rows'] == [[3.0]]
+    client.run('?[item, at, price] <- [["tea", [1100000, true], 4.0]] :put prices {item, at => price}')
+    assert view.run(temporal)['rows'] == [[3.0]]
+    with client.multi_transact(write=True) as tx:
+        tx.run('?[item, at, price] <- [["tea", [1300000, true], 5.0]] :put prices {item, at => price}')
+        tx.commit()
+    assert view.run(temporal)['rows'] == [[5.0]]
+    assert client.as_of_cache_stats()['hits'] == 1
+
+    assert not client.as_of('NOW').cacheable and not client.as_of(2 ** 62).cacheable
+    for bad, error in [('yesterday', ValueError), (1.5, TypeError)]:
+        try:
+            client.as_of(bad)
+            assert False
+        except error:
+            pass
+    try:
+        view.run(str(program))
+        assert False
+    except TypeError:
+        pass
+    client.close()
+
+
+def test_export_import_file(tmp_path):
+    client = Client(dataframe=False)
+    client.run(':create big {a, b => c}')
+    rows = [[i // 3, i % 3, {'i': i}] for i in range(1000)]
+    client.run('?[a, b, c] <- $rows :put big {a, b => c}', {'rows': rows})
+    chunks = []
+    n = client.export_to_file(['big'], str(tmp_path), compression='gzip', chunk_size=64,
+                              progress=lambda rel, total: chunks.append(total))
+    assert n == {'big': 1000}
+    assert chunks[0] == 64 and chunks[-1] == 1000
+
+    target = Client(dataframe=False)
+    target.run(':create big {a, b => c}')
+    assert target.import_from_file(str(tmp_path / 'big.ndjson.gz'), chunk_size=100) == {'big': 1000}
+    assert target.export_relations(['big']) == client.export_relations(['big'])
+    # files of other relations are not even opened
+    (tmp_path / 'other.ndjson').write_text('not json')
+    assert target.import_from_file(str(tmp_path), relations=['big']) == {'big': 1000}
+    client.close()
+    target.close()
+
+
+def test_iter_json_export():
+    import io
+    import json
+    from pycozo.transfer import iter_json_export
+
+    data = {'a': {'headers': ['k', 'v'], 'next': None, 'rows': [[i, [i, {'s': 'x' * i}], i / 3] for i in range(250)]},
+            'empty': {'headers': ['k'], 'rows': []},
+            'b': {'rows': [[1], [2]], 'headers': ['k']}}
+    chunks = list(iter_json_export(io.StringIO(json.dumps(data)), chunk_size=100))
+    assert [(rel, len(rows)) for rel, _, rows in chunks] == [('a', 100), ('a', 100), ('a', 50), ('b', 2)]
+    assert [row for rel, _, rows in chunks if rel == 'a' for row in rows] == data['a']['rows']
+    assert list(iter_json_export(io.StringIO(' { } '))) == []
+
+
+def test_arrow(tmp_path):
+    import pytest
+    pa = pytest.importorskip('pyarrow')
+
+    client = Client(dataframe=False)
+    client.run(':create arr {a: Int => b: Float?, c: String}')
+    table = pa.table({'a': [1, 2, 3], 'b': [0.5, None, 1.5], 'c': ['x', 'y', 'z']})
+    client.put('arr', table)
+    client.put('arr', table.to_batches()[0].slice(0, 1))
+    res = client.run('?[a, b, c] := *arr{a, b, c}', format='arrow', dtypes='arr')
+    assert res.schema.types == [pa.int64(), pa.float64(), pa.string()]
+    assert res.equals(table)
+
+    path = str(tmp_path / 'arr.parquet')
+    assert client.run_to_parquet('?[a, b, c] := *arr{a, b, c}', path) == 3
+    client.run('?[a, b, c] <- [] :replace arr {a: Int => b: Float?, c: String}')
+    assert client.put_parquet('arr', path, batch_size=2) == 3
+    assert client.run('?[a, b, c] := *arr{a, b, c}')['rows'] == [[1, 0.5, 'x'], [2, None, 'y'], [3, 1.5, 'z']]
+    client.close()
+
+
+def test_spilled_result(tmp_path):
+    import os
+    import pytest
+    pytest.importorskip('pyarrow')
+
+    client = Client(dataframe=False)
+    script = '?[x, s, l] := x in int_range(30000), s = to_string(x), l = if(x % 2 == 0, [x], null)'
+    res = client.run(script, spill_threshold_bytes=100000, spill_dir=str(tmp_path))
+    assert res.spilled and os.path.dirname(res.path) == str(tmp_path)
+    assert len(res) == 30000 and res.headers == ['x', 's', 'l'] and res.json_columns == ['l']
+    assert res[4] == [4, '4', [4]] and res[-1] == [29999, '29999', None]
+    page = res[100:103]
+    assert page.to_rows() == (['x', 's', 'l'], [[100, '100', [100]], [101, '101', None], [102, '102', [102]]])
+    assert page.to_pandas(columns=['l'])['l'].tolist() == [[100], None, [102]]
+    assert res['s'][29998:].to_rows()[1] == [['29998'], ['29999']]
+    assert sum(len(rows) for _, rows in res.iter_chunks(7000, columns=['x'])) == 30000
+    path = res.path
+    res.close()
+    assert not os.path.exists(path)
+
+    small = client.run('?[x] <- [[1], [2]]', spill_threshold_bytes=1 << 20)
+    assert not small.spilled and small.to_rows() == (['x'], [[1], [2]])
+    # the column is widened to JSON text once strings follow the spilled ints
+    mixed = '?[y] := x in int_range(20000), y = if(x < 15000, x, to_string(x))'
+    res = client.run(mixed, spill_threshold_bytes=1000, spill_dir=str(tmp_path))
+    assert res.spilled and res.json_columns == ['y'] and res[14999] == [14999] and res[-1] == ['19999']
+    res.close()
+    try:
+        client.run(mixed, spill_threshold_bytes=1000, dtypes={'y': 'Int'}, spill_dir=str(tmp_path))
+        assert False
+    except ValueError:
+        pass
+    assert os.listdir(tmp_path) == []
+    assert client.run(mixed, spill_threshold_bytes=1000, dtypes={'y': 'Any'})[-1] == ['19999']
+    client.close()
+
+
+def test_result_limits(tmp_path):
+    from pycozo.limits import ResultTooLarge, with_row_limit
+
+    seen = []
+    client = Client(max_rows=100, on_result=seen.append)
+    # writes are not limited
+    client.run('?[k, v] <- $rows :create kv {k => v}', {'rows': [[i, f'v{i}'] for i in range(1000)]})
+    assert len(client.run('?[k, v] := *kv{k, v}, k < 100')) == 100
+    try:
+        client.run('?[k] := *kv{k}')
+        assert False
+    except ResultTooLarge as e:
+        assert e.rows == 101
+    assert len(client.run('?[k] := *kv{k}', max_rows=1000)) == 1000
+    try:
+        client.run('?[k, v] := *kv{k, v}', max_rows=1000, max_bytes=10_000)
+        assert False
+    except ResultTooLarge as e:
+        assert e.bytes > 10_000
+        exceeded = e.rows
+    assert [(s['rows'], s['exceeded']) for s in seen] == [(1, False), (100, False), (101, True), (1000, False),
+                                                        (exceeded, True)]
+    assert seen[1]['bytes'] > 100 * 8 and seen[1]['output_bytes'] > 0 and seen[1]['caller'].startswith(__file__)
+
+    assert with_row_limit('?[k] := *kv{k}', 5) == '?[k] := *kv{k}\n:limit 6'
+    for script in ('?[k] := *kv{k} :limit 3', '::relations', '?[k] <- [[1]] :rm kv {k}', '# list\n::relations',
+                   '/* all */\n  {?[k] := *kv{k}}'):
+        assert with_row_limit(script, 5) == script
+    assert with_row_limit('# all\n?[k] := *kv{k}', 5).endswith(':limit 6')
+    assert len(client.run('# list\n::relations', max_rows=5)) == 1
+    try:
+        client.run('?[k] := *kv{k}', spill_threshold_bytes=0, spill_dir=str(tmp_path))
+        assert False
+    except ResultTooLarge:
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+    # the reads of get_many and as_of views are limited and reported like those of run
+    from pycozo.builder import InlineRule, InputProgram, RuleHead, StoredRuleNamedApply
+
+    client.run(':create prices {item: Int, at: Validity => price: Float}')
+    client.run('?[item, at, price] <- $rows :put prices {item, at => price}',
+               {'rows': [[i, [1000, True], 1.0] for i in range(150)]})
+    program = InputProgram([InlineRule(RuleHead('?', ['item']), [StoredRuleNamedApply('prices', {'item': 'item'})])])
+    del seen[:]
+    for read in (lambda: client.as_of(5000).run(program), lambda: client.get_many('kv', list(range(101)))):
+        try:
+            read()
+            assert False
+        except ResultTooLarge as e:
+            assert e.rows == 101
+    assert len(client.as_of(5000).run(program, max_rows=150)) == 150
+    assert len(client.get_many('kv', list(range(100)))) == 100
+    assert [(s['rows'], s['exceeded']) for s in seen] == [(101, True), (101, True), (150, False), (100, False)]
+    client.close()
+
+
+def test_plans(tmp_path):
+    from pycozo.plans import PlanRecorder, compare_plans, fingerprint
+
+    changes = []
+    path = str(tmp_path / 'plans.json')
+    recorder = PlanRecorder(path, slow_ms=0, min_interval=0, on_change=changes.append)
+    client = Client(dataframe=False, plan_recorder=recorder)
+    client.run('?[k, v] <- [[1, "a"], [2, "b"]] :create kv {k => v}')
+    client.run('::index create kv:by_v {v}')
+    query = 'r[k] := k in [1, 2]\n?[k, v] := r[k], *kv{k, v}'
+    client.run(query)
+    # plans are explained in the background, before the relation changes
+    assert recorder.wait(5)
+    plan = client.explain(query)
+    assert plan['headers'][:5] == ['stratum', 'rule_idx', 'rule', 'atom_idx', 'op']
+    assert 'stored_prefix_join' in [row[4] for row in plan['rows']]
+    assert fingerprint('?[v] := *kv{k: 1, v: "x"}') == fingerprint('?[v] :=  *kv{k: 22, v: "y"}')
+
+    # the relation is now keyed by v: the lookup on k becomes a scan
+    client.run('::index drop kv:by_v')
+    client.run('::remove kv')
+    client.run('?[v, k] <- [["a", 1], ["b", 2]] :create kv {v => k}')
+    assert client.run(query)['rows'] == [[1, 'a'], [2, 'b']]
+    assert recorder.wait(5)
+    assert [c['kind'] for c in changes] == ['plan_changed'] and recorder.changes() == changes
+    assert 'stored_prefix_join' not in str(changes[0]['after'])
+    client.run(query)
+    assert recorder.wait(5) and len(changes) == 1
+
+    reloaded = PlanRecorder(path)
+    assert reloaded.baselines().keys() == recorder.baselines().keys()
+    recorder.accept()
+    assert recorder.changes() == []
+    key = fingerprint(query)
+    assert PlanRecorder(path).baselines()[key]['rows'] != reloaded.baselines()[key]['rows']
+
+    # lookups by k use the index once there is one
+    client.run('::index create kv:by_k {k}')
+    by_index = client.explain('?[v] := *kv{k: 1, v}')
+    client.run('::index drop kv:by_k')
+    by_scan = client.explain('?[v] := *kv{k: 1, v}')
+    assert [c['kind'] for c in compare_plans(by_index, by_scan)] == ['lost_index', 'plan_changed']
+    assert compare_plans(by_index, by_index) == []
+    client.close()
+
+
+def test_run_batch():
+    client = Client(dataframe=False, max_rows=50)
+    client.run('?[k, v] <- $rows :create kv {k => v}', {'rows': [[i, f'v{i}'] for i in range(100)]})
+    queries = [('?[v] := *kv{k: $k, v}', {'k': 1}), ('?[v] := *kv{k: $k, v}', {'k': 2}), '?[count(k)] := *kv{k}']
+    expected = [[['v1']], [['v2']], [[100]]]
+    for consistent in (True, False):
+        assert [res['rows'] for res in client.run_batch(queries, consistent=consistent)] == expected
+    try:
+        client.run_batch(['?[k] := *kv{k}'])
+        assert False
+    except ResultTooLarge:
+        pass
+    try:
+        client.run_batch(queries + ['?[k, v] <- [[1, "x"]] :put kv {k => v}'])
+        assert False
+    except QueryException:
+        pass
+    assert client.outstanding_transactions() == []
+    assert client.run('?[v] := *kv{k: 1, v}')['rows'] == [['v1']]
+
+    # with callbacks registered, the queries run one after the other
+    cb = client.register_callback('kv', lambda *args: None)
+    assert [res['rows'] for res in client.run_batch(queries)] == expected
+    client.unregister_callback(cb)
+    client.close()
+
+    accounted = []
+    client = Client(dataframe=False, on_result=accounted.append)
+    client.run('?[k, v] <- [[1, "v1"], [2, "v2"]] :create kv {k => v}')
+    client.run_batch(queries)
+    assert [stats['script'] for stats in accounted[1:]] == [script for script, _ in queries[:2]] + [queries[2]]
+    assert accounted[-1]['rows'] == 1 and accounted[-1]['caller'].startswith(__file__)
+    client.close()
+
+
+def test_transactions_and_callbacks():
+    first = Client(dataframe=False)
+    second = Client(dataframe=False)
+    cb = first.register_callback('kv', lambda *args: None)
+    # a transaction on another database would wait behind the callback too
+    try:
+        second.multi_transact()
+        assert False
+    except RuntimeError as e:
+        assert 'kv' in str(e)
+    first.unregister_callback(cb)
+    with second.multi_transact() as tx:
+        assert tx.run('?[x] <- [[1]]')['rows'] == [[1]]
+    first.register_callback('kv', lambda *args: None)
+    first.close()
+    second.multi_transact().abort()
+    second.close()
+
+
+def test_vectors():
+    import pytest
+    np = pytest.importorskip('numpy')
+
+    client = Client(dataframe=False)
+    client.run(':create vecs {id: Int => vec: <F32; 8>}')
+    client.run('::hnsw create vecs:idx {dim: 8, m: 16, dtype: F32, fields: [vec], distance: L2, ef_construction: 20}')
+    matrix = np.random.default_rng(0).random((50, 8), dtype=np.float32)
+    seen = []
+    client.on_result = seen.append
+    assert client.put_vectors('vecs', np.arange(50), matrix, batch_size=16) == 50
+    assert len(seen) == 4
+    client.on_result = None
+    stored = client.run('?[vec] := *vecs{id: 7, vec}')['rows'][0][0]
+    assert np.allclose(stored, matrix[7])
+
+    ids, distances = client.search_many('vecs:idx', matrix[:10], k=3)
+    assert ids.shape == (10, 3) and distances.shape == (10, 3)
+    assert ids[:, 0].tolist() == list(range(10))
+    assert (np.diff(distances, axis=1) >= 0).all()
+
+    ids, distances = client.search_many('vecs:idx', matrix[:2], k=3, extra_params={'radius': 1e-6})
+    assert ids.tolist() == [[0, None, None], [1, None, None]]
+    assert np.isinf(distances[:, 1:]).all()
+
+    # up to k rows per query vector, limited and reported like the results of run
+    client.max_rows = 20
+    client.on_result = seen.append
+    try:
+        client.search_many('vecs:idx', matrix[:10], k=3)
+        assert False
+    except ResultTooLarge as e:
+        assert e.rows == 21
+    assert seen[-1]['exceeded'] and client.search_many('vecs:idx', matrix[:5], k=3)[0].shape == (5, 3)
+    client.close()
+
+
+_WIRE_PAYLOAD = {'script': '?[x] <- [[$x]]', 'params': {'x': [1, 2.5, 'three', None, True]}}
+
+
+def _round_trip(encoding):
+    from pycozo.client import _WIRE_ENCODINGS
+
+    _, encode, decode = _WIRE_ENCODINGS[encoding]
+    return decode(encode(_WIRE_PAYLOAD))
+
+
+def test_wire_encodings():
+    import gzip
+    from pycozo.client import _WIRE_ENCODINGS, _accepted_codings, _compress
+
+    assert _round_trip('json') == _WIRE_PAYLOAD
+    data = _WIRE_ENCODINGS['json'][1](_WIRE_PAYLOAD)
+    assert gzip.decompress(_compress(data, 'gzip')) == data
+    assert _accepted_codings('gzip;q=0.5, zstd;q=0, br') == {'gzip', 'br'}
+    assert _accepted_codings(None) == set()
+
+
+def test_msgpack_wire_encoding():
+    import pytest
+    pytest.importorskip('msgpack')
+    assert _round_trip('msgpack') == _WIRE_PAYLOAD
+
+
+def test_cbor_wire_encoding():
+    import pytest
+    pytest.importorskip('cbor2')
+    assert _round_trip('cbor') == _WIRE_PAYLOAD
+
+
+def test_timeout_and_cancel():
+    import time
+
+    client = Client(dataframe=False)
+    runaway = 'r[x] := x = 0\nr[y] := r[x], y = x + 1, y < 100000000\n?[count(x)] := r[x]'
+    for script in [runaway, '{' + runaway + '}']:
+        start = time.monotonic()
+        try:
+            client.run(script, timeout=0.2)
+            assert False
+        except QueryException as e:
+            assert e.code == 'eval::killed'
+        assert time.monotonic() - start < 2
+    # killed from a timer, not waited for on the pool, which background queries may all be using
+    assert client._executor is None
+    assert client.run('?[x] <- [[1]]', timeout=1)['rows'] == [[1]]
+    handle = client.submit('{' + runaway + '}', immutable=True, timeout=0.2)
+    try:
+        handle.result(5)
+        assert False
+    except QueryException as e:
+        assert e.code == 'eval::killed'
+
+    handle = client.submit(runaway, immutable=True)
+    assert _wait_for(lambda: handle.status == 'running')
+    time.sleep(0.1)
+    assert handle.cancel()
+    try:
+        handle.result(2)
+        assert False
+    except QueryException:
+        pass
+    assert handle.status == 'failed'
+    assert client.submit('?[x] <- [[2]]').result()['rows'] == [[2]]
+    client.close()
+
+
+def test_single_flight():
+    import threading
+    from pycozo.client import _flight_key
+
+    client = Client(dataframe=False, single_flight=True)
+    client.run('?[k] <- $rows :create nums {k}', {'rows': [[i] for i in range(200000)]})
+    script = '?[sum(k)] := *nums{k}, k % $m == 0'
+    results = []
+    barrier = threading.Barrier(8)
+
+    def work():
+        barrier.wait()
+        results.append(client.run(script, {'m': 3}, immutable=True))
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(results) == 8 and all(r['rows'] == results[0]['rows'] for r in results)
+    stats = client.single_flight_stats()
+    assert stats['executed'] + stats['coalesced'] == 8 and stats['in_flight'] == 0
+    assert stats['coalesced'] > 0
+
+    try:
+        client.run('?[x] := *missing{x}', immutable=True)
+        assert False
+    except QueryException:
+        pass
+    # parameters equal as JSON, or of the same repr, are different parameters
+    assert _flight_key(script, {'m': 1}, None) != _flight_key(script, {'m': 1.0}, None)
+    assert _flight_key(script, {'m': 1}, None) != _flight_key(script, {'m': True}, None)
+    assert _flight_key(script, {'m': b'1'}, None) != _flight_key(script, {'m': '1'}, None)
+    assert _flight_key(script, {'m': object()}, None) is None
+    client.close()
+    other = Client(dataframe=False)
+    assert other.single_flight_stats() is None
+    other.close()
+
+
+def test_materialized_view():
+    client = Client(dataframe=False)
+    client.run('?[k, g, v] <- [[1, "a", 5], [2, "a", 5], [3, "b", 1]] :create t {k => g, v}')
+    view = client.materialize('by_g', '?[g, count(k), sum(v)] := *t{k, g, v}', ['t'],
+                              group_by=['g'], aggregates={'n': ('count', None), 'total': ('sum', 'v')})
+    assert view.incremental and client.view('by_g') is view
+    assert view.rows() == [['a', 2, 10.0], ['b', 1, 1.0]]
+
+    client.put('t', [{'k': 4, 'g': 'c', 'v': 2}, {'k': 1, 'g': 'a', 'v': 7}])
+    assert _wait_for(lambda: view.get('c') == ['c', 1, 2.0])
+    assert view.get('a') == ['a', 2, 12.0]
+    client.rm('t', [{'k': 3}])
+    assert _wait_for(lambda: view.get('b') is None)
+    assert view.recomputations == 1
+    assert view.rows() == client.run('?[g, count(k), sum(v)] := *t{k, g, v}')['rows']
+
+    joined = client.materialize('joined', '?[k, v] := *t{k, g: "a", v}', ['t'], debounce=0.01)
+    assert not joined.incremental
+    # without a count, the view cannot tell when a group disappears
+    sums = client.materialize('sums', '?[g, sum(v)] := *t{g, v}', ['t'], group_by=['g'],
+                              aggregates={'total': ('sum', 'v')})
+    assert not sums.incremental
+    sums.close()
+    try:
+        client.materialize('two', '?[k] := *t{k}, *kv{k}', ['t', 'kv'])
+        assert False
+    except ValueError:
+        pass
+    client.rm('t', [{'k': 2}])
+    assert _wait_for(lambda: joined.rows() == [[1, 7]])
+    assert joined.recomputations >= 2
+    view.close()
+    joined.close()
+    client.close()
+
+
 if __name__ == '__main__':
-    test_client()
+    import pathlib
+    import tempfile
+
+    import pytest
+
+    for test in [test_client, test_get_many, test_schema_cache, test_dtypes, test_create_from_dataframe, test_as_of,
+                 test_export_import_file, test_iter_json_export, test_arrow, test_spilled_result, test_result_limits,
+                 test_plans, test_run_batch, test_transactions_and_callbacks, test_vectors, test_wire_encodings,
+                 test_msgpack_wire_encoding, test_cbor_wire_encoding, test_timeout_and_cancel, test_single_flight,
+                 test_materialized_view]:
+        try:
+            if test.__code__.co_argcount:
+                with tempfile.TemporaryDirectory() as tmp:
+                    test(pathlib.Path(tmp))
+            else:
+                test()
+        except pytest.skip.Exception as e:
+            print(f'{test.__name__} skipped: {e}')
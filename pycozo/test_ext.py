@@ -0,0 +1,91 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('IPython')
+
+
+def _magics():
+    from IPython.core.interactiveshell import InteractiveShell
+    from pycozo.ext_impl import CozoMagics
+
+    shell = InteractiveShell.instance()
+    magics = CozoMagics(shell)
+    return shell, magics
+
+
+def test_preview():
+    from pycozo.ext_impl import ResultPreview
+
+    shell, magics = _magics()
+    preview = magics.cozo('res', '?[x] := x in int_range(100000)')
+    assert isinstance(preview, ResultPreview)
+    assert len(shell.user_ns['res']) == 100000
+    html = preview._repr_html_()
+    assert '100000 rows' in html and '99999' in html and '50000' not in html
+    assert repr(preview).count('\n') < 30
+
+    assert magics.cozo_config('preview_rows=4 style=False')['preview_rows'] == 4
+    assert len(magics.cozo('', '?[x] := x in int_range(10)')._preview()[0]) == 4
+    try:
+        magics.cozo_config('nonsense=1')
+        assert False
+    except Exception as e:
+        assert 'nonsense' in str(e)
+
+    # line magics return the full result, which is only rendered as a preview
+    import pandas
+    df = magics.cozo_run_string(repr('?[x] := x in int_range(1000)'), {})
+    assert isinstance(df, pandas.DataFrame) and df['x'].tolist() == list(range(1000))
+    html = shell.display_formatter.format(df)[0]['text/html']
+    assert 'showing the first 2 and last 2' in html and '<td>500</td>' not in html
+    other = pandas.DataFrame({'x': range(1000)})
+    assert 'showing the first' not in shell.display_formatter.format(other)[0]['text/html']
+
+    magics.cozo_config('page_size=1000')
+    page = magics.cozo_page('res 3', {})
+    assert page.df['x'].tolist() == list(range(3000, 4000))
+    assert 'page 3 of 100' in page._repr_html_()
+    try:
+        magics.cozo_page('res 100', {})
+        assert False
+    except Exception:
+        pass
+
+
+def test_background_and_import(tmp_path):
+    import json
+    import time
+
+    shell, magics = _magics()
+    handle = magics.cozo('--bg bg_res', '?[x] := x in int_range(1000)')
+    assert handle.result(5) is not None
+    deadline = time.time() + 5
+    while 'bg_res' not in shell.user_ns and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(shell.user_ns['bg_res']) == 1000
+
+    script = 'r[x] := x = 0\nr[y] := r[x], y = x + 1, y < 100000000\n?[count(x)] := r[x]'
+    handle = magics.cozo_run_string(f'--bg slow {script!r}', {})
+    deadline = time.time() + 5
+    while handle.status != 'running' and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert magics.cozo_cancel('') == {'slow': handle}
+    try:
+        handle.result(5)
+        assert False
+    except Exception:
+        pass
+    assert handle.status == 'failed'
+
+    magics.cozo('', ':create kv {k => v}')
+    path = tmp_path / 'export.json'
+    path.write_text(json.dumps({'kv': {'headers': ['k', 'v'], 'rows': [[i, str(i)] for i in range(2500)]}}))
+    magics.cozo_config('import_chunk_rows=1000')
+    assert magics.cozo_import_local_file(repr(str(path))) == {'kv': 2500}
+    assert len(magics.cozo('counted', '?[k, v] := *kv{k, v}').df) == 2500
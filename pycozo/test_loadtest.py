@@ -0,0 +1,67 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+import json
+
+from pycozo.loadtest import main, run_workload
+
+
+def _spec(**kwargs):
+    spec = {
+        'setup': [':create kv {k: Int => v: String}'],
+        'duration': 0.3,
+        'threads': 2,
+        'operations': [
+            {'name': 'get', 'kind': 'run', 'weight': 3, 'immutable': True,
+             'script': '?[v] := *kv{k: $k, v}', 'params': {'k': '$randint:0:99'}},
+            {'name': 'put', 'kind': 'put', 'relation': 'kv', 'rows': 5,
+             'row': {'k': '$randint:0:99', 'v': '$$literal'}},
+            {'name': 'bad', 'kind': 'run', 'script': '?[x] := *missing{x}'},
+        ],
+    }
+    spec.update(kwargs)
+    return spec
+
+
+def test_open_loop():
+    report = run_workload(_spec(rate=200, subscribers=[{'relation': 'kv'}]))
+    ops = report['operations']
+    assert 50 <= report['total']['count'] <= 61
+    assert ops['get']['errors'] == 0 and ops['put']['errors'] == 0
+    assert ops['bad']['errors'] == ops['bad']['count'] and 'missing' in ops['bad']['first_error']
+    assert ops['get']['p50_ms'] <= ops['get']['p99_ms'] <= ops['get']['max_ms']
+    assert report['client']['cpu_seconds'] >= 0
+    assert 'kv' in report['subscriber_events']
+    assert report['scheduler'] is None
+
+
+def test_priorities():
+    spec = _spec(rate=200, scheduler={'max_concurrency': 1})
+    spec['operations'][0]['priority'] = 'interactive'
+    spec['operations'][1]['priority'] = 'batch'
+    report = run_workload(spec)
+    assert report['scheduler']['interactive']['admitted'] == report['operations']['get']['count']
+    assert report['scheduler']['batch']['admitted'] == report['operations']['put']['count']
+    # and the setup script
+    assert report['scheduler']['normal']['admitted'] == report['operations']['bad']['count'] + 1
+
+
+def test_closed_loop_with_transactions(tmp_path, capsys):
+    spec = _spec(operations=[
+        {'name': 'tx', 'kind': 'transact', 'write': True,
+         'scripts': [{'script': '?[k, v] <- [[$k, $v]] :put kv {k => v}', 'params': {'k': '$seq', 'v': '$randstr:4'}}]},
+    ])
+    path = tmp_path / 'spec.json'
+    path.write_text(json.dumps(spec))
+    main([str(path), '--json', '--threads', '1'])
+    report = json.loads(capsys.readouterr().out)
+    assert report['operations']['tx']['count'] > 0
+    assert report['operations']['tx']['errors'] == 0
+
+    try:
+        run_workload(_spec(operations=spec['operations'], subscribers=[{'relation': 'kv'}]))
+        assert False
+    except ValueError:
+        pass
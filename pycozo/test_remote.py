@@ -0,0 +1,191 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+import json
+import time
+
+import pytest
+import requests
+
+from pycozo.client import QueryException
+from pycozo.testing import StubServer
+
+
+def test_queries_and_encodings():
+    pytest.importorskip('msgpack')
+    with StubServer(compress_responses=True) as server:
+        for encoding, compression in [('json', None), ('json', 'gzip'), ('msgpack', 'zstd')]:
+            db = server.client(encoding, compression, dataframe=False)
+            rows = [[i, f'value {i}', [i, None]] for i in range(500)]
+            db.run('?[k, v, w] <- $rows :replace kv {k => v, w}', {'rows': rows})
+            db.run('?[k, v, w] <- $rows :put kv {k => v, w}', {'rows': rows})
+            assert db.run('?[k, v, w] := *kv{k, v, w}', immutable=True)['rows'] == rows
+            assert db._binary_accepted == (encoding != 'json')
+            assert db._compression_accepted == (compression is not None)
+            try:
+                db.run('?[x] := *missing{x}')
+                assert False
+            except QueryException as e:
+                assert 'missing' in str(e)
+            db.close()
+
+    with StubServer(encodings=('json',)) as server:
+        db = server.client('msgpack', dataframe=False)
+        assert db.run('?[x] <- [[1]]')['rows'] == [[1]]
+        assert not db._binary_accepted
+
+    # requests are only compressed for servers that advertise the compression
+    rows = [[i, f'value {i}'] for i in range(500)]
+    with StubServer(request_compressions=()) as server:
+        db = server.client('json', 'gzip', dataframe=False)
+        for _ in range(2):
+            db.run('?[k, v] <- $rows :replace kv {k => v}', {'rows': rows})
+        assert not db._compression_accepted and server.stats()['bytes_in'] > 2 * len(json.dumps(rows))
+
+
+def test_transactions_and_transfer(tmp_path):
+    with StubServer(auth='secret') as server:
+        db = server.client(dataframe=False)
+        db.run(':create kv {k => v}')
+        with db.multi_transact(write=True) as tx:
+            tx.run('?[k, v] <- [[1, "a"]] :put kv {k => v}')
+            tx.commit()
+        with db.multi_transact(write=True) as tx:
+            tx.run('?[k, v] <- [[2, "b"]] :put kv {k => v}')
+        assert db.outstanding_transactions() == []
+        exported = db.export_relations(['kv'])
+        assert exported['kv']['rows'] == [[1, 'a']]
+        db.import_relations({'kv': {'headers': ['k', 'v'], 'rows': [[3, 'c']]}})
+        assert db.export_to_file(['kv'], str(tmp_path)) == {'kv': 2}
+        db.run('::remove kv')
+        db.run(':create kv {k => v}')
+        assert db.import_from_file(str(tmp_path)) == {'kv': 2}
+        assert db.run('?[k, v] := *kv{k, v}')['rows'] == [[1, 'a'], [3, 'c']]
+
+        db.auth = 'wrong'
+        try:
+            db.run('?[x] <- [[1]]')
+            assert False
+        except QueryException:
+            pass
+        assert server.stats()['by_path']['/text-query'] >= 5
+
+
+def test_changes_stream():
+    with StubServer() as server:
+        db = server.client(dataframe=False)
+        db.run(':create kv {k => v}')
+        received = []
+        cb_id = db.register_callback('kv', lambda op, new, old: received.append((op, new, old)))
+        deadline = time.time() + 5
+        while server.stats()['by_path'].get('/changes') is None and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        db.run('?[k, v] <- [[1, "a"]] :put kv {k => v}')
+        db.run('?[k] <- [[1]] :rm kv {k}')
+        while len(received) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert received == [('Put', [[1, 'a']], []), ('Rm', [[1]], [[1, 'a']])]
+        db.unregister_callback(cb_id)
+
+
+def test_spilled_stream(tmp_path):
+    pytest.importorskip('pyarrow')
+    with StubServer(compress_responses=True) as server:
+        db = server.client(dataframe=False)
+        res = db.run('?[x, s] := x in int_range(30000), s = to_string(x)', spill_threshold_bytes=0,
+                     spill_dir=str(tmp_path))
+        assert res.spilled and len(res) == 30000 and res[12345] == [12345, '12345']
+        try:
+            db.run('?[x] := *missing{x}', spill_threshold_bytes=0, spill_dir=str(tmp_path))
+            assert False
+        except QueryException as e:
+            assert 'missing' in str(e)
+        res.close()
+        assert list(tmp_path.iterdir()) == []
+
+        # streamed writes drop what the patched client caches
+        from pycozo.client_patch import Client as PatchedClient
+        db = PatchedClient('http', options={'host': server.url, 'auth': server.auth}, dataframe=False)
+        db.run('?[k, v] <- [[1, "a"]] :create kv {k => v}')
+        assert db.get_many('kv', [1])['rows'] == [[1, 'a']]
+        db.run('?[k, v, w] <- [[1, "b", 2]] :replace kv {k => v, w}', max_bytes=1000)
+        assert db.get_many('kv', [1])['rows'] == [[1, 'b', 2]]
+        db.close()
+
+
+def test_result_limits():
+    from pycozo.limits import ResultTooLarge
+
+    seen = []
+    with StubServer(bandwidth=50_000_000) as server:
+        db = server.client(dataframe=False, max_bytes=100_000, on_result=seen.append)
+        assert len(db.run('?[x] := x in int_range(100)')['rows']) == 100
+        try:
+            db.run('?[x, s] := x in int_range(200000), s = to_string(x)')
+            assert False
+        except ResultTooLarge as e:
+            assert e.bytes > 100_000 and e.rows < 200000
+            exceeded = e.rows
+        # the limit cannot be added to a chained script, the rows are counted as they arrive
+        try:
+            db.run('{?[x] := x in int_range(1000)}', max_rows=10)
+            assert False
+        except ResultTooLarge as e:
+            assert e.rows == 11
+        assert [(s['rows'], s['exceeded']) for s in seen][-2:] == [(exceeded, True), (11, True)]
+        assert seen[0]['rows'] == 100 and seen[0]['caller'].startswith(__file__)
+
+
+def test_run_batch():
+    with StubServer(latency=0.05) as server:
+        db = server.client(dataframe=False)
+        db.run('?[k, v] <- [[1, "a"], [2, "b"]] :create kv {k => v}')
+        queries = [('?[v] := *kv{k: $k, v}', {'k': k}) for k in (1, 2)]
+        server.reset_stats()
+        assert [res['rows'] for res in db.run_batch(queries)] == [[['a']], [['b']]]
+        # begin, the two queries and commit
+        assert server.stats()['by_path'] == {'/transact': 4}
+        start = time.perf_counter()
+        assert [res['rows'] for res in db.run_batch(queries * 3, consistent=False)] == [[['a']], [['b']]] * 3
+        assert time.perf_counter() - start < 0.05 * 6
+        assert db.outstanding_transactions() == []
+
+
+def test_faults_and_shaping():
+    with StubServer(latency=0.05, seed=1) as server:
+        db = server.client(dataframe=False)
+        start = time.perf_counter()
+        db.run('?[x] <- [[1]]')
+        assert time.perf_counter() - start >= 0.05
+
+        server.inject('error', path='/text-query')
+        try:
+            db.run('?[x] <- [[1]]')
+            assert False
+        except QueryException as e:
+            assert 'Injected' in str(e)
+        server.inject('drop')
+        try:
+            db.run('?[x] <- [[1]]')
+            assert False
+        except requests.ConnectionError:
+            pass
+        assert db.run('?[x] <- [[1]]')['rows'] == [[1]]
+        assert server.stats()['faults'] == 2
+
+    with StubServer(bandwidth=200000) as server:
+        db = server.client(dataframe=False)
+        server.reset_stats()
+        start = time.perf_counter()
+        res = db.run('?[x] := x in int_range(20000)')
+        elapsed = time.perf_counter() - start
+        assert len(res['rows']) == 20000
+        assert elapsed >= server.stats()['bytes_out'] / 200000 * 0.9
+
+
+if __name__ == '__main__':
+    test_queries_and_encodings()
+    test_changes_stream()
@@ -0,0 +1,87 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+import json
+
+from pycozo.client import Client
+from pycozo.replication import Replicator
+
+
+def _all(client, relation):
+    return client.run(f'?[k1, k2, v] := *{relation}{{k1, k2, v}}')['rows']
+
+
+def test_replicator(tmp_path):
+    source = Client(dataframe=False)
+    target = Client(dataframe=False)
+    source.run(':create kv {k1: Int, k2: String => v: Any}')
+    source.run('?[k1, k2, v] <- $rows :put kv {k1, k2 => v}', {'rows': [[i, str(i), i] for i in range(250)]})
+    # a stale copy: one row missing, one row changed, one row that no longer exists on the source
+    target.run(':create kv {k1: Int, k2: String => v: Any}')
+    stale = [[i, str(i), i] for i in range(1, 250)] + [[1000, 'x', 0]]
+    stale[5] = [6, '6', 'changed']
+    target.run('?[k1, k2, v] <- $rows :put kv {k1, k2 => v}', {'rows': stale})
+
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    replicator = Replicator(source, target, ['kv'], batch_size=50, chunk_size=100, checkpoint_path=checkpoint)
+    replicator.start()
+    assert _all(target, 'kv') == _all(source, 'kv')
+    progress = replicator.checkpoint()['relations']['kv']
+    assert progress['synchronized']
+    assert progress['rows_compared'] == 250 and progress['rows_written'] == 2 and progress['rows_removed'] == 1
+
+    source.run('?[k1, k2, v] <- $rows :put kv {k1, k2 => v}', {'rows': [[i, 'new', i] for i in range(120)]})
+    source.run('?[k1, k2] <- [[0, "0"], [1, "new"]] :rm kv {k1, k2}')
+    source.run('?[k1, k2, v] <- [[0, "0", "back"]] :put kv {k1, k2 => v}')
+    assert replicator.wait_until_caught_up(timeout=5)
+    assert _all(target, 'kv') == _all(source, 'kv')
+    stats = replicator.stats()
+    assert stats['events_applied'] == stats['events_received'] == 3
+    assert stats['rows_applied'] == 123 and stats['pending_events'] == 0 and stats['lag_seconds'] == 0.0
+
+    replicator.stop()
+    with open(checkpoint) as f:
+        assert json.load(f)['relations']['kv']['events_applied'] == 3
+    source.run('?[k1, k2] <- [[2, "2"]] :rm kv {k1, k2}')
+    assert replicator.wait_until_caught_up(timeout=1)
+    assert len(_all(target, 'kv')) == len(_all(source, 'kv')) + 1
+
+
+def test_replicator_creates_relations():
+    source = Client(dataframe=False)
+    target = Client(dataframe=False)
+    source.run('?[k, v] <- [[1, 1.5]] :create nums {k: Int => v: Float default 0.0}')
+    with Replicator(source, target, ['nums'], max_rows_per_second=1000) as replicator:
+        source.run('?[k, v] <- [[2, 2.5]] :put nums {k => v}')
+        assert replicator.wait_until_caught_up(timeout=5)
+    assert target.run('?[k, v] := *nums{k, v}')['rows'] == [[1, 1.5], [2, 2.5]]
+    columns = target.run('::columns nums')['rows']
+    assert [(col[0], col[1], col[3]) for col in columns] == [('k', True, 'Int'), ('v', False, 'Float')]
+    source.run(':create other {k}')
+    try:
+        Replicator(source, target, ['nums', 'other']).start()
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_replicator_bytes_and_list_keys():
+    source = Client(dataframe=False)
+    target = Client(dataframe=False)
+    for client in (source, target):
+        client.run(':create blobs {k: Bytes, tags: [String] => v}')
+    source.run('?[k, tags, v] <- $rows :put blobs {k, tags => v}',
+               {'rows': [[b'\x00\x01', ['a'], 1], [b'\x02', ['a', 'b'], 2]]})
+    target.run('?[k, tags, v] <- $rows :put blobs {k, tags => v}',
+               {'rows': [[b'\x02', ['a', 'b'], 0], [b'\x03', [], 3]]})
+    with Replicator(source, target, ['blobs']) as replicator:
+        progress = replicator.checkpoint()['relations']['blobs']
+    assert progress['rows_written'] == 2 and progress['rows_removed'] == 1
+    query = '?[k, tags, v] := *blobs{k, tags, v}'
+    assert target.run(query)['rows'] == source.run(query)['rows']
+
+
+if __name__ == '__main__':
+    test_replicator_creates_relations()
@@ -0,0 +1,93 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+import threading
+import time
+
+from pycozo.client import Client
+from pycozo.scheduler import Scheduler
+
+
+def _wait_queued(scheduler, priority, n):
+    deadline = time.time() + 5
+    while scheduler.stats()[priority]['queued'] < n and time.time() < deadline:
+        time.sleep(0.005)
+
+
+def test_priorities_and_limits():
+    scheduler = Scheduler(max_concurrency=2)
+    order = []
+
+    def take(priority):
+        with scheduler.slot(priority):
+            order.append(priority)
+
+    with scheduler.slot('batch'):
+        # batch work may only take one of the two slots
+        batch = threading.Thread(target=take, args=('batch',))
+        batch.start()
+        _wait_queued(scheduler, 'batch', 1)
+        with scheduler.slot('normal'):
+            later = []
+            for priority in ('normal', 'interactive'):
+                later.append(threading.Thread(target=take, args=(priority,)))
+                later[-1].start()
+                _wait_queued(scheduler, priority, 1)
+        for t in later:
+            t.join()
+    batch.join()
+    assert order == ['interactive', 'normal', 'batch']
+    stats = scheduler.stats()
+    assert stats['running'] == 0 and stats['batch']['admitted'] == 2
+    assert stats['batch']['wait_max_ms'] >= stats['interactive']['wait_p50_ms']
+
+    with scheduler.slot('normal'), scheduler.slot('normal'):
+        try:
+            with scheduler.slot('interactive', queue_timeout=0.05):
+                assert False
+        except TimeoutError:
+            pass
+    assert scheduler.stats()['interactive']['timed_out'] == 1
+    try:
+        with scheduler.slot('urgent'):
+            assert False
+    except ValueError:
+        pass
+
+
+def test_rate_limit():
+    scheduler = Scheduler(classes={'normal': {'rate': 50, 'burst': 1}})
+    start = time.monotonic()
+    for _ in range(6):
+        with scheduler.slot('normal'):
+            pass
+    assert time.monotonic() - start >= 0.09
+
+
+def test_client_admission():
+    scheduler = Scheduler(max_concurrency=2)
+    client = Client(dataframe=False, scheduler=scheduler)
+    client.run(':create kv {k => v}')
+    client.import_relations({'kv': {'headers': ['k', 'v'], 'rows': [[1, 'a']]}})
+    with client.priority('interactive'):
+        assert client.run('?[v] := *kv{k: 1, v}')['rows'] == [['a']]
+        assert client.submit('?[k] := *kv{k}').result(5)['rows'] == [[1]]
+    stats = client.scheduler_stats()
+    assert (stats['normal']['admitted'], stats['batch']['admitted'], stats['interactive']['admitted']) == (1, 1, 2)
+    assert Client(dataframe=False).scheduler_stats() is None
+    client.close()
+
+
+def test_helper_admission():
+    from pycozo.client_patch import Client as PatchedClient
+    from pycozo.transfer import iter_relation_chunks
+
+    client = PatchedClient(dataframe=False, scheduler=Scheduler(max_concurrency=2))
+    client.run('?[k, v] <- [[1, "a"], [2, "b"]] :create kv {k => v}')
+    assert client.get_many('kv', [2, 1])['rows'] == [[2, 'b'], [1, 'a']]
+    assert [rows for _, rows in iter_relation_chunks(client, 'kv')] == [[[1, 'a'], [2, 'b']]]
+    stats = client.scheduler_stats()
+    assert (stats['normal']['admitted'], stats['batch']['admitted']) == (2, 1)
+    client.close()
@@ -0,0 +1,453 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""An in-process stand-in for the Cozo HTTP server, for tests and benchmarks of the 'http' engine.
+
+`StubServer` answers the REST API used by `Client` (`/text-query`, `/transact`, `/export`, `/import`,
+`/changes`, `/backup`, `/import-from-backup`) from an embedded 'mem' database. It can slow down or break
+the connection on purpose: a fixed latency per request, a bandwidth limit in both directions, and faults
+(error statuses or dropped connections) injected at random or on demand. It counts requests and bytes on
+the wire, which is what the encodings and compression of the client are judged by.
+
+Change streams are served with the change callbacks of the embedded engine, which serves the callbacks of one
+relation at a time: streams for several relations at once only work for the relation subscribed to first.
+
+Running the module benchmarks the wire encodings of the client against the stub:
+
+    python -m pycozo.testing [rows] [latency_seconds] [bandwidth_bytes_per_second]
+"""
+
+import gzip
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pycozo.client import Client, QueryException, _WIRE_ENCODINGS
+
+_FAULT_KINDS = ('error', 'drop', 'delay')
+
+# seconds between keep-alive comments on idle change streams
+_SSE_KEEPALIVE = 0.5
+
+
+class StubServer:
+    """A local HTTP server with the API of the Cozo server, backed by an embedded 'mem' database.
+
+    >>> with StubServer() as server:
+    ...     db = server.client(dataframe=False)
+    ...     db.run('?[x] <- [[1], [2]]')['rows']
+    [[1], [2]]
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, error_rate=0.0, drop_rate=0.0, seed=None,
+                 encodings=('json', 'msgpack'), compress_responses=False, request_compressions=('gzip', 'zstd'),
+                 auth=None, port=0):
+        """
+        :param latency: seconds added before each request is handled, like the round trip of a network.
+        :param jitter: if given, a random extra delay of up to this many seconds per request.
+        :param bandwidth: if given, the number of bytes per second request and response bodies are
+                          read and written at.
+        :param error_rate: the probability that a request is answered with a 503 error instead.
+        :param drop_rate: the probability that the connection of a request is closed without any response.
+        :param seed: the seed for the random faults and jitter, for reproducible runs.
+        :param encodings: the encodings the server answers in when the client accepts them,
+                          use `('json',)` to act as a server without binary encodings.
+        :param compress_responses: if true, responses are gzip-compressed for clients that accept it.
+        :param request_compressions: the compressions of request bodies the server accepts, listed in the
+                                      `Accept-Encoding` header of its responses. Other compressed requests are
+                                      answered with a 415 error. Use `()` to act as a server without any.
+        :param auth: if given, requests must carry this value in the `x-cozo-auth` header.
+        :param port: the port to listen on, a free one is chosen if 0.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.encodings = tuple(encodings)
+        self.compress_responses = compress_responses
+        self.request_compressions = tuple(request_compressions)
+        self.auth = auth
+        self.db = Client('mem', dataframe=False)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._faults = []
+        self._transactions = {}
+        self._next_tx_id = 0
+        self._closing = threading.Event()
+        self._stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'faults': 0, 'by_path': {}}
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', port), _handler_class(self))
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        """The base URL of the server, to use as the `host` option of the 'http' engine."""
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def client(self, encoding='json', compression=None, **kwargs):
+        """A `Client` of the 'http' engine connected to this server. Other arguments are passed to `Client`."""
+        options = {'host': self.url, 'auth': self.auth, 'encoding': encoding, 'compression': compression}
+        return Client('http', options=options, **kwargs)
+
+    def inject(self, kind, count=1, path=None, status=503, seconds=1.0):
+        """Make the next `count` requests fail, optionally only requests whose path starts with `path`.
+
+        :param kind: 'error' answers with the HTTP `status`, 'drop' closes the connection without a response,
+                     'delay' waits `seconds` before handling the request normally.
+        """
+        if kind not in _FAULT_KINDS:
+            raise ValueError(f'Unknown fault {kind!r}, expected one of {_FAULT_KINDS}')
+        with self._lock:
+            self._faults.extend([(kind, path, status, seconds)] * count)
+
+    def stats(self):
+        """Requests served, bytes read and written as bodies on the wire, faults injected, requests per path."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['by_path'] = dict(stats['by_path'])
+            return stats
+
+    def reset_stats(self):
+        """Set all counters of `stats` back to zero."""
+        with self._lock:
+            self._stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'faults': 0, 'by_path': {}}
+
+    def close(self):
+        """Stop the server and close its database."""
+        self._closing.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _count(self, path, bytes_in=0):
+        endpoint = '/' + path.strip('/').split('/')[0]
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['bytes_in'] += bytes_in
+            self._stats['by_path'][endpoint] = self._stats['by_path'].get(endpoint, 0) + 1
+
+    def _count_sent(self, bytes_out):
+        with self._lock:
+            self._stats['bytes_out'] += bytes_out
+
+    def _take_fault(self, path):
+        with self._lock:
+            for i, fault in enumerate(self._faults):
+                if fault[1] is None or path.startswith(fault[1]):
+                    del self._faults[i]
+                    self._stats['faults'] += 1
+                    return fault
+            roll = self._random.random()
+            if roll < self.drop_rate:
+                self._stats['faults'] += 1
+                return 'drop', None, None, None
+            if roll < self.drop_rate + self.error_rate:
+                self._stats['faults'] += 1
+                return 'error', None, 503, None
+            return None
+
+    def _delay(self):
+        with self._lock:
+            extra = self._random.uniform(0, self.jitter) if self.jitter else 0.0
+        if self.latency or extra:
+            time.sleep(self.latency + extra)
+
+    def _query(self, body):
+        try:
+            return 200, self.db._run_raw(body['script'], body.get('params') or {}, body.get('immutable', False))
+        except QueryException as e:
+            return 400, _error_payload(e)
+
+    def _begin(self, write):
+        tx = self.db.multi_transact(write)
+        with self._lock:
+            tx_id = self._next_tx_id
+            self._next_tx_id += 1
+            self._transactions[tx_id] = tx
+        return 200, {'ok': True, 'id': tx_id}
+
+    def _tx_query(self, tx_id, body):
+        tx = self._transactions.get(tx_id)
+        if tx is None:
+            return 404, {'ok': False, 'message': f'Transaction {tx_id} not found'}
+        try:
+            return 200, tx.multi_tx.run_script(body['script'], body.get('params') or {})
+        except Exception as e:
+            return 400, _error_payload(e)
+
+    def _tx_finish(self, tx_id, body):
+        with self._lock:
+            tx = self._transactions.pop(tx_id, None)
+        if tx is None:
+            return 404, {'ok': False, 'message': f'Transaction {tx_id} not found'}
+        try:
+            tx.abort() if body.get('abort') else tx.commit()
+        except Exception as e:
+            return 400, _error_payload(e)
+        return 200, {'ok': True}
+
+    def _call(self, fn, *args):
+        """Calls of the database other than queries, answered as `{'ok': ...}`"""
+        try:
+            res = fn(*args)
+        except Exception as e:
+            return 400, _error_payload(e)
+        return 200, {'ok': True, **(res or {})}
+
+
+def _error_payload(e):
+    """The error of the database as the server reports it"""
+    if isinstance(e, QueryException):
+        e = e.resp
+    elif e.args and isinstance(e.args[0], dict):
+        e = e.args[0]
+    if isinstance(e, dict):
+        return e
+    return {'ok': False, 'message': str(e)}
+
+
+def _handler_class(stub):
+    class Handler(_StubHandler):
+        server_stub = stub
+
+    return Handler
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_stub = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def _handle(self, method):
+        stub = self.server_stub
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        raw = self._read_body()
+        stub._delay()
+        fault = stub._take_fault(path)
+        if fault is not None:
+            kind, _, status, seconds = fault
+            if kind == 'drop':
+                stub._count(path, len(raw))
+                self.close_connection = True
+                return
+            elif kind == 'error':
+                stub._count(path, len(raw))
+                return self._respond(status, {'ok': False, 'message': 'Injected fault'})
+            time.sleep(seconds)
+        if stub.auth is not None and self.headers.get('x-cozo-auth') != stub.auth:
+            stub._count(path, len(raw))
+            return self._respond(401, {'ok': False, 'message': 'Unauthorized'})
+        compression = self.headers.get('Content-Encoding')
+        if compression and compression not in stub.request_compressions:
+            stub._count(path, len(raw))
+            return self._respond(415, {'ok': False, 'message': f'Unsupported Content-Encoding {compression}'})
+        if method == 'GET' and path.startswith('/changes/'):
+            stub._count(path, len(raw))
+            return self._stream_changes(urllib.parse.unquote(path[len('/changes/'):]))
+        body = self._decode(raw)
+        status, payload = self._route(method, path, urllib.parse.parse_qs(url.query), body)
+        # counted before the client can see the response, so that stats taken after a call include it
+        stub._count(path, len(raw))
+        sent = self._respond(status, payload)
+        stub._count_sent(sent)
+
+    def _route(self, method, path, query, body):
+        stub = self.server_stub
+        parts = path.strip('/').split('/')
+        if method == 'POST' and path == '/text-query':
+            return stub._query(body)
+        elif method == 'POST' and path == '/transact':
+            return stub._begin(query.get('write', ['false'])[0] == 'true')
+        elif parts[0] == 'transact' and len(parts) == 2 and parts[1].isdigit():
+            if method == 'POST':
+                return stub._tx_query(int(parts[1]), body)
+            elif method == 'PUT':
+                return stub._tx_finish(int(parts[1]), body)
+        elif method == 'GET' and parts[0] == 'export' and len(parts) == 2:
+            relations = [urllib.parse.unquote_plus(r) for r in parts[1].split(',')]
+            return stub._call(lambda: {'data': stub.db.export_relations(relations)})
+        elif method == 'PUT' and path == '/import':
+            return stub._call(stub.db.import_relations, body)
+        elif method == 'POST' and path == '/backup':
+            return stub._call(stub.db.backup, body['path'])
+        elif method == 'POST' and path == '/import-from-backup':
+            return stub._call(stub.db.import_from_backup, body['path'], body['relations'])
+        return 404, {'ok': False, 'message': f'No route for {method} {path}'}
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return b''
+        chunks = []
+        remaining = length
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 65536))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            self._throttle(len(chunk))
+        return b''.join(chunks)
+
+    def _decode(self, raw):
+        if not raw:
+            return {}
+        encoding = self.headers.get('Content-Encoding')
+        if encoding == 'gzip':
+            raw = gzip.decompress(raw)
+        elif encoding == 'zstd':
+            import zstandard
+            raw = zstandard.ZstdDecompressor().decompress(raw)
+        content_type = (self.headers.get('Content-Type') or 'application/json').split(';')[0].strip()
+        for name, (type_, _, decode) in _WIRE_ENCODINGS.items():
+            if type_ == content_type:
+                return decode(raw)
+        return json.loads(raw)
+
+    def _response_encoding(self):
+        accept = self.headers.get('Accept') or ''
+        preferences = []
+        for i, item in enumerate(accept.split(',')):
+            parts = [p.strip() for p in item.split(';')]
+            quality = 1.0
+            for p in parts[1:]:
+                if p.startswith('q='):
+                    quality = float(p[2:])
+            preferences.append((-quality, i, parts[0]))
+        for _, _, content_type in sorted(preferences):
+            for name in self.server_stub.encodings:
+                if _WIRE_ENCODINGS[name][0] == content_type:
+                    return name
+        return 'json'
+
+    def _respond(self, status, payload):
+        encoding = self._response_encoding()
+        content_type, encode, _ = _WIRE_ENCODINGS[encoding]
+        data = encode(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if self.server_stub.request_compressions:
+            self.send_header('Accept-Encoding', ', '.join(self.server_stub.request_compressions))
+        if self.server_stub.compress_responses and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            data = gzip.compress(data, compresslevel=5)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        for offset in range(0, len(data), 65536):
+            chunk = data[offset:offset + 65536]
+            try:
+                self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # clients may hang up without reading the whole response, e.g. when a result is too large
+                self.close_connection = True
+                return offset
+            self._throttle(len(chunk))
+        return len(data)
+
+    def _throttle(self, n_bytes):
+        bandwidth = self.server_stub.bandwidth
+        if bandwidth:
+            time.sleep(n_bytes / bandwidth)
+
+    def _stream_changes(self, relation):
+        import queue
+
+        stub = self.server_stub
+        events = queue.Queue()
+        cb_id = stub.db.register_callback(relation, lambda op, new, old: events.put((op, new, old)))
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.flush()
+            while not stub._closing.is_set():
+                try:
+                    op, new_rows, old_rows = events.get(timeout=_SSE_KEEPALIVE)
+                except queue.Empty:
+                    # lets the client notice that it unsubscribed, and us that it went away
+                    message = b': keep-alive\n\n'
+                else:
+                    payload = {'op': op, 'new_rows': {'rows': new_rows}, 'old_rows': {'rows': old_rows}}
+                    message = f'data: {json.dumps(payload)}\n\n'.encode('utf-8')
+                self.wfile.write(message)
+                self.wfile.flush()
+                self._throttle(len(message))
+                with stub._lock:
+                    stub._stats['bytes_out'] += len(message)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stub.db.unregister_callback(cb_id)
+
+
+def _benchmark(rows=100000, latency=0.0, bandwidth=None):
+    """Bytes on the wire and time taken to write and read back `rows` rows, per wire configuration"""
+    configs = [
+        ('json', None, False),
+        ('json', 'gzip', True),
+        ('msgpack', None, False),
+        ('msgpack', 'zstd', True),
+    ]
+    data = [[i, f'value {i}', i * 0.5] for i in range(rows)]
+    results = {}
+    for encoding, compression, compress_responses in configs:
+        with StubServer(latency=latency, bandwidth=bandwidth, compress_responses=compress_responses) as server:
+            db = server.client(encoding, compression, dataframe=False)
+            db.run(':create bench {k: Int => s: String, f: Float}')
+            server.reset_stats()
+            start = time.perf_counter()
+            db.run('?[k, s, f] <- $rows :put bench {k => s, f}', {'rows': data})
+            # the first response tells the client that the binary encoding is accepted, the second put uses it
+            db.run('?[k, s, f] <- $rows :put bench {k => s, f}', {'rows': data})
+            written = time.perf_counter()
+            assert len(db.run('?[k, s, f] := *bench{k, s, f}', immutable=True)['rows']) == rows
+            done = time.perf_counter()
+            stats = server.stats()
+            db.close()
+        name = encoding + (f'+{compression}' if compression else '')
+        results[name] = {'bytes_in': stats['bytes_in'], 'bytes_out': stats['bytes_out'],
+                         'write_seconds': written - start, 'read_seconds': done - written}
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+
+    args = sys.argv[1:]
+    n_rows = int(args[0]) if args else 100000
+    rtt = float(args[1]) if len(args) > 1 else 0.0
+    limit = float(args[2]) if len(args) > 2 else None
+    for config, res in _benchmark(n_rows, rtt, limit).items():
+        print(f'{config:14} sent {res["bytes_in"] / 1e6:8.2f} MB  received {res["bytes_out"] / 1e6:8.2f} MB  '
+              f'write {res["write_seconds"]:7.3f}s  read {res["read_seconds"]:7.3f}s')
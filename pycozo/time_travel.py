@@ -0,0 +1,165 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Running builder programs against stored relations as of a point in time.
+
+An `AsOf` view rewrites the programs of `pycozo.builder` so that every stored-relation atom on a relation with
+time travel (one whose last key column is of type `Validity`) reads the relation as of the view's timestamp.
+Atoms that already have a validity are left alone, and so are the scripts of `RawAtom`s.
+
+Results are cached by the client, keyed by the rewritten script and its parameters, but only while the
+timestamp is in the past, and only for programs whose every stored-relation atom is read as of the timestamp:
+facts asserted from now on are valid from now on, so they do not change what was true before. Programs reading
+relations without time travel, atoms with their own validity, raw scripts or proximity indexes see the current
+state of those, and are not cached. Facts can also be asserted with an explicit, earlier validity. Writes made
+through the client, including in committed transactions, drop the cached results reading the relations they
+name, while writes made by triggers or by other clients must be followed by `Client.invalidate_as_of_cache`.
+"""
+
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+
+from pycozo.builder import (Conjunction, Const, Disjunction, FixedRule, InlineRule, InputProgram, Negation,
+                            ProximityApply, RawAtom, StoredRuleApply, StoredRuleNamedApply)
+from pycozo.client import QueryException, _flight_key
+from pycozo.limits import check_result
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# validities that move with the clock or with writes
+_RELATIVE = ('NOW', 'END')
+
+
+class AsOf:
+    """Runs builder programs as of a fixed timestamp, caching the results. Use `Client.as_of` to create views.
+
+    >>> from pycozo.builder import InlineRule, RuleHead, StoredRuleNamedApply
+    >>> from pycozo.client_patch import Client
+    >>> db = Client(dataframe=False)
+    >>> _ = db.run(':create prices {item: String, at: Validity => price: Float}')
+    >>> _ = db.run('?[item, at, price] <- [["tea", [1000000, true], 2.0], ["tea", [2000000, true], 2.5]] '
+    ...            ':put prices {item, at => price}')
+    >>> program = InputProgram([InlineRule(RuleHead('?', ['price']),
+    ...                                    [StoredRuleNamedApply('prices', {'item': Const('tea'), 'price': 'price'})])])
+    >>> db.as_of(1500000).script(program)
+    '?[price] :=\\n    *prices{item: "tea", price: price @ 1500000}'
+    >>> db.as_of(1500000).run(program)['rows']
+    [[2.0]]
+    """
+
+    def __init__(self, client, timestamp):
+        """
+        :param client: a `pycozo.client_patch.Client`, which holds the cache.
+        :param timestamp: a `datetime` (naive ones are in local time), an int number of microseconds since the
+                          epoch as stored in `Validity` columns, an ISO 8601 string, or 'NOW' or 'END'.
+                          Results are not cached for 'NOW', 'END' and timestamps in the future.
+        """
+        self.client = client
+        self.timestamp = timestamp
+        self._micros = _micros(timestamp)
+        self.validity = Const(self._micros if self._micros is not None else timestamp)
+
+    @property
+    def cacheable(self):
+        """Whether results read at this timestamp can be cached now"""
+        return self._micros is not None and self._micros < _now_micros()
+
+    def program(self, program):
+        """A copy of the program reading the relations with time travel as of the timestamp"""
+        return self._rewrite(program, set())[0]
+
+    def script(self, program):
+        """The CozoScript of `program(program)`"""
+        return str(self.program(program))
+
+    def run(self, program, params=None, dtypes=None, format=None, timeout=None, priority=None, cache=True,
+            max_rows=None, max_bytes=None):
+        """Run a program as of the timestamp.
+
+        :param program: a `pycozo.builder.InputProgram`. Scripts cannot be rewritten, use `@` in them instead.
+        :param cache: whether the result can be taken from, and put in, the cache of the client.
+                      Programs storing their result in a relation, or reading anything but relations with
+                      time travel as of the timestamp, are never cached.
+        :param params, dtypes, format, timeout, priority, max_rows, max_bytes: as for `Client.run`.
+        """
+        if not isinstance(program, InputProgram):
+            raise TypeError(f'Expected a pycozo.builder.InputProgram, got {type(program).__name__}')
+        rewritten, relations = self._rewrite(program, set())
+        script = str(rewritten)
+        if isinstance(dtypes, str):
+            dtypes = self.client.relation_dtypes(dtypes)
+        immutable = program.store_relation is None
+        key = _flight_key(script, params, None)
+        cache = cache and immutable and self.cacheable and None not in relations and key is not None
+        if cache:
+            res = self.client._as_of_cache_get(key, relations)
+            if res is not None:
+                # cached by a call that may have had higher limits
+                check_result(res, self.client.max_rows if max_rows is None else max_rows,
+                             self.client.max_bytes if max_bytes is None else max_bytes)
+                return self.client._to_output(res, dtypes, format)
+            # taken before running, so that writes made meanwhile leave the entry stale
+            generations = self.client._as_of_generations(relations)
+        res = self.client._run_checked(script, params, immutable, timeout, priority, max_rows, max_bytes)
+        if cache:
+            self.client._as_of_cache_put(key, generations, res)
+        return self.client._to_output(res, dtypes, format)
+
+    def _rewrite(self, node, relations):
+        """The node with validity added to its stored-relation atoms, and the relations it reads.
+
+        None among the relations stands for what is not read as of the timestamp: relations without time travel,
+        atoms with their own validity, proximity indexes and raw scripts."""
+        if isinstance(node, (StoredRuleApply, StoredRuleNamedApply)):
+            relations.add(node.name)
+            if node.validity is None and self._has_time_travel(node.name):
+                node = replace(node, validity=self.validity)
+            else:
+                relations.add(None)
+        elif isinstance(node, (ProximityApply, RawAtom)):
+            relations.add(None)
+        elif isinstance(node, (Conjunction, Disjunction)):
+            node = replace(node, atoms=[self._rewrite(atom, relations)[0] for atom in node.atoms])
+        elif isinstance(node, Negation):
+            node = replace(node, atom=self._rewrite(node.atom, relations)[0])
+        elif isinstance(node, InlineRule):
+            node = replace(node, atoms=[self._rewrite(atom, relations)[0] for atom in node.atoms])
+        elif isinstance(node, FixedRule):
+            node = replace(node, inputs=[self._rewrite(rule, relations)[0] for rule in node.inputs])
+        elif isinstance(node, InputProgram):
+            node = replace(node, rules=[self._rewrite(rule, relations)[0] for rule in node.rules])
+        return node, relations
+
+    def _has_time_travel(self, name):
+        try:
+            keys = [row for row in self.client._cached_columns(name)['rows'] if row[1]]
+        except QueryException:
+            # let the database report the missing relation
+            return False
+        return bool(keys) and keys[-1][3] == 'Validity'
+
+    def __repr__(self):
+        return f'AsOf({self.timestamp!r})'
+
+
+def _micros(timestamp):
+    """Microseconds since the epoch of a fixed timestamp, None for relative ones"""
+    if isinstance(timestamp, datetime):
+        return (timestamp.astimezone(timezone.utc) - _EPOCH) // timedelta(microseconds=1)
+    if isinstance(timestamp, int) and not isinstance(timestamp, bool):
+        return timestamp
+    if isinstance(timestamp, str):
+        if timestamp in _RELATIVE:
+            return None
+        try:
+            return _micros(datetime.fromisoformat(timestamp))
+        except ValueError:
+            raise ValueError(f'Cannot parse timestamp {timestamp!r}, expected ISO 8601, NOW or END') from None
+    raise TypeError(f'Expected a datetime, microseconds or a string as timestamp, got {type(timestamp).__name__}')
+
+
+def _now_micros():
+    return (datetime.now(timezone.utc) - _EPOCH) // timedelta(microseconds=1)
@@ -0,0 +1,500 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Chunked export and import of stored relations to and from files.
+
+Relations are paged through in key order, so that only one chunk per relation is held in memory at any time.
+Each relation goes into its own file in the target directory, named after the relation, in one of the formats:
+
+* `ndjson`: a header line `{"relation": ..., "headers": [...]}` followed by one JSON array per row.
+  Compression can be 'gzip', 'bz2', 'xz', or 'zstd' (requires the `zstandard` package).
+* `parquet`: one row group per chunk. Compression is passed to `pyarrow` (e.g. 'snappy', 'zstd').
+* `arrow`: an Arrow IPC file with one record batch per chunk. Compression can be 'lz4' or 'zstd'.
+
+The `parquet` and `arrow` formats require the `pyarrow` package.
+"""
+
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('ndjson', 'parquet', 'arrow')
+
+_NDJSON_SUFFIXES = {
+    None: '.ndjson',
+    'gzip': '.ndjson.gz',
+    'bz2': '.ndjson.bz2',
+    'xz': '.ndjson.xz',
+    'zstd': '.ndjson.zst',
+}
+
+
+def iter_relation_chunks(client, relation, chunk_size=10000):
+    """Yield the rows of a stored relation in key order, as `(headers, rows)` with at most `chunk_size` rows.
+
+    Each chunk is a separate query that resumes after the last key of the previous chunk, so the cost of a chunk
+    does not grow with its position in the relation.
+    """
+    columns = client._run_raw(f'::columns {relation}', immutable=True)['rows']
+    headers = [col[0] for col in columns]
+    keys = [col[0] for col in columns if col[1]]
+    head = ', '.join(headers)
+    # the output of a rule is ordered by its head, which starts with the key columns
+    base = f'?[{head}] := *{relation}{{{head}}}'
+    script = f'{base} :limit {chunk_size}'
+    params = {}
+    while True:
+        with client._admission(None, 'batch'):
+            rows = client._run_raw(script, params, immutable=True)['rows']
+        if rows:
+            yield headers, rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][:len(keys)]
+        # the condition on the first key alone lets the engine turn the scan into a range scan
+        script = f'{base}, {keys[0]} >= $first, [{", ".join(keys)}] > $last :limit {chunk_size}'
+        params = {'first': last[0], 'last': last}
+
+
+def export_to_file(client, relations, path, format='ndjson', compression=None, chunk_size=10000, workers=4,
+                   progress=None):
+    """Export stored relations into files in the directory `path`, one file per relation.
+
+    :param relations: names of the relations in a list.
+    :param progress: if given, called as `progress(relation, rows_written)` after each chunk.
+    :return: a dict from relation names to the number of rows written.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unknown export format {format!r}, expected one of {FORMATS}')
+    os.makedirs(path, exist_ok=True)
+    writer = {'ndjson': _export_ndjson, 'parquet': _export_parquet, 'arrow': _export_arrow}[format]
+
+    def export_one(relation):
+        chunks = iter_relation_chunks(client, relation, chunk_size)
+        return writer(client, relation, chunks, path, compression, _progress_reporter(relation, progress))
+
+    return _run_parallel(export_one, relations, workers)
+
+
+def import_from_file(client, path, chunk_size=10000, relations=None, workers=4, progress=None):
+    """Import relations from files written by `export_to_file`.
+
+    Each chunk is loaded with `client.import_relations`, so triggers are _not_ run and the relations must exist.
+
+    :param path: a single exported file, or a directory containing them.
+    :param relations: if given, only files of these relations are imported.
+    :param progress: if given, called as `progress(relation, rows_read)` after each chunk.
+    :return: a dict from relation names to the number of rows imported.
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if _file_format(f)]
+    else:
+        files = [path]
+
+    jobs = {}
+    closers = []
+    try:
+        for file in files:
+            # files are named after their relation, which spares opening those of the other relations
+            if relations is not None and _file_relation(os.path.basename(file)) not in relations:
+                continue
+            relation, chunks, close = _open_chunks(file, chunk_size)
+            closers.append(close)
+            if relations is None or relation in relations:
+                jobs[relation] = chunks
+
+        def import_one(relation):
+            report = _progress_reporter(relation, progress)
+            total = 0
+            for headers, rows in jobs[relation]:
+                client.import_relations({relation: {'headers': headers, 'rows': rows}})
+                total += len(rows)
+                report(total)
+            return total
+
+        return _run_parallel(import_one, list(jobs), workers)
+    finally:
+        for close in closers:
+            close()
+
+
+def iter_json_export(f, chunk_size=10000):
+    """Yield `(relation, headers, rows)` with at most `chunk_size` rows from a JSON text stream in the format of
+    `Client.export_relations`, i.e. `{"<relation>": {"headers": [...], "rows": [[...], ...]}, ...}`.
+
+    Only one chunk of rows is held in memory at any time, plus the rows of a relation whose "rows" come before
+    its "headers", which does not happen for files written by `json.dump` from `export_relations`.
+    """
+    stream = _JsonStream(f)
+    stream.expect('{')
+    if stream.consume('}'):
+        return
+    while True:
+        relation = stream.value()
+        stream.expect(':')
+        stream.expect('{')
+        headers = None
+        pending = []
+        if not stream.consume('}'):
+            while True:
+                key = stream.value()
+                stream.expect(':')
+                if key == 'headers':
+                    headers = stream.value()
+                    if pending:
+                        yield relation, headers, pending
+                        pending = []
+                elif key == 'rows':
+                    stream.expect('[')
+                    rows = []
+                    if not stream.consume(']'):
+                        while True:
+                            rows.append(stream.value())
+                            if len(rows) >= chunk_size and headers is not None:
+                                yield relation, headers, rows
+                                rows = []
+                            if stream.consume(']'):
+                                break
+                            stream.expect(',')
+                    if headers is not None:
+                        if rows:
+                            yield relation, headers, rows
+                    else:
+                        pending.extend(rows)
+                else:
+                    stream.value()
+                if stream.consume('}'):
+                    break
+                stream.expect(',')
+        if pending:
+            raise ValueError(f'Rows of {relation} without headers')
+        if stream.consume('}'):
+            return
+        stream.expect(',')
+
+
+class _JsonStream:
+    """Reads JSON values one at a time from a text stream, refilling a buffer as needed"""
+
+    def __init__(self, f, block_size=1 << 16):
+        self._f = f
+        self._block_size = block_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self._f.read(self._block_size)
+        if not data:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _skip_ws(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in ' \t\r\n':
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._fill():
+                return
+
+    def consume(self, char):
+        self._skip_ws()
+        if self._buf[self._pos:self._pos + 1] == char:
+            self._pos += 1
+            return True
+        return False
+
+    def expect(self, char):
+        if not self.consume(char):
+            found = self._buf[self._pos:self._pos + 20] or 'end of file'
+            raise ValueError(f'Malformed JSON export: expected {char!r}, found {found!r}')
+
+    def value(self):
+        self._skip_ws()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the next block
+            if end == len(self._buf) and not self._eof and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+def _stream_query(client, script, params, immutable, timeout, sink):
+    """Run a query on a remote database, handing each row to `sink.add` as it is parsed from the response.
+
+    `sink.headers` is set once the headers are read. Returns the other fields of the response."""
+    import io
+    from pycozo.client import QueryException
+
+    body = {'script': script, 'params': params or {}, 'immutable': immutable}
+    res = {}
+    try:
+        with client._http_request('POST', '/text-query', body, timeout, stream=True) as r:
+            r.raw.decode_content = True
+            # keep the body readable to its end, `io.TextIOWrapper` fails on a body that closed itself
+            r.raw.auto_close = False
+            stream = _JsonStream(io.TextIOWrapper(r.raw, encoding='utf-8'))
+            stream.expect('{')
+            if not stream.consume('}'):
+                while True:
+                    key = stream.value()
+                    stream.expect(':')
+                    if key == 'rows':
+                        stream.expect('[')
+                        if not stream.consume(']'):
+                            while True:
+                                sink.add(stream.value())
+                                if stream.consume(']'):
+                                    break
+                                stream.expect(',')
+                    else:
+                        res[key] = stream.value()
+                        if key == 'headers':
+                            sink.headers = res[key]
+                    if stream.consume('}'):
+                        break
+                    stream.expect(',')
+    finally:
+        # as `_run_raw` does, a write may have happened even if the response was not read to its end
+        if not immutable:
+            client._invalidate_for(script)
+    if res.get('ok') is False or 'headers' not in res:
+        raise QueryException(res)
+    return res
+
+
+def _run_parallel(fn, relations, workers):
+    if workers <= 1 or len(relations) <= 1:
+        return {relation: fn(relation) for relation in relations}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {relation: pool.submit(fn, relation) for relation in relations}
+        return {relation: future.result() for relation, future in futures.items()}
+
+
+def _progress_reporter(relation, progress):
+    def report(n_rows):
+        logger.debug(f'{relation}: {n_rows} rows')
+        if progress is not None:
+            progress(relation, n_rows)
+
+    return report
+
+
+def _file_format(filename):
+    if '.ndjson' in filename:
+        return 'ndjson'
+    elif filename.endswith('.parquet'):
+        return 'parquet'
+    elif filename.endswith('.arrow'):
+        return 'arrow'
+    return None
+
+
+def _file_relation(filename):
+    """The relation an exported file is named after"""
+    for suffix in sorted(_NDJSON_SUFFIXES.values(), key=len, reverse=True) + ['.parquet', '.arrow']:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+    return None
+
+
+def _open_text(file, mode, compression):
+    if compression is None:
+        return open(file, mode + 't', encoding='utf-8')
+    elif compression == 'gzip':
+        import gzip
+        return gzip.open(file, mode + 't', encoding='utf-8')
+    elif compression == 'bz2':
+        import bz2
+        return bz2.open(file, mode + 't', encoding='utf-8')
+    elif compression == 'xz':
+        import lzma
+        return lzma.open(file, mode + 't', encoding='utf-8')
+    elif compression == 'zstd':
+        import zstandard
+        return zstandard.open(file, mode + 't', encoding='utf-8')
+    raise ValueError(f'Unknown compression {compression!r} for ndjson')
+
+
+def _ndjson_compression(filename):
+    for compression, suffix in _NDJSON_SUFFIXES.items():
+        if compression and filename.endswith(suffix):
+            return compression
+    return None
+
+
+def _export_ndjson(client, relation, chunks, path, compression, report):
+    if compression not in _NDJSON_SUFFIXES:
+        raise ValueError(f'Unknown compression {compression!r} for ndjson')
+    total = 0
+    with _open_text(os.path.join(path, relation + _NDJSON_SUFFIXES[compression]), 'w', compression) as f:
+        header_written = False
+        for headers, rows in chunks:
+            if not header_written:
+                f.write(json.dumps({'relation': relation, 'headers': headers}) + '\n')
+                header_written = True
+            f.write(''.join(json.dumps(row) + '\n' for row in rows))
+            total += len(rows)
+            report(total)
+        if not header_written:
+            headers = [col[0] for col in client._run_raw(f'::columns {relation}', immutable=True)['rows']]
+            f.write(json.dumps({'relation': relation, 'headers': headers}) + '\n')
+    return total
+
+
+def _read_ndjson(file, chunk_size):
+    f = _open_text(file, 'r', _ndjson_compression(file))
+    try:
+        header = json.loads(f.readline())
+    except Exception:
+        f.close()
+        raise
+
+    def chunks():
+        with f:
+            rows = []
+            for line in f:
+                if line.strip():
+                    rows.append(json.loads(line))
+                if len(rows) >= chunk_size:
+                    yield header['headers'], rows
+                    rows = []
+            if rows:
+                yield header['headers'], rows
+
+    return header['relation'], chunks(), f.close
+
+
+def _arrow_schema(client, relation):
+    """The Arrow schema for a relation. Columns without a scalar Cozo type are stored as JSON text."""
+    import pyarrow as pa
+    from pycozo.arrow import arrow_type
+
+    fields = []
+    json_columns = []
+    for row in client._run_raw(f'::columns {relation}', immutable=True)['rows']:
+        name, typ = row[0], arrow_type(row[3])
+        if typ is not None:
+            fields.append(pa.field(name, typ))
+        else:
+            fields.append(pa.field(name, pa.string()))
+            json_columns.append(name)
+    metadata = {b'cozo.relation': relation.encode('utf-8'),
+                b'cozo.json_columns': json.dumps(json_columns).encode('utf-8')}
+    return pa.schema(fields, metadata=metadata), json_columns
+
+
+def _arrow_batch(schema, json_columns, headers, rows):
+    import pyarrow as pa
+
+    arrays = []
+    for i, name in enumerate(headers):
+        values = [row[i] for row in rows]
+        if name in json_columns:
+            values = [None if v is None else json.dumps(v) for v in values]
+        arrays.append(pa.array(values, type=schema.field(name).type))
+    return pa.record_batch(arrays, schema=schema)
+
+
+def _batch_rows(batch, json_columns):
+    from pycozo.arrow import to_rows
+
+    headers, rows = to_rows(batch)
+    positions = [headers.index(name) for name in json_columns]
+    for row in rows:
+        for i in positions:
+            if row[i] is not None:
+                row[i] = json.loads(row[i])
+    return headers, rows
+
+
+def _export_arrow_like(client, relation, chunks, open_writer, report):
+    schema, json_columns = _arrow_schema(client, relation)
+    total = 0
+    with open_writer(schema) as writer:
+        for headers, rows in chunks:
+            writer.write_batch(_arrow_batch(schema, json_columns, headers, rows))
+            total += len(rows)
+            report(total)
+    return total
+
+
+def _export_parquet(client, relation, chunks, path, compression, report):
+    import pyarrow.parquet as pq
+
+    file = os.path.join(path, relation + '.parquet')
+    return _export_arrow_like(client, relation, chunks,
+                              lambda schema: pq.ParquetWriter(file, schema, compression=compression or 'snappy'),
+                              report)
+
+
+def _export_arrow(client, relation, chunks, path, compression, report):
+    import pyarrow as pa
+
+    file = os.path.join(path, relation + '.arrow')
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    return _export_arrow_like(client, relation, chunks,
+                              lambda schema: pa.ipc.new_file(file, schema, options=options),
+                              report)
+
+
+def _read_arrow_like(schema, batches, close):
+    relation = schema.metadata[b'cozo.relation'].decode('utf-8')
+    json_columns = json.loads(schema.metadata.get(b'cozo.json_columns', b'[]'))
+
+    def chunks():
+        try:
+            for batch in batches:
+                yield _batch_rows(batch, json_columns)
+        finally:
+            close()
+
+    return relation, chunks(), close
+
+
+def _read_parquet(file, chunk_size):
+    import pyarrow.parquet as pq
+
+    f = pq.ParquetFile(file)
+    return _read_arrow_like(f.schema_arrow, f.iter_batches(batch_size=chunk_size), f.close)
+
+
+def _read_arrow(file, chunk_size):
+    import pyarrow as pa
+
+    source = pa.OSFile(file)
+    try:
+        reader = pa.ipc.open_file(source)
+    except Exception:
+        source.close()
+        raise
+
+    def batches():
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, chunk_size):
+                yield batch.slice(offset, chunk_size)
+
+    return _read_arrow_like(reader.schema, batches(), source.close)
+
+
+def _open_chunks(file, chunk_size):
+    fmt = _file_format(os.path.basename(file))
+    if fmt is None:
+        raise ValueError(f'Cannot determine the format of {file}')
+    return {'ndjson': _read_ndjson, 'parquet': _read_parquet, 'arrow': _read_arrow}[fmt](file, chunk_size)
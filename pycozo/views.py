@@ -0,0 +1,198 @@
+#  Copyright 2023, The Cozo Project Authors.
+#
+#  This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#  If a copy of the MPL was not distributed with this file,
+#  You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Client-side materialized views, kept up to date from change callbacks.
+
+A view runs its query once and keeps the result in memory, indexed by its leading key columns.
+When the query is a count/sum grouped by columns of a single stored relation, and that shape is declared
+with `group_by` and `aggregates` including a count, the view applies each change event to the affected groups.
+The count tells when a group disappears. Otherwise, every change schedules a full re-run of the query,
+debounced so that bursts of changes cause one re-run.
+
+The embedded engine delivers the changes of only one relation at a time, so views of embedded databases have
+a single source relation. While a view is open, transactions of embedded databases cannot start, see
+`Client.multi_transact`.
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES = ('count', 'sum')
+
+
+class MaterializedView:
+    """An in-memory result of a query, maintained as its source relations change.
+
+    Use `Client.materialize` to create views.
+    """
+
+    def __init__(self, client, name, script, source_relations, params=None, group_by=None, aggregates=None,
+                 key_columns=None, debounce=0.05):
+        self.client = client
+        self.name = name
+        self.script = script
+        self.params = params or {}
+        self.source_relations = list(source_relations)
+        self.group_by = list(group_by or [])
+        self.aggregates = dict(aggregates or {})
+        self.key_columns = key_columns if key_columns is not None else (len(self.group_by) or 1)
+        self.debounce = debounce
+        self.headers = []
+        self.version = 0
+        self.recomputations = 0
+        self._lock = threading.RLock()
+        self._rows = {}
+        self._group_counts = {}
+        self._loading = False
+        self._dirty = False
+        self._timer = None
+        self._callbacks = []
+        self._positions = None
+
+        for agg, _ in self.aggregates.values():
+            if agg not in AGGREGATES:
+                raise ValueError(f'Unsupported aggregate {agg!r}, expected one of {AGGREGATES}')
+        if client.embedded and len(self.source_relations) > 1:
+            raise ValueError('An embedded database delivers the changes of only one relation at a time, '
+                             'views of embedded databases must have a single source relation')
+        if self.incremental:
+            columns = [c for c, _ in client._relation_columns(self.source_relations[0])]
+            wanted = self.group_by + [col for _, col in self.aggregates.values() if col is not None]
+            missing = [c for c in wanted if c not in columns]
+            if missing:
+                raise ValueError(f'Columns {missing} do not exist in relation {self.source_relations[0]}')
+            self._positions = {c: columns.index(c) for c in wanted}
+
+        # callbacks first, so that no change between the initial query and the subscription is lost
+        for relation in self.source_relations:
+            self._callbacks.append(client.register_callback(relation, self._on_change))
+        self.refresh()
+
+    @property
+    def incremental(self):
+        """Whether changes are applied incrementally rather than by re-running the query"""
+        return len(self.source_relations) == 1 and bool(self.group_by) and self._count_position is not None
+
+    @property
+    def _count_position(self):
+        """The position in the rows of the view of the count of source rows of the group, if any"""
+        for i, (agg, _) in enumerate(self.aggregates.values()):
+            if agg == 'count':
+                return len(self.group_by) + i
+        return None
+
+    def refresh(self):
+        """Re-run the query and replace the content of the view"""
+        with self._lock:
+            self._loading = True
+            self._dirty = False
+        try:
+            with self.client._admission(None, 'batch'):
+                res = self.client._run_raw(self.script, self.params, immutable=True)
+        finally:
+            with self._lock:
+                self._loading = False
+        with self._lock:
+            self.headers = list(res['headers'])
+            if self.incremental and (self.headers[:len(self.group_by)] != self.group_by or
+                                     len(self.headers) != len(self.group_by) + len(self.aggregates)):
+                raise ValueError(f'The query of view {self.name} returns {self.headers}, '
+                                 f'expected the group_by columns followed by one column per aggregate')
+            self._rows = {tuple(row[:self.key_columns]): list(row) for row in res['rows']}
+            if self.incremental:
+                # from the same result, so that the counts match the rows
+                count = self._count_position
+                self._group_counts = {tuple(row[:len(self.group_by)]): row[count] for row in res['rows']}
+            self.version += 1
+            self.recomputations += 1
+            dirty = self._dirty
+        if dirty:
+            # changes arrived while the query ran, they may or may not be reflected in its result
+            self._schedule_refresh()
+
+    def get(self, *key):
+        """The row of the view for the given key columns, or None"""
+        with self._lock:
+            row = self._rows.get(key)
+            return list(row) if row is not None else None
+
+    def rows(self):
+        """All rows of the view, sorted by key"""
+        with self._lock:
+            return [list(self._rows[k]) for k in sorted(self._rows)]
+
+    def result(self):
+        """The content of the view in the same form as `Client.run` returns"""
+        with self._lock:
+            return self.client._to_output({'headers': list(self.headers), 'rows': self.rows()})
+
+    def __len__(self):
+        return len(self._rows)
+
+    def close(self):
+        """Stop maintaining the view"""
+        for cb_id in self._callbacks:
+            self.client.unregister_callback(cb_id)
+        self._callbacks = []
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+
+    def _on_change(self, op, new_rows, old_rows):
+        try:
+            with self._lock:
+                if self._loading:
+                    self._dirty = True
+                    return
+                if not self.incremental:
+                    self._schedule_refresh()
+                    return
+                for row in old_rows:
+                    self._apply(row, -1)
+                if op == 'Put':
+                    for row in new_rows:
+                        self._apply(row, 1)
+                self.version += 1
+        except Exception:
+            logger.exception(f'Cannot apply change to view {self.name}, re-running its query')
+            self._schedule_refresh()
+
+    def _apply(self, source_row, sign):
+        group = tuple(source_row[self._positions[c]] for c in self.group_by)
+        count = self._group_counts.get(group, 0) + sign
+        if count <= 0:
+            self._group_counts.pop(group, None)
+            self._rows.pop(group, None)
+            return
+        self._group_counts[group] = count
+        row = self._rows.get(group)
+        if row is None:
+            # the database sums into floats
+            row = self._rows[group] = list(group) + [0 if agg == 'count' else 0.0
+                                                     for agg, _ in self.aggregates.values()]
+        for i, (agg, col) in enumerate(self.aggregates.values()):
+            if agg == 'count':
+                row[len(group) + i] += sign
+            else:
+                value = source_row[self._positions[col]]
+                if value is not None:
+                    row[len(group) + i] += sign * value
+
+    def _schedule_refresh(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._debounced_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _debounced_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception(f'Cannot refresh view {self.name}')
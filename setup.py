@@ -21,7 +21,8 @@ setup(
     extras_require={
         'pandas': ['pandas', 'ipython'],
         'embedded': ['cozo-embedded==' + VERSION],
-        'client': ['requests']
+        'client': ['requests'],
+        'arrow': ['pyarrow'],
     },
     classifiers=[
         "Development Status :: 3 - Alpha",